@@ -0,0 +1,82 @@
+"""
+Compare the join_asvbins FASTA reader and writer to the scikit-bio path
+
+Run with:
+
+    python benchmarks/fasta_io.py --records 20000 --length 1500
+
+scikit-bio is only needed for the comparison, if it is not installed only
+the join_asvbins numbers are reported.
+"""
+import os
+import random
+import argparse
+import tempfile
+from join_asvbins.utils import read_fasta, write_fasta
+from timing import time_call
+
+
+def make_fasta(path:str, records:int, length:int, line_width:int=60):
+    """Write a random nucleotide fasta"""
+    rng = random.Random(0)
+    with open(path, 'w') as out:
+        for i in range(records):
+            seq = "".join(rng.choices("ACGT", k=length))
+            out.write(f">scaffold_{i} bin_{i % 100}\n")
+            for j in range(0, length, line_width):
+                out.write(seq[j:j + line_width] + "\n")
+
+
+def native_read(path:str):
+    return [i for i in read_fasta(path)]
+
+
+def native_round_trip(path:str, out_path:str):
+    write_fasta(read_fasta(path), out_path)
+
+
+def skbio_read(path:str):
+    from skbio import read as read_fa
+    return [i.values for i in read_fa(path, format='fasta')]
+
+
+def skbio_round_trip(path:str, out_path:str):
+    from skbio import read as read_fa
+    from skbio import write as write_fa
+    write_fa(read_fa(path, format='fasta'), 'fasta', out_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--length", type=int, default=1500)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    try:
+        import skbio
+        has_skbio = True
+    except ImportError:
+        has_skbio = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        in_path = os.path.join(work_dir, 'in.fna')
+        out_path = os.path.join(work_dir, 'out.fna')
+        make_fasta(in_path, args.records, args.length)
+        size_mb = os.path.getsize(in_path) / 1e6
+        print(f"{args.records} records, {size_mb:.1f} MB")
+        print("task\tjoin_asvbins_s\tskbio_s\tspeedup")
+        for task, native, other in [
+                ('read', lambda: native_read(in_path),
+                 lambda: skbio_read(in_path)),
+                ('read_write', lambda: native_round_trip(in_path, out_path),
+                 lambda: skbio_round_trip(in_path, out_path))]:
+            native_time = time_call(native, args.repeats)
+            if has_skbio:
+                other_time = time_call(other, args.repeats)
+                print(f"{task}\t{native_time:.3f}\t{other_time:.3f}\t"
+                      f"{other_time / native_time:.1f}x")
+            else:
+                print(f"{task}\t{native_time:.3f}\tNA\tNA")
+
+
+if __name__ == '__main__':
+    main()
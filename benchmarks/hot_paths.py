@@ -0,0 +1,159 @@
+"""
+Time the pandas hot paths of join_asvbins at several data sizes
+
+Run with:
+
+    python benchmarks/hot_paths.py --sizes 1000 10000 100000 --length 1500
+
+Each size is the number of rows in the synthetic hit table. The number of
+scaffolds and barrnap fragments scale with it, see --hits_per_scaffold, and
+every scaffold is --length bases long. For each function the best wall clock
+time of --repeats runs and the peak memory traced by tracemalloc in one more
+run are printed as a table, so the output of two versions can be compared
+line by line.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from join_asvbins.seq_array import SeqArray
+from join_asvbins.utils import (
+    filter_mdstats, process_barfasta, process_mbdata, combine_fasta,
+    fasta_to_df, df_to_fasta, MBSTATS_NAMES)
+from join_asvbins.snake_functions import resolve_dup_gene_locs
+from timing import time_call, peak_memory
+
+# The stage 1 filters from the default config
+FILTER_ARGS = {'min_pct_id': 95.0, 'min_len_pct': 80.0, 'max_gaps': 10,
+               'max_missmatch': 50, 'min_len_with_overlap': 1000,
+               'min_len_pct_no_overlap': 98.0}
+QUERY_LENGTH = 1500
+
+
+def make_seqs(lengths:np.ndarray, rng) -> SeqArray:
+    """Random nucleotide sequences with the given lengths"""
+    codes = np.frombuffer(b'ACGT', dtype=np.uint8)
+    stops = np.cumsum(lengths, dtype=np.int64)
+    buffer = codes[rng.integers(0, 4, size=stops[-1] if len(stops) else 0)]
+    return SeqArray(buffer, stops - lengths, stops)
+
+
+def make_hits(rows:int, scaffolds:int, length:int, rng) -> pd.DataFrame:
+    """
+    A hit table in the mmseqs and blast format, with the scaffold sequences
+
+    About half the hits are on the minus strand, and the hits of a scaffold
+    overlap often enough to exercise resolve_dup_gene_locs.
+    """
+    scaffold = rng.integers(0, scaffolds, size=rows)
+    hit_length = rng.integers(QUERY_LENGTH // 2, QUERY_LENGTH + 1, size=rows)
+    hit_length = np.minimum(hit_length, length)
+    start = rng.integers(0, length - hit_length + 1) + 1
+    end = start + hit_length - 1
+    reverse = rng.random(rows) < 0.5
+    gaps = rng.integers(0, 15, size=rows)
+    mismatch = rng.integers(0, 60, size=rows)
+    return pd.DataFrame({
+        'qseqid': [f"asv_{i}" for i in rng.integers(0, 1000, size=rows)],
+        'sseqid': [f"scaffold_{i}" for i in scaffold],
+        'pident': np.round(rng.uniform(90, 100, size=rows), 1),
+        'length': hit_length,
+        'mismatch': mismatch,
+        'gapopen': gaps,
+        'qstart': np.ones(rows, dtype=int),
+        'qend': hit_length,
+        'sstart': np.where(reverse, end, start),
+        'send': np.where(reverse, start, end),
+        'evalue': rng.uniform(0, 1e-5, size=rows),
+        'bitscore': rng.integers(100, 3000, size=rows),
+        'qlen': np.full(rows, QUERY_LENGTH),
+        'slen': np.full(rows, length),
+        'seq': make_seqs(np.full(scaffolds, length), rng).take(scaffold)},
+        columns=MBSTATS_NAMES + ['seq'])
+
+
+def make_barrnap(scaffolds:int, length:int, rng) -> pd.DataFrame:
+    """
+    Barrnap fragments in the format of the extracted fasta
+
+    Each scaffold has one to three fragments that often overlap.
+    """
+    counts = rng.integers(1, 4, size=scaffolds)
+    scaffold = np.repeat(np.arange(scaffolds), counts)
+    frag_length = np.minimum(rng.integers(500, 1600, size=len(scaffold)),
+                             length)
+    start = rng.integers(0, length - frag_length + 1)
+    stop = start + frag_length
+    return pd.DataFrame({
+        'header': [f"scaffold_{i}:{j}-{k}" for i, j, k in
+                   zip(scaffold, start, stop)],
+        'seq': make_seqs(frag_length, rng)})
+
+
+def quiet(func):
+    """Hide the progress printed by the pipeline functions"""
+    def call():
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            return func()
+    return call
+
+
+def get_cases(rows:int, hits_per_scaffold:int, length:int,
+              work_dir:str) -> list:
+    """Make the data for one size and the calls to time on it"""
+    rng = np.random.default_rng(0)
+    scaffolds = max(1, rows // hits_per_scaffold)
+    hits = make_hits(rows, scaffolds, length, rng)
+    barrnap = make_barrnap(scaffolds, length, rng)
+    mbdata = process_mbdata(hits.copy())
+    bardata = process_barfasta(barrnap.copy())
+    fasta_path = os.path.join(work_dir, f"scaffolds_{rows}.fna")
+    out_path = os.path.join(work_dir, f"out_{rows}.fna")
+    fasta_data = mbdata[['sseqid', 'seq']].rename(
+        columns={'sseqid': 'header'})
+    fasta_data['note'] = 'mmseqs'
+    df_to_fasta(fasta_data, fasta_path)
+    return [
+        ('filter_mdstats', lambda: filter_mdstats(hits, **FILTER_ARGS)),
+        ('resolve_dup_gene_locs', lambda: resolve_dup_gene_locs(
+            hits, bs_name='sseqid', bs_start='sstart', bs_end='send',
+            values='bitscore', ascending=False)),
+        ('process_mbdata', lambda: process_mbdata(hits.copy())),
+        ('process_barfasta', lambda: process_barfasta(barrnap.copy())),
+        ('combine_fasta', quiet(lambda: combine_fasta(mbdata, bardata,
+                                                      'mmseqs'))),
+        ('fasta_to_df', lambda: fasta_to_df(fasta_path)),
+        ('df_to_fasta', lambda: df_to_fasta(fasta_data, out_path)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--hits_per_scaffold", type=int, default=4)
+    parser.add_argument("--length", type=int, default=1500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", nargs='+', default=None,
+                        help="Only run the functions with these names")
+    args = parser.parse_args()
+    print("function\trows\tscaffolds\ttime_s\tpeak_mb")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rows in args.sizes:
+            scaffolds = max(1, rows // args.hits_per_scaffold)
+            for name, func in get_cases(rows, args.hits_per_scaffold,
+                                        args.length, work_dir):
+                if args.only is not None and name not in args.only:
+                    continue
+                seconds = time_call(func, args.repeats)
+                peak = peak_memory(func)
+                print(f"{name}\t{rows}\t{scaffolds}\t{seconds:.4f}\t"
+                      f"{peak:.1f}")
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Time the whole join_asvbins pipeline with stub tools on synthetic bins
+
+Run with:
+
+    python benchmarks/pipeline.py --bins 10 1000 100000 --latency 0.5
+
+No real tools are needed, the tools are replaced by benchmarks/stub_tools.py
+so the numbers show the cost of the pipeline itself, the snakemake
+scheduling, the python run blocks and the file handling, at a size where it
+can be measured. For each number of bins a random set of 16S genes, ASVs cut
+from them and bins are made, some bins with a gene in their first scaffold,
+and the pipeline is run on them. For each rule the number of jobs, the wall
+time of the jobs, the time spent in the stub tools, the rest as python time,
+and the size of the inputs and outputs of the jobs are printed as a table.
+The stub calls are matched to jobs by time, so the tool time of each rule
+is only exact with --threads 1, the default. The table is written to --out,
+or printed with the pipeline output if it is not given.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from collections import defaultdict
+from join_asvbins import join_asvbins
+
+STUB_TOOLS = ['mmseqs', 'makeblastdb', 'blastn', 'barrnap', 'bedtools',
+              'samtools']
+GENE_LENGTH = 1500
+ASV_LENGTH = 250
+BASES = 'ACGT'
+
+
+def random_seq(rng, length:int) -> str:
+    return "".join(rng.choices(BASES, k=length))
+
+
+def mutate(rng, seq:str, rate:float) -> str:
+    """Change about rate of the bases of a sequence"""
+    seq = list(seq)
+    for i in rng.sample(range(len(seq)), int(len(seq) * rate)):
+        seq[i] = rng.choice(BASES.replace(seq[i], ''))
+    return "".join(seq)
+
+
+def reverse_complement(seq:str) -> str:
+    return seq.translate(str.maketrans(BASES, 'TGCA'))[::-1]
+
+
+def write_records(path:str, records):
+    with open(path, 'w') as out:
+        for name, seq in records:
+            out.write(f">{name}\n")
+            for i in range(0, len(seq), 60):
+                out.write(seq[i:i + 60] + "\n")
+
+
+def make_data(work_dir:str, bins:int, scaffolds:int, length:int,
+              genes:int, gene_fraction:float, seed:int=0) -> dict:
+    """
+    Write the 16S genes, ASVs and bins of one benchmark
+
+    Each gene gives one ASV, a piece with one change in it. A gene_fraction
+    of the bins get a copy of a gene with about 1% changes, on a random
+    strand, in their first scaffold.
+
+    :returns: A dict of the paths
+    """
+    rng = random.Random(seed)
+    gene_seqs = [random_seq(rng, GENE_LENGTH) for _ in range(genes)]
+    paths = {'generic_16S': os.path.join(work_dir, 'genes.fa'),
+             'asv_seqs': os.path.join(work_dir, 'asvs.fa'),
+             'bins': os.path.join(work_dir, 'bins')}
+    write_records(paths['generic_16S'],
+                  ((f"gene_{i}", j) for i, j in enumerate(gene_seqs)))
+    asvs = []
+    for i, gene in enumerate(gene_seqs):
+        start = rng.randrange(GENE_LENGTH - ASV_LENGTH)
+        asvs.append((f"asv_{i}", mutate(rng, gene[start:start + ASV_LENGTH],
+                                        1 / ASV_LENGTH)))
+    write_records(paths['asv_seqs'], asvs)
+    os.makedirs(paths['bins'])
+    for i in range(bins):
+        seqs = [random_seq(rng, length) for _ in range(scaffolds)]
+        if rng.random() < gene_fraction:
+            gene = mutate(rng, rng.choice(gene_seqs), 0.01)
+            if rng.random() < 0.5:
+                gene = reverse_complement(gene)
+            start = rng.randrange(max(1, length - GENE_LENGTH))
+            seqs[0] = seqs[0][:start] + gene + seqs[0][start + GENE_LENGTH:]
+        write_records(os.path.join(paths['bins'], f"bin_{i}.fa"),
+                      ((f"bin_{i}_scaffold_{j}", k)
+                       for j, k in enumerate(seqs)))
+    return paths
+
+
+def make_stub_dir(work_dir:str) -> str:
+    """Make a folder of scripts that call the stub tools by name"""
+    stub_dir = os.path.join(work_dir, 'stub_bin')
+    os.makedirs(stub_dir)
+    stub_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'stub_tools.py')
+    for tool in STUB_TOOLS:
+        path = os.path.join(stub_dir, tool)
+        with open(path, 'w') as out:
+            out.write(f"#!/bin/sh\nexec {sys.executable} {stub_path}"
+                      f" {tool} \"$@\"\n")
+        os.chmod(path, 0o755)
+    return stub_dir
+
+
+def path_size(path:str) -> int:
+    """The size of a file or everything in a folder, 0 if it is gone"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(i, k))
+                   for i, _, j in os.walk(path) for k in j)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class JobTimer:
+    """A snakemake log handler that times each job"""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def __call__(self, msg:dict):
+        if msg['level'] == 'job_info':
+            self.jobs[msg['jobid']] = {
+                'rule': msg['name'], 'start': time.time(), 'stop': None,
+                'input': list(msg['input']), 'output': list(msg['output'])}
+        elif msg['level'] == 'job_finished' and msg['jobid'] in self.jobs:
+            self.jobs[msg['jobid']]['stop'] = time.time()
+
+
+def read_stub_log(log_path:str) -> list:
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as in_file:
+        return [json.loads(i) for i in in_file]
+
+
+def summarize(jobs:list, calls:list, output_dir:str) -> dict:
+    """Add up the jobs and the stub calls in them by rule"""
+    rules = defaultdict(lambda: defaultdict(float))
+    for job in jobs:
+        rule = rules[job['rule']]
+        rule['jobs'] += 1
+        rule['wall_s'] += job['stop'] - job['start']
+        rule['input_mb'] += sum(path_size(os.path.join(output_dir, i))
+                                for i in job['input']) / 1e6
+        rule['output_mb'] += sum(path_size(os.path.join(output_dir, i))
+                                 for i in job['output']) / 1e6
+    for call in calls:
+        # The latest job that started before the call and had not finished
+        running = [i for i in jobs if i['start'] <= call['start'] <= i['stop']]
+        if len(running) == 0:
+            continue
+        rule = rules[max(running, key=lambda i: i['start'])['rule']]
+        rule['tool_s'] += call['stop'] - call['start']
+        rule['tool_io_mb'] += (call['read_bytes'] +
+                               call['written_bytes']) / 1e6
+    for rule in rules.values():
+        rule['python_s'] = max(0, rule['wall_s'] - rule['tool_s'])
+    return rules
+
+
+def run_benchmark(bins:int, args, work_dir:str, out):
+    data_dir = os.path.join(work_dir, f"data_{bins}")
+    os.makedirs(data_dir)
+    paths = make_data(data_dir, bins, args.scaffolds, args.length,
+                      args.genes, args.gene_fraction)
+    output_dir = os.path.join(work_dir, f"output_{bins}")
+    log_path = os.path.join(work_dir, f"stub_log_{bins}.jsonl")
+    os.environ['STUB_LOG'] = log_path
+    os.environ['STUB_BARRNAP_REFERENCE'] = paths['generic_16S']
+    timer = JobTimer()
+    start = time.time()
+    # Snakemake only reports finished jobs if it is not quiet
+    join_asvbins(output_dir=output_dir, threads=args.threads,
+                 blast=args.blast, keep_temp=True, verbosity=3,
+                 snake_args={'log_handler': [timer]}, **paths)
+    total = time.time() - start
+    jobs = [i for i in timer.jobs.values() if i['stop'] is not None]
+    rules = summarize(jobs, read_stub_log(log_path), output_dir)
+    columns = ['jobs', 'wall_s', 'tool_s', 'python_s', 'input_mb',
+               'output_mb', 'tool_io_mb']
+    for name in sorted(rules, key=lambda i: -rules[i]['wall_s']):
+        out.write(f"{bins}\t{name}\t" + "\t".join(
+            f"{rules[name][i]:.0f}" if i == 'jobs' else
+            f"{rules[name][i]:.3f}" for i in columns) + "\n")
+    tool_time = sum(i['tool_s'] for i in rules.values())
+    out.write(f"{bins}\ttotal\t{len(jobs)}\t{total:.3f}\t{tool_time:.3f}\t"
+              f"{total - tool_time:.3f}\tNA\t"
+              f"{sum(i['output_mb'] for i in rules.values()):.3f}\t"
+              f"{sum(i['tool_io_mb'] for i in rules.values()):.3f}\n")
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--bins", type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument("--scaffolds", type=int, default=2,
+                        help="Scaffolds in each bin")
+    parser.add_argument("--length", type=int, default=3000,
+                        help="The length of each scaffold")
+    parser.add_argument("--genes", type=int, default=20,
+                        help="The number of 16S genes and ASVs")
+    parser.add_argument("--gene_fraction", type=float, default=0.2,
+                        help="The fraction of bins with a 16S gene")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds each stub tool call takes to start")
+    parser.add_argument("--decoy_hits", type=int, default=0,
+                        help="Extra weak hits the stub searches write for"
+                        " each query")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--blast", action='store_true', default=False,
+                        help="Run the blast version of the pipeline")
+    parser.add_argument("--out", default=None,
+                        help="Write the table to this file")
+    parser.add_argument("--work_dir", default=None,
+                        help="Keep the data and outputs here, by default"
+                        " they are removed")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = temp_dir if args.work_dir is None else args.work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        os.environ['PATH'] = make_stub_dir(temp_dir) + os.pathsep + \
+            os.environ['PATH']
+        os.environ['STUB_LATENCY'] = str(args.latency)
+        os.environ['STUB_DECOY_HITS'] = str(args.decoy_hits)
+        out = sys.stdout if args.out is None else open(args.out, 'w')
+        out.write("bins\trule\tjobs\twall_s\ttool_s\tpython_s\tinput_mb\t"
+                  "output_mb\ttool_io_mb\n")
+        for bins in args.bins:
+            run_benchmark(bins, args, work_dir, out)
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+Stand ins for mmseqs, makeblastdb, blastn, barrnap, bedtools and samtools
+
+These are only for benchmarks/pipeline.py, they let the whole pipeline run
+with no real tools so the time spent outside of the tools can be measured.
+Call it with the tool name first:
+
+    python benchmarks/stub_tools.py mmseqs search query target out tmp
+
+The searches find exact k-mer seeds from the queries at a fixed stride along
+each target and score the diagonal of each seed with no gaps, which is fast
+and gives realistic tables as long as the matches are long and similar, as
+they are in the benchmark data. The environment sets the rest:
+
+STUB_LATENCY: Seconds to sleep in every call, for the start up of a tool
+STUB_DECOY_HITS: Extra weak hits to write for each query, to make the hit
+    tables bigger, they are removed by the default filters
+STUB_BARRNAP_REFERENCE: The 16S genes barrnap looks for, with no reference
+    barrnap finds nothing
+STUB_LOG: A file to add a line to for each call, with the tool, the start
+    and stop times and the bytes read and written
+"""
+import os
+import sys
+import math
+import time
+import json
+import random
+import shutil
+import numpy as np
+
+KMER = 16
+MAX_STRIDE = 64
+MIN_PIDENT = 80
+COMPLEMENT = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+# The bytes read and written by this call, for STUB_LOG
+IO_BYTES = {'read': 0, 'written': 0}
+
+
+def read_fasta(path:str) -> list:
+    """Read a fasta as a list of (name, sequence) with upper case bytes"""
+    records = []
+    header = None
+    parts = []
+    with open(path, 'rb') as in_file:
+        for line in in_file:
+            IO_BYTES['read'] += len(line)
+            line = line.strip()
+            if line.startswith(b'>'):
+                if header is not None:
+                    records.append((header, b''.join(parts)))
+                header = line[1:].decode().split()[0] if len(line) > 1 \
+                    else ''
+                parts = []
+            elif line:
+                parts.append(line.upper())
+    if header is not None:
+        records.append((header, b''.join(parts)))
+    return records
+
+
+def write_bytes(path:str, data:bytes):
+    IO_BYTES['written'] += len(data)
+    with open(path, 'wb') as out:
+        out.write(data)
+
+
+def copy_file(in_path:str, out_path:str):
+    shutil.copyfile(in_path, out_path)
+    IO_BYTES['read'] += os.path.getsize(in_path)
+    IO_BYTES['written'] += os.path.getsize(in_path)
+
+
+def fasta_bytes(records) -> bytes:
+    return b''.join(b'>' + name.encode() + b'\n' + seq + b'\n'
+                    for name, seq in records)
+
+
+def parse_args(args:list, flags:tuple=()) -> tuple:
+    """Split args into positionals and a dict of options with values"""
+    positional = []
+    options = {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith('-') and len(args[i]) > 1:
+            if args[i] in flags:
+                options[args[i]] = True
+                i += 1
+            else:
+                options[args[i]] = args[i + 1] if i + 1 < len(args) \
+                    else None
+                i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
+
+def index_queries(queries:list) -> dict:
+    """Index every k-mer of every query"""
+    index = {}
+    for qid, (_, seq) in enumerate(queries):
+        for pos in range(len(seq) - KMER + 1):
+            index.setdefault(seq[pos:pos + KMER], []).append((qid, pos))
+    return index
+
+
+def score(length:int, mismatch:int, qlen:int, db_size:int) -> tuple:
+    """Bit score and e-value with the blastn statistics for 1 and -2"""
+    bits = (1.28 * (length - 3 * mismatch) + 0.78) / math.log(2)
+    return bits, qlen * db_size * 2 ** -bits
+
+
+def align(queries:list, targets:list, reverse_on:str='query',
+          max_evalue:float=10, db_size:int=None) -> list:
+    """
+    Find one ungapped hit per query, target, strand and diagonal
+
+    reverse_on says which coordinates are flipped for minus strand hits,
+    'query' like mmseqs or 'subject' like blastn.
+    """
+    queries = [i for i in queries if len(i[1]) >= KMER]
+    if len(queries) == 0:
+        return []
+    index = index_queries(queries)
+    stride = max(1, min(MAX_STRIDE,
+                        min(len(i[1]) for i in queries) - KMER + 1))
+    if db_size is None:
+        db_size = sum(len(i[1]) for i in targets)
+    hits = []
+    for tname, tseq in targets:
+        for strand in ('+', '-'):
+            seq = tseq if strand == '+' else tseq.translate(COMPLEMENT)[::-1]
+            diagonals = set()
+            for pos in range(0, len(seq) - KMER + 1, stride):
+                for qid, qpos in index.get(seq[pos:pos + KMER], ()):
+                    diagonals.add((qid, pos - qpos))
+            for qid, diag in sorted(diagonals):
+                qname, qseq = queries[qid]
+                qs = max(0, -diag)
+                qe = min(len(qseq), len(seq) - diag)
+                query = np.frombuffer(qseq[qs:qe], dtype=np.uint8)
+                target = np.frombuffer(seq[qs + diag:qe + diag],
+                                       dtype=np.uint8)
+                length = qe - qs
+                mismatch = int((query != target).sum())
+                pident = round(100 * (length - mismatch) / length, 1)
+                # Random diagonals score far below zero, skip them before
+                # the e-value can overflow
+                if pident < MIN_PIDENT:
+                    continue
+                bits, evalue = score(length, mismatch, len(qseq), db_size)
+                if evalue > max_evalue:
+                    continue
+                ts, te = qs + diag, qe + diag
+                if strand == '+':
+                    coords = (qs + 1, qe, ts + 1, te)
+                elif reverse_on == 'query':
+                    coords = (qe, qs + 1, len(seq) - te + 1, len(seq) - ts)
+                else:
+                    coords = (qs + 1, qe, len(seq) - ts, len(seq) - te + 1)
+                hits.append((bits, qname, tname, pident, length, mismatch, 0)
+                            + coords + (f"{evalue:.3g}", int(bits),
+                                        len(qseq), len(tseq)))
+    return hits + decoy_hits(queries, targets)
+
+
+def decoy_hits(queries:list, targets:list) -> list:
+    """The extra weak hits asked for by STUB_DECOY_HITS"""
+    count = int(os.environ.get('STUB_DECOY_HITS', '0'))
+    if count == 0 or len(targets) == 0:
+        return []
+    hits = []
+    for qname, qseq in queries:
+        rng = random.Random(qname)
+        for _ in range(count):
+            tname, tseq = targets[rng.randrange(len(targets))]
+            length = min(len(qseq), len(tseq), 30)
+            start = rng.randrange(len(tseq) - length + 1) + 1
+            hits.append((0.0, qname, tname, 70.0, length, 9, 1, 1, length,
+                         start, start + length - 1, '1', 0, len(qseq),
+                         len(tseq)))
+    return hits
+
+
+def write_hits(hits:list, out_path:str, queries:list):
+    """Write hits grouped by query in query order, best bitscore first"""
+    order = {name: i for i, (name, _) in enumerate(queries)}
+    hits = sorted(hits, key=lambda h: (order[h[1]], -h[0], h[2]))
+    write_bytes(out_path, "".join("\t".join(str(i) for i in hit[1:]) + "\n"
+                                  for hit in hits).encode())
+
+
+def mmseqs(args:list):
+    module, args = args[0], args[1:]
+    positional, _ = parse_args(args)
+    if module == 'version':
+        print('stub-15.6f452')
+    elif module == 'createdb':
+        fasta, db = positional
+        copy_file(fasta, db)
+        write_bytes(db + '.dbtype', b'nucleotide')
+    elif module == 'createindex':
+        db, tmp = positional
+        os.makedirs(tmp, exist_ok=True)
+        copy_file(db, db + '.idx')
+    elif module == 'search':
+        query, target, result, tmp = positional
+        os.makedirs(tmp, exist_ok=True)
+        queries = read_fasta(query)
+        write_hits(align(queries, read_fasta(target), reverse_on='query',
+                         max_evalue=1e-3), result, queries)
+    elif module == 'convertalis':
+        query, target, result, out_tab = positional
+        copy_file(result, out_tab)
+    else:
+        sys.exit(f"mmseqs stub: unknown module {module}")
+
+
+def makeblastdb(args:list):
+    _, options = parse_args(args)
+    copy_file(options['-in'], options['-out'] + '.fa')
+
+
+def blastn(args:list):
+    _, options = parse_args(args)
+    queries = read_fasta(options['-query'])
+    db_size = int(options['-dbsize']) if '-dbsize' in options else None
+    write_hits(align(queries, read_fasta(options['-db'] + '.fa'),
+                     reverse_on='subject', max_evalue=1e-5, db_size=db_size),
+               options['-out'], queries)
+
+
+def barrnap(args:list):
+    positional, _ = parse_args(args, flags=('--quiet',))
+    lines = ["##gff-version 3\n"]
+    reference = os.environ.get('STUB_BARRNAP_REFERENCE')
+    hits = [] if reference is None else \
+        align(read_fasta(reference), read_fasta(positional[0]),
+              reverse_on='subject')
+    best = {}
+    for hit in hits:
+        if hit[4] >= 1000 and hit[0] > best.get(hit[2], (0,))[0]:
+            best[hit[2]] = hit
+    for tname, hit in best.items():
+        start, end = sorted((hit[9], hit[10]))
+        strand = '+' if hit[9] < hit[10] else '-'
+        lines.append(f"{tname}\tbarrnap:0.9\trRNA\t{start}\t{end}\t0\t"
+                     f"{strand}\t.\tName=16S_rRNA;product=16S ribosomal"
+                     " RNA\n")
+    data = "".join(lines).encode()
+    IO_BYTES['written'] += len(data)
+    sys.stdout.buffer.write(data)
+
+
+def write_fai(fasta:str, records:list):
+    write_bytes(fasta + '.fai', "".join(
+        f"{name}\t{len(seq)}\t0\t{len(seq)}\t{len(seq) + 1}\n"
+        for name, seq in records).encode())
+
+
+def bedtools(args:list):
+    if args[0] != 'getfasta':
+        sys.exit("bedtools stub: only getfasta is supported")
+    _, options = parse_args(args[1:])
+    records = read_fasta(options['-fi'])
+    write_fai(options['-fi'], records)
+    seqs = dict(records)
+    pieces = []
+    with open(options['-bed']) as bed:
+        for line in bed:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(fields) < 5:
+                continue
+            start, end = int(fields[3]) - 1, int(fields[4])
+            pieces.append((f"{fields[0]}:{start}-{end}",
+                           seqs[fields[0]][start:end]))
+    write_bytes(options['-fo'], fasta_bytes(pieces))
+
+
+def samtools(args:list):
+    if args[0] != 'faidx':
+        sys.exit("samtools stub: only faidx is supported")
+    fasta, regions = args[1], args[2:]
+    records = read_fasta(fasta)
+    write_fai(fasta, records)
+    seqs = dict(records)
+    data = fasta_bytes((i, seqs[i]) for i in regions)
+    IO_BYTES['written'] += len(data)
+    sys.stdout.buffer.write(data)
+
+
+TOOLS = {'mmseqs': mmseqs, 'makeblastdb': makeblastdb, 'blastn': blastn,
+         'barrnap': barrnap, 'bedtools': bedtools, 'samtools': samtools}
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    start = time.time()
+    time.sleep(float(os.environ.get('STUB_LATENCY', '0')))
+    TOOLS[tool](args)
+    log_path = os.environ.get('STUB_LOG')
+    if log_path is not None:
+        with open(log_path, 'a') as log:
+            log.write(json.dumps({
+                'tool': tool, 'module': args[0] if tool == 'mmseqs' else '',
+                'start': start, 'stop': time.time(),
+                'read_bytes': IO_BYTES['read'],
+                'written_bytes': IO_BYTES['written']}) + "\n")
+
+
+if __name__ == '__main__':
+    main()
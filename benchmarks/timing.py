@@ -0,0 +1,29 @@
+"""
+The timing and memory helpers shared by the benchmarks
+
+The benchmarks are run as scripts from the top of the repo, so this is
+imported as a plain module from the benchmarks folder.
+"""
+import time
+import tracemalloc
+
+
+def time_call(func, repeats:int) -> float:
+    """Best of several wall clock timings"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(func) -> float:
+    """The peak memory allocated by one call in MB, from tracemalloc"""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
@@ -6,6 +6,9 @@ import sys
 import argparse
 from contextlib import redirect_stdout
 from snakemake import snakemake
+from join_asvbins.incremental import get_settings_key, \
+    prepare_incremental_run, add_shared_bins, finish_incremental_run
+from join_asvbins.snake_functions import BINS_SCAFFOLD_MAP
 
 
 def get_package_path(local_path):
@@ -31,7 +34,17 @@ CONFIG_VALUES = {
     "verbosity": 2,
     "generic_16S": None,
     "qiime_out": False,
-    "candidate_16S_seqs": None
+    "candidate_16S_seqs": None,
+    "s2_chunksize": None,
+    "s1_window_flank": 0,
+    "ref_cache_dir": None,
+    "s1_shards": 1,
+    "max_memory": None,
+    "barrnap_core_share": None,
+    "scratch_dir": None,
+    "s2_exact_prepass": False,
+    "s1_kmer_screen": None,
+    "s2_adaptive_sensitivity": None
 }
 
 # TODO add a section to the readme on this, just this
@@ -83,7 +96,19 @@ def join_asvbins(bins:str=CONFIG_VALUES['asv_seqs'],
                  qiime_out=CONFIG_VALUES['qiime_out'],
                  print_rulegraph:bool=False,
                  threads:int=1,
-                 candidate_16S_seqs:str=CONFIG_VALUES["candidate_16S_seqs"]):
+                 candidate_16S_seqs:str=CONFIG_VALUES["candidate_16S_seqs"],
+                 s2_chunksize:int=CONFIG_VALUES["s2_chunksize"],
+                 s1_window_flank:int=CONFIG_VALUES["s1_window_flank"],
+                 ref_cache_dir:str=CONFIG_VALUES["ref_cache_dir"],
+                 s1_shards:int=CONFIG_VALUES["s1_shards"],
+                 max_memory:float=CONFIG_VALUES["max_memory"],
+                 barrnap_core_share:float=CONFIG_VALUES["barrnap_core_share"],
+                 scratch_dir:str=CONFIG_VALUES["scratch_dir"],
+                 s2_exact_prepass:bool=CONFIG_VALUES["s2_exact_prepass"],
+                 s1_kmer_screen:int=CONFIG_VALUES["s1_kmer_screen"],
+                 s2_adaptive_sensitivity:float=
+                     CONFIG_VALUES["s2_adaptive_sensitivity"],
+                 incremental:bool=False):
     """
     This is the main entry point of the package
     """
@@ -97,6 +122,24 @@ def join_asvbins(bins:str=CONFIG_VALUES['asv_seqs'],
         candidate_16S_seqs = os.path.abspath(candidate_16S_seqs)
     if asv_seqs is not None:
         asv_seqs = os.path.abspath(asv_seqs)
+    if ref_cache_dir is not None:
+        ref_cache_dir = os.path.abspath(ref_cache_dir)
+    if scratch_dir is not None:
+        scratch_dir = os.path.abspath(scratch_dir)
+        os.makedirs(scratch_dir, exist_ok=True)
+    if s2_adaptive_sensitivity is not None and not blast and \
+       s2_adaptive_sensitivity >= s2_mmseqs_sensitivity:
+        raise AttributeError(
+            "The adaptive stage 2 search needs a fast pass, so"
+            f" --s2_adaptive_sensitivity {s2_adaptive_sensitivity} must be"
+            f" lower than --s2_mmseqs_sensitivity {s2_mmseqs_sensitivity}.")
+    if s2_exact_prepass and (no_filter or not (
+            s2_min_pct_id >= 100 or (max_missmatch == 0 and max_gaps == 0))):
+        raise AttributeError(
+            "The exact stage 2 pre-pass does not search the ASVs it matches,"
+            " so it would drop their near matches. It can only be used when"
+            " the stage 2 filters remove near matches, with --s2_min_pct_id"
+            " 100 or with --max_missmatch 0 and --max_gaps 0.")
     if snake_rule is None:
         snake_rule = 'all'
     if len(snake_rule) < 0:
@@ -135,13 +178,56 @@ def join_asvbins(bins:str=CONFIG_VALUES['asv_seqs'],
                   quiet=quiet, verbose=snake_verbose,
                   printrulegraph=print_rulegraph, **snake_args)
         return
+    resources = {} if max_memory is None else \
+        {'mem_mb': int(max_memory * 1024)}
+    if incremental:
+        if bins is None or not os.path.isdir(bins) or \
+           candidate_16S_seqs is not None or qiime_out:
+            raise AttributeError("The incremental mode needs a directory of"
+                                 " bins, and can't be used with"
+                                 " --candidate_16S_seqs or --qiime_out.")
+        os.makedirs(output_dir, exist_ok=True)
+        run = prepare_incremental_run(bins, output_dir, fasta_extention,
+                                      get_settings_key(config))
+        config['bins'] = run['bins_dir']
+        # The bins are combined first, the scaffold map shows which
+        # unchanged bins share scaffolds with them and must be run too
+        while len(run['new_bins']) > 0:
+            if not snakemake(get_package_path('Snakefile'),
+                             targets=[BINS_SCAFFOLD_MAP],
+                             workdir=run['run_dir'], quiet=quiet,
+                             verbose=snake_verbose, config=config,
+                             cores=threads, notemp=True, forceall=True,
+                             **snake_args):
+                raise ValueError("The new bins could not be combined, the"
+                                 f" outputs in {output_dir} were not"
+                                 " changed.")
+            if not add_shared_bins(run):
+                break
+        # New bins with no 16S are common, they give empty outputs so the
+        # removed bins are still dropped and the manifest moves on
+        config['allow_no_hits'] = True
+        if len(run['new_bins']) > 0 and not snakemake(
+                get_package_path('Snakefile'), targets=[snake_rule],
+                workdir=run['run_dir'], quiet=quiet, verbose=snake_verbose,
+                config=config, cores=threads, use_conda=True,
+                notemp=keep_temp, resources=resources, **snake_args):
+            raise ValueError("The pipeline failed on the new bins, the"
+                             f" outputs in {output_dir} were not changed.")
+        # The merged statistics are ordered by the queries, as in a full run
+        finish_incremental_run(
+            run, output_dir, keep_temp, generic_16S,
+            None if asv_seqs is None or asv_seqs.endswith('.qza')
+            else asv_seqs)
+        return
     if os.path.exists(output_dir) and not no_clean:
         snakemake(get_package_path('Snakefile'), targets=[snake_rule],
                   workdir=output_dir, quiet=quiet, verbose=snake_verbose,
                   config=config, delete_all_output=True, **snake_args)
     snakemake(get_package_path('Snakefile'), targets=[snake_rule],
               workdir=output_dir, quiet=quiet, verbose=snake_verbose,
-              config=config, cores=threads, use_conda=True, notemp=keep_temp, **snake_args)
+              config=config, cores=threads, use_conda=True, notemp=keep_temp,
+              resources=resources, **snake_args)
 
 
 class ParseKwargs(argparse.Action):
@@ -250,6 +336,86 @@ def main():
                         " be ignored and the stage on fast and stats.tab"
                         " not be made. Note that your sequences must be"
                         " trimed, before you run this program.")
+    parser.add_argument("--s1_window_flank", type=int,
+                        default=CONFIG_VALUES['s1_window_flank'],
+                        help="In the stage 1 search, generic 16S against"
+                        " bins, only the region of each scaffold that the"
+                        " hits span, plus this many bases on each side, is"
+                        " pulled from the bins. Give a negative value to"
+                        " pull whole scaffolds instead.")
+    parser.add_argument("--s1_shards", type=int,
+                        default=CONFIG_VALUES['s1_shards'],
+                        help="Split the bins into this many shards of about"
+                        " the same size for barrnap and the stage 1 search,"
+                        " generic 16S against bins. Each shard is run as its"
+                        " own job, which bounds the memory of each job and"
+                        " lets them run in parallel, and the results are"
+                        " gathered back together. Each shard keeps its own"
+                        " best targets for each 16S, so if a 16S hits more"
+                        " scaffolds than the search keeps, the best by"
+                        " bitscore are kept and they may not be the ones one"
+                        " search would keep.")
+    parser.add_argument("--s1_kmer_screen", type=int,
+                        default=CONFIG_VALUES['s1_kmer_screen'],
+                        help="Before the stage 1 search, generic 16S against"
+                        " bins, keep only the scaffolds that have at least"
+                        " this many 14-mers from the generic 16S in some"
+                        " window of 200 bases, and search only those."
+                        " Barrnap still sees every scaffold. About 50 keeps"
+                        " the scaffolds with 16S genes and drops most"
+                        " others. By default every scaffold is searched.")
+    parser.add_argument("--max_memory", type=float,
+                        default=CONFIG_VALUES['max_memory'],
+                        help="The memory in gigabytes the program may use."
+                        " It is passed to MMseqs2 as --split-memory-limit,"
+                        " divided between the stage 1 shards, and"
+                        " snakemake will not run more MMseqs2 jobs at once"
+                        " than fit in it.")
+    parser.add_argument("--barrnap_core_share", type=float,
+                        default=CONFIG_VALUES['barrnap_core_share'],
+                        help="The fraction of the threads given to barrnap,"
+                        " the rest go to the stage 1 search so the two run"
+                        " at the same time. By default barrnap gets up to 4"
+                        " threads per shard and at most half of them.")
+    parser.add_argument("--scratch_dir", type=str,
+                        default=CONFIG_VALUES['scratch_dir'],
+                        help="A folder on fast local disk, or tmpfs, for the"
+                        " search databases and temporary files. Each search"
+                        " job makes its own folder in it and removes it when"
+                        " done. By default the system temporary folder is"
+                        " used.")
+    parser.add_argument("--ref_cache_dir", type=str,
+                        default=CONFIG_VALUES['ref_cache_dir'],
+                        help="A folder to keep the MMseqs2 database of the"
+                        " generic 16S, and the index of a bins file, in"
+                        " between runs. Each is made once for each file"
+                        " content, and MMseqs2 version for the database, and"
+                        " reused by later runs that give the same folder.")
+    parser.add_argument("--s2_chunksize", type=int,
+                        default=CONFIG_VALUES['s2_chunksize'],
+                        help="Stream the stage 2 statistics, the search"
+                        " matching ASVs against candidate 16S, this many rows"
+                        " at a time while filtering. Use this if the stage 2"
+                        " hits do not fit in memory.")
+    parser.add_argument("--s2_adaptive_sensitivity", type=float,
+                        default=CONFIG_VALUES['s2_adaptive_sensitivity'],
+                        help="Run the stage 2 MMseqs2 search, matching ASVs"
+                        " against candidate 16S, in two passes. The first"
+                        " pass uses this lower sensitivity, then only the"
+                        " ASVs with no hit that passes the filters are"
+                        " searched again at --s2_mmseqs_sensitivity, and"
+                        " the hits of both passes are merged. It must be"
+                        " lower than --s2_mmseqs_sensitivity. Has no effect"
+                        " with --blast.")
+    parser.add_argument("--s2_exact_prepass", action='store_true',
+                        help="Before the stage 2 search, matching ASVs"
+                        " against candidate 16S, find the ASVs that are"
+                        " exact substrings of a candidate without a search."
+                        " Only the other ASVs are searched, so it needs"
+                        " filters that remove near matches, --s2_min_pct_id"
+                        " 100 or --max_missmatch 0 and --max_gaps 0. The"
+                        " exact matches are scored as blastn would score"
+                        " them and have 'Exact' as their search_tool.")
     parser.add_argument("--fasta_extention", type=str, default='fa',
                         help="The extention of fasta files when providing a"
                         " directory of bins. as long as your files are in "
@@ -263,6 +429,20 @@ def main():
                         " cleaned of results of pass runs. If your run is"
                         " interrupted this will allow you to to pickup."
                         " where you left off. Use at your own risk.")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Only run the bins that are new or changed"
+                        " since the last incremental run in the output"
+                        " directory, and merge the results with the old"
+                        " outputs. Results of removed bins are dropped. The"
+                        " e-values of the new hits are scaled to the size of"
+                        " all the bins and candidates and the old hits keep"
+                        " theirs, so e-values are close to but not the same"
+                        " as a full run, and hits are not removed if that"
+                        " moves them past the e-value cut off. A"
+                        " manifest of the bins is kept in the output"
+                        " directory. If the settings, ASVs or generic 16S"
+                        " change every bin is run again. Needs a directory"
+                        " of bins.")
     parser.add_argument("--no_filter", action='store_true',
                         help="Nuclier option to remove all filters. from"
                         " the analisis.")
@@ -0,0 +1,398 @@
+"""Run the pipeline only on the bins that changed since the last run"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import pandas as pd
+from join_asvbins.utils import read_fasta, write_fasta, hash_file
+from join_asvbins.snake_functions import CANDIDATE_16S_SEQS_PATH, \
+    BINS_SCAFFOLD_MAP, RUN_REPORT_TSV, RUN_REPORT_JSON
+
+MANIFEST_PATH = 'incremental_manifest.json'
+INCREMENTAL_RUN_DIR = 'incremental_run'
+# Config values that don't change the outputs
+NON_OUTPUT_SETTINGS = ('bins', 'output_dir', 'verbosity', 'ref_cache_dir',
+                       's2_chunksize', 'scratch_dir', 'max_memory',
+                       'barrnap_core_share')
+CANDIDATE_STATS_PATH = 'candidate_statistics.tsv'
+MATCH_SEQS_PATH = 'match_sequences.fna'
+MATCH_STATS_PATH = 'match_statistics.tsv'
+
+
+def list_bins(bins_dir:str, fasta_extention:str) -> dict:
+    """
+    Find the bin files the same way the pipeline does
+
+    :param bins_dir: The folder of bins
+    :param fasta_extention: The extension of the bin files
+    :returns: A dict of bin file names to paths
+    """
+    paths = glob.glob(os.path.join(bins_dir, f"*.{fasta_extention}"))
+    return {os.path.basename(i): i for i in sorted(paths)}
+
+
+def get_settings_key(config:dict) -> str:
+    """
+    Make a key for everything besides the bins that changes the outputs
+
+    :param config: The snakemake config of the run
+    :returns: A hex digest of the settings and the ASV and generic 16S content
+    """
+    settings = {i: j for i, j in config.items()
+                if i not in NON_OUTPUT_SETTINGS}
+    digest = hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode())
+    for path in (config.get('asv_seqs'), config.get('generic_16S')):
+        if path is not None:
+            hash_file(path, digest)
+    return digest.hexdigest()
+
+
+def read_manifest(output_dir:str) -> dict:
+    """
+    Read the manifest of the last incremental run
+
+    :param output_dir: The output folder of the runs
+    :returns: The manifest, or None if there is none
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_PATH)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as in_file:
+        return json.load(in_file)
+
+
+def shared_scaffold_bins(bins:dict, changed:list, touched:set) -> list:
+    """
+    Find the unchanged bins that share a scaffold name with the run
+
+    The results of a scaffold name found in more than one bin can't be
+    split between them, so all the bins with it are run again. touched is
+    updated with the scaffolds of the bins found, and so of the bins they
+    share with in turn.
+
+    :param bins: The bins in the manifest, with their scaffolds
+    :param changed: The bins in the run
+    :param touched: The scaffolds of the bins in the run, and dropped ones
+    :returns: The bins to add to the run
+    """
+    added = []
+    shared = [i for i in bins if i not in changed and
+              not touched.isdisjoint(bins[i]['scaffolds'])]
+    while len(shared) > 0:
+        added.extend(shared)
+        for i in shared:
+            touched.update(bins[i]['scaffolds'])
+        shared = [i for i in bins if i not in changed and i not in added and
+                  not touched.isdisjoint(bins[i]['scaffolds'])]
+    return added
+
+
+def prepare_incremental_run(bins_dir:str, output_dir:str,
+                            fasta_extention:str, settings_key:str) -> dict:
+    """
+    Compare the bins to the manifest and link the new and changed bins
+
+    Bins are compared by the sha256 of their content. If there is no manifest
+    or the settings changed every bin is treated as new, and the old outputs
+    are replaced. The scaffolds of the new bins and their sizes are only
+    known after the run, from its scaffold map, see add_shared_bins.
+
+    :param bins_dir: The folder of bins
+    :param output_dir: The output folder of the runs
+    :param fasta_extention: The extension of the bin files
+    :param settings_key: The key from get_settings_key
+    :returns: A dict describing the run, for finish_incremental_run
+    """
+    bins = list_bins(bins_dir, fasta_extention)
+    checksums = {i: hash_file(j).hexdigest() for i, j in bins.items()}
+    manifest = read_manifest(output_dir)
+    if manifest is None:
+        print("No incremental manifest was found, all bins will be run.")
+        old_bins = {}
+    elif manifest['settings'] != settings_key:
+        print("The settings, ASVs or generic 16S changed since the last"
+              " incremental run, all bins will be run.")
+        old_bins = {}
+    else:
+        old_bins = manifest['bins']
+    changed = [i for i in bins
+               if old_bins.get(i, {}).get('sha256') != checksums[i]]
+    dropped = [i for i in old_bins if i not in bins or i in changed]
+    dropped_scaffolds = {j for i in dropped for j in old_bins[i]['scaffolds']}
+    unchanged = {i: old_bins[i] for i in bins if i not in changed}
+    changed.extend(shared_scaffold_bins(unchanged, changed,
+                                        dropped_scaffolds))
+    run_dir = os.path.join(output_dir, INCREMENTAL_RUN_DIR)
+    run_bins_dir = os.path.join(run_dir, 'bins')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_bins_dir)
+    for i in changed:
+        os.symlink(os.path.abspath(bins[i]), os.path.join(run_bins_dir, i))
+    print(f"Incremental run: {len(changed)} new, changed or linked bins,"
+          f" {len([i for i in old_bins if i not in bins])} removed bins,"
+          f" {len(bins) - len(changed)} unchanged bins.")
+    return {
+        'run_dir': run_dir,
+        'bins_dir': run_bins_dir,
+        'source_bins': {i: os.path.abspath(j) for i, j in bins.items()},
+        'settings': settings_key,
+        'keep_old': len(old_bins) > 0,
+        'bins': {i: old_bins[i] for i in bins if i not in changed},
+        'new_bins': {i: {'sha256': checksums[i], 'scaffolds': [],
+                         'bases': 0} for i in changed},
+        'dropped_scaffolds': dropped_scaffolds,
+    }
+
+
+def add_shared_bins(run:dict) -> bool:
+    """
+    Read the scaffolds of the run and link the bins that share them
+
+    The scaffolds of each new bin and its size are taken from the scaffold
+    map the run made while combining the bins. Unchanged bins with one of those names
+    are moved into the run, and the bins have to be combined again.
+
+    :param run: The dict from prepare_incremental_run, it is updated
+    :returns: True if bins were added and must be combined again
+    """
+    scaffold_map = pd.read_csv(os.path.join(run['run_dir'], BINS_SCAFFOLD_MAP),
+                               sep='\t', dtype={'header': str, 'bin': str},
+                               keep_default_na=False)
+    for name, scaffolds in scaffold_map.groupby('bin', sort=False):
+        run['new_bins'][name]['scaffolds'] = list(scaffolds['header'])
+        run['new_bins'][name]['bases'] = int(scaffolds['length'].sum())
+    touched = set(scaffold_map['header']).union(run['dropped_scaffolds'])
+    added = shared_scaffold_bins(run['bins'], list(run['new_bins']), touched)
+    for i in added:
+        old = run['bins'].pop(i)
+        run['dropped_scaffolds'].update(old['scaffolds'])
+        run['new_bins'][i] = {'sha256': old['sha256'], 'scaffolds': [],
+                              'bases': 0}
+        os.symlink(run['source_bins'][i], os.path.join(run['bins_dir'], i))
+    if len(added) > 0:
+        print(f"Incremental run: {len(added)} unchanged bins share scaffold"
+              " names with the new bins, they are added to the run.")
+    return len(added) > 0
+
+
+def fasta_bases(path:str) -> int:
+    """The number of bases in a fasta, 0 if there is none"""
+    if not os.path.exists(path):
+        return 0
+    return sum(len(i[2]) for i in read_fasta(path))
+
+
+def rescale_stats_evalues(stats:pd.DataFrame, factor:float) -> pd.DataFrame:
+    """
+    Scale the e-values of statistics to a new size of the searched target
+
+    Rows with no e-value, like the barrnap rows, and e-values of 0 are left
+    as they are, the scaled e-values are written as pandas writes floats.
+
+    :param stats: The statistics read as strings
+    :param factor: The new size of the target over the size searched
+    :returns: The statistics with the e-values scaled
+    """
+    if factor == 1 or len(stats) == 0:
+        return stats
+    evalue = pd.to_numeric(stats['evalue'], errors='coerce')
+    scaled = evalue.notna() & (evalue != 0)
+    stats = stats.copy()
+    stats.loc[scaled, 'evalue'] = [repr(float(i)) for i in
+                                   evalue[scaled] * factor]
+    return stats
+
+
+def query_order(headers:pd.Series, query_fasta_path:str=None):
+    """
+    Number the queries of statistics in the order of the query fasta
+
+    :param headers: The query headers of the statistics
+    :param query_fasta_path: The query fasta, if None the queries are
+        numbered in the order they first appear
+    :returns: An array with the number of the query of each row
+    """
+    if query_fasta_path is None:
+        return pd.factorize(headers)[0]
+    order = {j[0]: i for i, j in enumerate(read_fasta(query_fasta_path))}
+    return headers.map(order).to_numpy()
+
+
+def order_candidate_stats(stats:pd.DataFrame,
+                          query_fasta_path:str=None) -> pd.DataFrame:
+    """
+    Order merged candidate statistics the way a full run orders them
+
+    The search tool hits are first, best bitscore first and then by query
+    and locus, and the barrnap rows follow by their e-value and name.
+
+    :param stats: The candidate statistics read as strings
+    :param query_fasta_path: The generic 16S the bins were searched with
+    :returns: The ordered statistics
+    """
+    def column(name, numeric=True):
+        values = stats[name] if name in stats else \
+            pd.Series('NA', index=stats.index)
+        if numeric:
+            values = pd.to_numeric(values, errors='coerce')
+        return values.to_numpy()
+
+    keys = pd.DataFrame({
+        'barrnap': pd.isna(column('bitscore')),
+        'bitscore': -column('bitscore'),
+        'query_order': query_order(
+            pd.Series(column('16S_header', False)), query_fasta_path),
+        'barrnap_evalue': column('barrnap_e-value'),
+        'name': column('name', False),
+        'scaffold': column('bin_scaffold_header', False)})
+    for i in ['bin_scaffold_start', 'bin_scaffold_end', '16S_start',
+              '16S_end']:
+        keys[i] = column(i)
+    order = keys.sort_values(list(keys.columns), kind='stable').index
+    return stats.iloc[order]
+
+
+def order_match_stats(stats:pd.DataFrame,
+                      query_fasta_path:str=None) -> pd.DataFrame:
+    """
+    Order merged match statistics the way a full run orders them
+
+    :param stats: The match statistics read as strings
+    :param query_fasta_path: The ASVs that were searched
+    :returns: The statistics by ASV, best bitscore first
+    """
+    keys = pd.DataFrame({
+        'query_order': query_order(stats['ASV_header'], query_fasta_path),
+        'bitscore': -pd.to_numeric(stats['bitscore'],
+                                   errors='coerce').to_numpy()})
+    order = keys.sort_values(list(keys.columns), kind='stable').index
+    return stats.iloc[order]
+
+
+def read_stats_text(path:str) -> pd.DataFrame:
+    """
+    Read a statistics output as text, so the values are written back as is
+
+    :param path: The path to the statistics
+    :returns: The statistics, or None if the file is empty
+    """
+    if os.path.getsize(path) == 0:
+        return None
+    return pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+
+
+def merge_outputs(old_dir:str, new_dir:str, fasta_name:str,
+                  stats_name:str, dropped_scaffolds:set, keep_old:bool,
+                  evalue_factor:float=1, order_stats=None):
+    """
+    Merge the outputs of the new bins into the old outputs
+
+    The statistics are merged as text so the old rows are not changed, only
+    the e-values of the new rows are scaled by evalue_factor to the size of
+    the target that a full run would search. The sequences are ordered by
+    header and the statistics by order_stats, as a full run orders them.
+
+    :param old_dir: The folder with the old outputs, they are replaced
+    :param new_dir: The folder with the outputs for the new bins
+    :param fasta_name: The name of the fasta output
+    :param stats_name: The name of the statistics output
+    :param dropped_scaffolds: Scaffolds to remove from the old outputs
+    :param keep_old: If false the old outputs are not merged
+    :param evalue_factor: The factor to scale the new e-values by
+    :param order_stats: Optional, a function that orders the merged
+        statistics
+    """
+    old_fasta = os.path.join(old_dir, fasta_name)
+    old_stats = os.path.join(old_dir, stats_name)
+    new_fasta = os.path.join(new_dir, fasta_name)
+    new_stats = os.path.join(new_dir, stats_name)
+    keep_old = keep_old and os.path.exists(old_fasta)
+    if not keep_old and not os.path.exists(new_fasta):
+        # Outputs made with other settings are out of date
+        for path in (old_fasta, old_stats):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    records = []
+    stats = []
+    if keep_old:
+        records.extend(i for i in read_fasta(old_fasta)
+                       if i[0] not in dropped_scaffolds)
+        data = read_stats_text(old_stats)
+        if data is not None:
+            stats.append(
+                data[~data['bin_scaffold_header'].isin(dropped_scaffolds)])
+    if os.path.exists(new_fasta):
+        # New bins with no 16S leave empty outputs
+        records.extend(read_fasta(new_fasta))
+        data = read_stats_text(new_stats)
+        if data is not None:
+            stats.append(rescale_stats_evalues(data, evalue_factor))
+    write_fasta(sorted(records, key=lambda i: i[0]), f"{old_fasta}.tmp")
+    if len(stats) > 0:
+        stats = pd.concat(stats, ignore_index=True)
+        if order_stats is not None:
+            stats = order_stats(stats)
+        stats.to_csv(f"{old_stats}.tmp", sep='\t', index=False,
+                     na_rep='NA')
+    else:
+        open(f"{old_stats}.tmp", 'w').close()
+    os.replace(f"{old_fasta}.tmp", old_fasta)
+    os.replace(f"{old_stats}.tmp", old_stats)
+
+
+def finish_incremental_run(run:dict, output_dir:str, keep_temp:bool=False,
+                           generic_16s_path:str=None,
+                           asv_seqs_path:str=None):
+    """
+    Merge the outputs of an incremental run and write the new manifest
+
+    E-values grow with the size of the searched target, the bins for the
+    candidates and the candidates for the matches. The new rows are scaled
+    from the size of the new bins and candidates to the size of all of
+    them, and the old rows keep the e-values of the run that found them, so
+    the e-values are close to those of a full run but not the same. Hits
+    are not removed if the scaled e-value passes the cut off of the search.
+    The run report of the new bins replaces the last one.
+
+    :param run: The dict from prepare_incremental_run
+    :param output_dir: The output folder of the runs
+    :param keep_temp: If true the folder of the incremental run is kept
+    :param generic_16s_path: Optional, the generic 16S, to order the
+        candidate statistics by
+    :param asv_seqs_path: Optional, the ASV fasta, to order the match
+        statistics by
+    """
+    bins = dict(run['bins'], **run['new_bins'])
+    if all('bases' in i for i in bins.values()):
+        candidate_factor = sum(i['bases'] for i in bins.values()) / \
+            max(sum(i['bases'] for i in run['new_bins'].values()), 1)
+    else:
+        # Manifests from before the sizes were kept
+        candidate_factor = 1
+    new_candidate_bases = fasta_bases(
+        os.path.join(run['run_dir'], CANDIDATE_16S_SEQS_PATH))
+    merge_outputs(output_dir, run['run_dir'], CANDIDATE_16S_SEQS_PATH,
+                  CANDIDATE_STATS_PATH, run['dropped_scaffolds'],
+                  run['keep_old'], candidate_factor,
+                  lambda i: order_candidate_stats(i, generic_16s_path))
+    all_candidate_bases = fasta_bases(
+        os.path.join(output_dir, CANDIDATE_16S_SEQS_PATH))
+    merge_outputs(output_dir, run['run_dir'], MATCH_SEQS_PATH,
+                  MATCH_STATS_PATH, run['dropped_scaffolds'],
+                  run['keep_old'],
+                  all_candidate_bases / max(new_candidate_bases, 1),
+                  lambda i: order_match_stats(i, asv_seqs_path))
+    manifest_path = os.path.join(output_dir, MANIFEST_PATH)
+    with open(f"{manifest_path}.tmp", 'w') as out_file:
+        json.dump({'settings': run['settings'], 'bins': bins}, out_file)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    for report_name in (RUN_REPORT_TSV, RUN_REPORT_JSON):
+        report_path = os.path.join(run['run_dir'], report_name)
+        if os.path.exists(report_path):
+            shutil.copyfile(report_path,
+                            os.path.join(output_dir, report_name))
+    if not keep_temp:
+        shutil.rmtree(run['run_dir'])
@@ -0,0 +1,318 @@
+"""A compact pandas column type for many DNA sequences"""
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import (
+    ExtensionArray, ExtensionDtype, register_extension_dtype, take)
+from pandas.api.indexers import check_array_indexer
+
+# A byte lookup table from each base to its complement, U pairs with A
+_COMPLEMENT_CODES = np.frombuffer(bytes.maketrans(b'ACGTUNacgtun',
+                                                  b'TGCAANtgcaan'),
+                                  dtype=np.uint8)
+
+
+def seq_to_bytes(seq) -> bytes:
+    """
+    Convert one sequence to bytes
+
+    :param seq: Bytes, a string, or an array or list of characters
+    :returns: The sequence as bytes
+    """
+    if isinstance(seq, bytes):
+        return seq
+    if isinstance(seq, str):
+        return seq.encode()
+    if isinstance(seq, np.ndarray) and seq.dtype.kind in 'Su' \
+       and seq.dtype.itemsize == 1:
+        return seq.tobytes()
+    return ''.join(i.decode() if isinstance(i, bytes) else str(i)
+                   for i in seq).encode()
+
+
+def _ranges_index(starts:np.ndarray, stops:np.ndarray) -> np.ndarray:
+    """
+    The positions covered by a list of ranges, joined end to end
+
+    :param starts: The start of each range
+    :param stops: The end of each range, end exclusive
+    :returns: An array of positions
+    """
+    lengths = stops - starts
+    ends = np.cumsum(lengths)
+    total = ends[-1] if len(ends) > 0 else 0
+    return np.repeat(starts - (ends - lengths), lengths) + \
+        np.arange(total, dtype=np.int64)
+
+
+@register_extension_dtype
+class SeqDtype(ExtensionDtype):
+    """The dtype of a SeqArray, the scalar type is an array of S1"""
+    name = 'seq'
+    type = np.ndarray
+    kind = 'O'
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return SeqArray
+
+
+class SeqArray(ExtensionArray):
+    """
+    Sequences stored in one contiguous uint8 buffer
+
+    Each sequence is a start and stop into the buffer, so taking, sorting,
+    merging and trimming rows only moves two integers per row, and the
+    buffer is shared until it needs to be rewritten. Missing values have a
+    start of -1. Single items are returned as arrays of dtype S1, the same
+    as the arrays fasta_to_df used to put in each row.
+
+    :param buffer: A uint8 array with the sequence bytes
+    :param starts: The start of each sequence in the buffer
+    :param stops: The end of each sequence in the buffer, end exclusive
+    """
+
+    def __init__(self, buffer:np.ndarray, starts:np.ndarray,
+                 stops:np.ndarray):
+        self._buffer = buffer
+        self._starts = np.asarray(starts, dtype=np.int64)
+        self._stops = np.asarray(stops, dtype=np.int64)
+
+    @classmethod
+    def from_bytes(cls, seqs) -> 'SeqArray':
+        """
+        Pack byte strings, None marks a missing value
+
+        :param seqs: A list of bytes or None
+        :returns: A SeqArray
+        """
+        lengths = np.array([0 if i is None else len(i) for i in seqs],
+                           dtype=np.int64)
+        stops = np.cumsum(lengths)
+        starts = stops - lengths
+        missing = np.array([i is None for i in seqs], dtype=bool)
+        buffer = np.frombuffer(b''.join(i for i in seqs if i is not None),
+                               dtype=np.uint8)
+        return cls(buffer, np.where(missing, -1, starts),
+                   np.where(missing, -1, stops))
+
+    @classmethod
+    def _from_sequence(cls, scalars, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+        return cls.from_bytes([None if _is_missing(i) else seq_to_bytes(i)
+                               for i in scalars])
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls.from_bytes(list(values))
+
+    def _values_for_factorize(self):
+        return np.array(list(self.iter_bytes()), dtype=object), None
+
+    @property
+    def dtype(self) -> SeqDtype:
+        return SeqDtype()
+
+    @property
+    def nbytes(self) -> int:
+        return self._buffer.nbytes + self._starts.nbytes + self._stops.nbytes
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            start, stop = self._starts[item], self._stops[item]
+            if start < 0:
+                return self.dtype.na_value
+            return self._buffer[start:stop].view('S1')
+        item = check_array_indexer(self, item)
+        return type(self)(self._buffer, self._starts[item],
+                          self._stops[item])
+
+    def __array__(self, dtype=None):
+        # Fill an object array item by item, numpy would stack sequences
+        # of the same length into a 2D array
+        out = np.empty(len(self), dtype=object)
+        for i in range(len(self)):
+            out[i] = self[i]
+        return out if dtype is None else out.astype(dtype)
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if not isinstance(other, SeqArray):
+            other = type(self).from_bytes([seq_to_bytes(other)]).take(
+                np.zeros(len(self), dtype=np.int64))
+        return np.array([i is not None and i == j for i, j in
+                         zip(self.iter_bytes(), other.iter_bytes())],
+                        dtype=bool)
+
+    def isna(self) -> np.ndarray:
+        return self._starts < 0
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        if allow_fill and not _is_missing(fill_value):
+            raise ValueError("A SeqArray can only be filled with missing"
+                             " values.")
+        starts = take(self._starts, indices, allow_fill=allow_fill,
+                      fill_value=-1)
+        stops = take(self._stops, indices, allow_fill=allow_fill,
+                     fill_value=-1)
+        return type(self)(self._buffer, starts, stops)
+
+    def copy(self) -> 'SeqArray':
+        """Copy only the sequences in use into a new compact buffer"""
+        keep = ~self.isna()
+        lengths = np.where(keep, self._stops - self._starts, 0)
+        stops = np.cumsum(lengths)
+        buffer = self._buffer[_ranges_index(self._starts[keep],
+                                            self._stops[keep])]
+        return type(self)(buffer, np.where(keep, stops - lengths, -1),
+                          np.where(keep, stops, -1))
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat = [i for i in to_concat if len(i) > 0] or list(to_concat)
+        shift = np.cumsum([0] + [len(i._buffer) for i in to_concat[:-1]])
+        starts = np.concatenate([np.where(i.isna(), -1, i._starts + s)
+                                 for i, s in zip(to_concat, shift)])
+        stops = np.concatenate([np.where(i.isna(), -1, i._stops + s)
+                                for i, s in zip(to_concat, shift)])
+        buffer = np.concatenate([i._buffer for i in to_concat])
+        return cls(buffer, starts, stops)
+
+    def _formatter(self, boxed=False):
+        def format_seq(seq):
+            if _is_missing(seq):
+                return 'NaN'
+            text = seq.tobytes().decode()
+            return text if len(text) <= 20 else f"{text[:17]}..."
+        return format_seq
+
+    def iter_bytes(self):
+        """
+        Each sequence as bytes
+
+        :returns: A generator of bytes, or None for missing values
+        """
+        buffer = self._buffer
+        for start, stop in zip(self._starts, self._stops):
+            yield None if start < 0 else buffer[start:stop].tobytes()
+
+    def lengths(self) -> np.ndarray:
+        """The length of each sequence, 0 if missing"""
+        return np.where(self.isna(), 0, self._stops - self._starts)
+
+    def subseq(self, starts, stops) -> 'SeqArray':
+        """
+        Cut a piece out of each sequence, without copying
+
+        :param starts: The 0-based start in each sequence
+        :param stops: The end in each sequence, end exclusive
+        :returns: A SeqArray of the pieces, clipped to the sequences
+        """
+        lengths = self.lengths()
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, lengths)
+        stops = np.clip(np.asarray(stops, dtype=np.int64), starts, lengths)
+        missing = self.isna()
+        return type(self)(self._buffer,
+                          np.where(missing, -1, self._starts + starts),
+                          np.where(missing, -1, self._starts + stops))
+
+    def reverse(self, where=None) -> 'SeqArray':
+        """
+        Reverse the sequences, into a new compact buffer
+
+        :param where: Optional, a boolean array of which sequences to reverse
+        :returns: A SeqArray
+        """
+        if where is None:
+            where = np.ones(len(self), dtype=bool)
+        keep = ~self.isna()
+        starts, stops = self._starts[keep], self._stops[keep]
+        flip = np.asarray(where, dtype=bool)[keep]
+        positions = _ranges_index(starts, stops)
+        lengths = stops - starts
+        new_starts = np.cumsum(lengths) - lengths
+        # Mirror each position of a flipped sequence inside its own range
+        offset = positions - np.repeat(starts, lengths)
+        mirrored = np.repeat(stops - 1, lengths) - offset
+        buffer = self._buffer[np.where(np.repeat(flip, lengths), mirrored,
+                                       positions)]
+        out_starts = np.full(len(self), -1, dtype=np.int64)
+        out_stops = np.full(len(self), -1, dtype=np.int64)
+        out_starts[keep] = new_starts
+        out_stops[keep] = new_starts + lengths
+        return type(self)(buffer, out_starts, out_stops)
+
+    def reverse_complement(self, where=None) -> 'SeqArray':
+        """
+        Reverse complement the sequences, into a new compact buffer
+
+        :param where: Optional, a boolean array of which sequences to flip
+        :returns: A SeqArray
+        """
+        if where is None:
+            where = np.ones(len(self), dtype=bool)
+        flipped = self.reverse(where)
+        keep = ~self.isna()
+        lengths = flipped.lengths()[keep]
+        complement = np.repeat(np.asarray(where, dtype=bool)[keep], lengths)
+        buffer = flipped._buffer.copy()
+        buffer[complement] = _COMPLEMENT_CODES[buffer[complement]]
+        return type(self)(buffer, flipped._starts, flipped._stops)
+
+    def join_runs(self, groups) -> 'SeqArray':
+        """
+        Join runs of sequences end to end, into a new compact buffer
+
+        :param groups: A label for each sequence, sequences to join must
+            have the same label and be next to each other
+        :returns: A SeqArray with one sequence per run, missing values are
+            joined as empty sequences
+        """
+        groups = np.asarray(groups)
+        if len(groups) == 0:
+            return type(self).from_bytes([])
+        keep = ~self.isna()
+        run_ids = np.cumsum(np.r_[True, groups[1:] != groups[:-1]]) - 1
+        run_lengths = np.bincount(run_ids, weights=self.lengths()).astype(
+            np.int64)
+        stops = np.cumsum(run_lengths)
+        buffer = self._buffer[_ranges_index(self._starts[keep],
+                                            self._stops[keep])]
+        return type(self)(buffer, stops - run_lengths, stops)
+
+    def where(self, cond, other:'SeqArray') -> 'SeqArray':
+        """
+        Pick each sequence from this array or another
+
+        :param cond: A boolean array, True picks from this array
+        :param other: A SeqArray of the same length
+        :returns: A SeqArray sharing the buffers of both
+        """
+        joined = type(self)._concat_same_type([self, other])
+        cond = np.asarray(cond, dtype=bool)
+        index = np.where(cond, np.arange(len(self)),
+                         np.arange(len(self)) + len(self))
+        return joined.take(index)
+
+
+def _is_missing(value) -> bool:
+    return value is None or (np.ndim(value) == 0 and pd.isna(value))
+
+
+def as_seq_array(values) -> SeqArray:
+    """
+    Get the sequences of a column as a SeqArray
+
+    :param values: A Series, SeqArray or list of sequences
+    :returns: A SeqArray
+    """
+    if isinstance(values, pd.Series):
+        values = values.array
+    if isinstance(values, SeqArray):
+        return values
+    return SeqArray._from_sequence(values)
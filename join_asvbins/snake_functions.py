@@ -1,43 +1,132 @@
 """These functions are used directly by the snakemake pipline"""
 import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from join_asvbins.utils import (
     df_to_fasta, fasta_to_df, read_mbstats, 
     filter_mdstats, mbstats_reformat,  
     process_barfasta, barstats_reformat, 
     combine_fasta, filter_fasta_from_headers, 
-    read_gff, get_stage1_mbstats_fasta)
+    read_gff, get_stage1_mbstats_fasta, load_fasta_index,
+    fetch_fasta_records, fetch_fasta_windows, write_fasta, hash_file,
+    split_fasta_by_size, read_fasta, find_exact_hits, build_kmer_table,
+    screen_fasta_by_kmers, concat_fasta_files, build_fasta_index,
+    MBSTATS_NAMES)
 
 CANDIDATE_16S_SEQS_PATH = 'candidate_sequences.fna'
+# The bin file of each scaffold, made when a folder of bins is combined
+BINS_SCAFFOLD_MAP = 'bins_scaffolds.tsv'
+# The benchmark of each job goes in a folder per rule, they are summed up in
+# the report at the end of each run
+RUN_REPORT_DIR = 'run_report'
+RUN_REPORT_TSV = 'run_report.tsv'
+RUN_REPORT_JSON = 'run_report.json'
+# Changing this makes runs rebuild the cached indexes of bins files
+FASTA_INDEX_VERSION = 'fasta_index_1'
+# The default e-value cut off of mmseqs search and blastn
+MMSEQS_MAX_EVALUE = 1e-3
+BLAST_MAX_EVALUE = 10
+# The default number of targets kept for each query, --max-seqs of mmseqs
+# search and -max_target_seqs of blastn
+MMSEQS_MAX_SEQS = 300
+BLAST_MAX_TARGET_SEQS = 500
+# barrnap gains little from more threads than this
+BARRNAP_MAX_THREADS = 4
+# The blastn statistics, for reward 1 and penalty -2, used to score exact
+# matches found without a search
+EXACT_MATCH_LAMBDA = 1.28
+EXACT_MATCH_K = 0.46
+# The search_tool of the stage 2 rows from the exact pre-pass, their scores
+# are on the blastn scale whichever tool searched the rest
+EXACT_SEARCH_TOOL = 'Exact'
+BLAST_OUTFMT = "6 qseqid sseqid pident length mismatch gapopen qstart qend" \
+    " sstart send evalue bitscore qlen slen"
 
 
-def resolve_dup_gene_locs(mbstats:str, bs_name:str, bs_start:str,
-                          bs_end:str, values:str, ascending:bool):
-    gene_locs = {}
-    def check_overlap(line:pd.Series):
-        line_name = line[bs_name]
-        line_start = min(line[bs_start], line[bs_end])
-        line_end = max(line[bs_start], line[bs_end])
-        if line_name in gene_locs:
-            match_start = gene_locs[line_name]['start']
-            match_end = gene_locs[line_name]['end']
-            if match_start <= line_start < match_end:
-                return False
-            if match_start <= line_end < match_end:
-                return False
-        gene_locs[line_name] = {
-            'start': line_start,
-            'end': line_end,
-        }
-        return True
-    mbstats.sort_values(values, inplace=True, ascending=False)
-    mbstats = mbstats[mbstats.apply(check_overlap, axis=1)]
-    return mbstats
+def resolve_dup_gene_locs(mbstats:pd.DataFrame, bs_name:str, bs_start:str,
+                          bs_end:str, values:str,
+                          ascending:bool) -> pd.DataFrame:
+    """
+    Keep the best hit at each gene locus of each scaffold
+
+    Hits are ranked by values, and each is kept only if it does not overlap
+    any hit already kept on its scaffold. The kept loci of a scaffold never
+    overlap, so only the kept locus with the last start at or before the end
+    of a hit can reach past its start. Every hit has a slot in the order of
+    scaffold and start, and a Fenwick tree counts the kept slots, so finding
+    that locus and keeping a new one are both O(log n).
+
+    :param mbstats: The statistics to resolve
+    :param bs_name: The column with the scaffold name
+    :param bs_start: The column with one end of the locus
+    :param bs_end: The column with the other end of the locus
+    :param values: The column to rank the hits by
+    :param ascending: If true lower values are better
+    :returns: The hits that were kept, best first
+    """
+    mbstats = mbstats.sort_values(values, ascending=ascending, kind='stable')
+    count = len(mbstats)
+    starts = np.minimum(mbstats[bs_start], mbstats[bs_end]).to_numpy(
+        dtype=np.int64)
+    ends = np.maximum(mbstats[bs_start], mbstats[bs_end]).to_numpy(
+        dtype=np.int64)
+    names = pd.factorize(mbstats[bs_name])[0].astype(np.int64)
+    slot_order = np.lexsort((starts, names))
+    slots = np.empty(count, dtype=np.int64)
+    slots[slot_order] = np.arange(count)
+    # One sorted key for the scaffold and the position
+    first = starts.min() if count > 0 else 0
+    span = ends.max() - first + 1 if count > 0 else 1
+    slot_keys = names[slot_order] * span + starts[slot_order] - first
+    # The slots with a start at or before the end of each hit
+    limits = np.searchsorted(slot_keys, names * span + ends - first,
+                             side='right')
+    slot_names = names[slot_order].tolist()
+    slot_ends = ends[slot_order].tolist()
+    tree = [0] * (count + 1)
+    top = 1 << max(count.bit_length() - 1, 0)
+    keep = np.zeros(count, dtype=bool)
+    for i, (limit, start, name) in enumerate(zip(limits.tolist(),
+                                                  starts.tolist(),
+                                                  names.tolist())):
+        # the number of kept slots before the limit
+        kept = 0
+        pos = limit
+        while pos > 0:
+            kept += tree[pos]
+            pos &= pos - 1
+        if kept > 0:
+            # the slot of the last of them
+            pos = 0
+            step = top
+            while step > 0:
+                if pos + step <= count and tree[pos + step] < kept:
+                    pos += step
+                    kept -= tree[pos]
+                step >>= 1
+            if slot_names[pos] == name and slot_ends[pos] > start:
+                continue
+        keep[i] = True
+        pos = slots[i] + 1
+        while pos <= count:
+            tree[pos] += 1
+            pos += pos & -pos
+    return mbstats[keep]
+
 
 def combine_mbstats_barrnap(mbstats_fasta_path:str, mbstats_stats_path:str,
                             barrnap_fasta_path:str, out_fasta_path:str,
                             out_stats_path:str, barrnap_stats_path:str,
                             search_tool:str, allow_empty:bool=False,
+                            allow_no_hits:bool=False,
                             **filter_kargs) -> None:
     """
     Combine the statistics from mmseqs or blast with  barrnap.
@@ -54,6 +143,9 @@ def combine_mbstats_barrnap(mbstats_fasta_path:str, mbstats_stats_path:str,
     :param min_length: A filter for min_length, only for the non barrnap output
     :param search_tool: The name of the search_tool that is not barrnap
     :param allow_empty: If true the program will continue if only one search_tool gives results
+    :param allow_no_hits: If true and neither tool gives results the outputs
+        are left empty, for incremental runs where the new bins often have
+        no 16S
     :raises ValueError:
     """
     # TODO add checks that these functions return empty dfs if given empty
@@ -64,7 +156,13 @@ def combine_mbstats_barrnap(mbstats_fasta_path:str, mbstats_stats_path:str,
     mbstats_raw = read_mbstats(mbstats_stats_path)
     mbstats_raw.drop_duplicates(inplace=True)
     print('Filter stats FASTA')
-    mbstats = filter_mdstats(mbstats_raw, **filter_kargs)
+    mbstats = filter_mdstats(mbstats_raw, report=True, **filter_kargs)
+    if barfasta.empty and mbstats.empty and allow_no_hits:
+        print(f"There are no hits from barrnap or {search_tool}, the outputs"
+              " are empty.")
+        for path in (out_fasta_path, out_stats_path):
+            open(path, 'w').close()
+        return
     if barfasta.empty and mbstats.empty:
         raise ValueError(f"There are no hits from barrnap or {search_tool},"
                           " this is most likely caused by some irregularity in"
@@ -107,7 +205,6 @@ def combine_mbstats_barrnap(mbstats_fasta_path:str, mbstats_stats_path:str,
     print("Write output")
     df_to_fasta(data, out_fasta_path)
     mbstats.reset_index(inplace=True) # sanity check
-    breakpoint()
     make_stage1_statistics(out_stats_path, search_tool, mbstats=mbstats, 
                            barfasta=barfasta, barrnap_stats_path=barrnap_stats_path)
 
@@ -136,6 +233,7 @@ def make_stage1_statistics(output_path:str, search_tool:str,
                            mbstats:pd.DataFrame=None,
                            barfasta:pd.DataFrame=None,
                            barrnap_stats_path:str=None):
+    barstats = None
     if barfasta is not None:
         barstats = read_gff(barrnap_stats_path)
         barstats_corrected = barfasta[['header', 'start', 'stop']]
@@ -163,19 +261,800 @@ def make_stage1_statistics(output_path:str, search_tool:str,
 
 def filter_from_mbstats(stats_file_in:str, fasta_file_in:str,
                         fasta_file_out:str,
-                        stats_file_out:str, search_tool:str,  **filter_kargs):
+                        stats_file_out:str, search_tool:str,
+                        chunksize:int=None, exact_queries:set=None,
+                        **filter_kargs):
+    """
+    Filter the stage 2 statistics and pull the matching candidate sequences.
+
+    If chunksize is given the statistics are streamed, each chunk is
+    filtered and appended to the output, and only the set of passing headers
+    is kept in memory.
+
+    :param stats_file_in: Path to mmseqs or blast statistics
+    :param fasta_file_in: Path to the candidate sequences
+    :param fasta_file_out: Path for the matched sequences
+    :param stats_file_out: Path for the matched statistics
+    :param search_tool: The name of the search tool
+    :param chunksize: Optional, the number of statistics rows to read at once
+    :param exact_queries: Optional, the ASVs matched by the exact pre-pass,
+        their rows get EXACT_SEARCH_TOOL as the search_tool
+    """
+    def reformat(mbstats):
+        mbstats = mbstats_reformat(mbstats, search_tool, 'ASV')
+        if exact_queries is not None:
+            mbstats.loc[mbstats['ASV_header'].isin(exact_queries),
+                        'search_tool'] = EXACT_SEARCH_TOOL
+        return mbstats
+
+    if chunksize is None:
         mbstats = read_mbstats(stats_file_in)
         mbstats = filter_mdstats(mbstats, **filter_kargs)
-        mbstats = mbstats_reformat(mbstats, search_tool, 'ASV')
+        mbstats = reformat(mbstats)
         mbstats.to_csv(stats_file_out, sep='\t', index=False, na_rep='NA')
-        filter_fasta_from_headers(fasta_file_in,
-                                  fasta_file_out,
-                                  mbstats['bin_scaffold_header'].values)
+        headers = mbstats['bin_scaffold_header'].values
+    else:
+        headers = set()
+        write_header = True
+        for mbstats in read_mbstats(stats_file_in, chunksize=chunksize):
+            mbstats = filter_mdstats(mbstats, **filter_kargs)
+            mbstats = reformat(mbstats)
+            mbstats.to_csv(stats_file_out, sep='\t', index=False,
+                           na_rep='NA', header=write_header,
+                           mode='w' if write_header else 'a')
+            write_header = False
+            headers.update(mbstats['bin_scaffold_header'].values)
+    filter_fasta_from_headers(fasta_file_in, fasta_file_out, headers)
 
 
 def pullseqs_header_name_from_tab(in_fasta_path:str, out_fasta_path:str,
                                   tab_file_path:str,
-                                  header_column:str='sseqid'):
-       mbstats = read_mbstats(tab_file_path)
-       headers = set(mbstats[header_column].values)
-       filter_fasta_from_headers(in_fasta_path, out_fasta_path, headers)
+                                  header_column:str='sseqid',
+                                  index_path:str=None, flank:int=None):
+    """
+    Pull the sequences named in a mmseqs or blast table from a fasta
+
+    :param in_fasta_path: Path to the fasta to pull from
+    :param out_fasta_path: Path for the pulled sequences
+    :param tab_file_path: Path to mmseqs or blast statistics
+    :param header_column: The statistics column with the fasta headers
+    :param index_path: Optional, path to an index of in_fasta_path, made if
+        missing, with it only the named sequences are read
+    :param flank: Optional, needs index_path, pull only the window spanning
+        every hit on a scaffold plus this many bases on each side instead of
+        the whole scaffold
+    """
+    mbstats = read_mbstats(tab_file_path)
+    headers = set(mbstats[header_column].values)
+    if index_path is None:
+        filter_fasta_from_headers(in_fasta_path, out_fasta_path, headers)
+        return
+    index = load_fasta_index(in_fasta_path, index_path)
+    if flank is None:
+        write_fasta(fetch_fasta_records(in_fasta_path, index, headers),
+                    out_fasta_path)
+        return
+    mbstats['start'] = mbstats[['sstart', 'send']].min(axis=1) - 1 - flank
+    mbstats['stop'] = mbstats[['sstart', 'send']].max(axis=1) + flank
+    windows = mbstats.groupby(header_column).agg({'start': 'min',
+                                                  'stop': 'max'})
+    windows = windows.reset_index().rename(columns={header_column: 'header'})
+    write_fasta(fetch_fasta_windows(in_fasta_path, index, windows),
+                out_fasta_path)
+
+
+def extract_barrnap_16s(gff_path:str, bins_path:str, index_path:str,
+                        out_gff_path:str, out_fasta_path:str):
+    """
+    Pull the 16S genes barrnap found out of the bins
+
+    The lines of the gff that mention 16S are kept, and each feature is read
+    from the indexed bins with a seek. The records are named like bedtools
+    getfasta names them, 'scaffold:start-end' with a 0-based start, and are
+    in the order of the gff. Features past the end of their scaffold are
+    skipped, as bedtools skips them.
+
+    :param gff_path: The barrnap gff
+    :param bins_path: The combined bins, uncompressed
+    :param index_path: The index of the combined bins
+    :param out_gff_path: Path for the gff of the 16S features
+    :param out_fasta_path: Path for the 16S sequences
+    """
+    with open(gff_path) as in_file:
+        lines = [i for i in in_file if '16S' in i]
+    with open(out_gff_path, 'w') as out_file:
+        out_file.writelines(lines)
+    features = [i.split('\t', 5) for i in lines
+                if not i.startswith('#') and i.count('\t') >= 4]
+    windows = pd.DataFrame({'header': [i[0] for i in features],
+                            'start': [int(i[3]) - 1 for i in features],
+                            'stop': [int(i[4]) for i in features]})
+    index = load_fasta_index(bins_path, index_path)
+    lengths = windows['header'].map(
+        index.drop_duplicates('header').set_index('header')['length'])
+    windows = windows[(windows['start'] >= 0) &
+                      (windows['stop'] <= lengths)]
+    seqs = {}
+    for header, description, seq in fetch_fasta_windows(bins_path, index,
+                                                        windows):
+        seqs[f"{header}:{description.split('=', 1)[1]}"] = seq
+    names = [f"{i}:{j}-{k}" for i, j, k in windows.itertuples(index=False)]
+    write_fasta(((i, '', seqs[i]) for i in names), out_fasta_path)
+
+
+def reference_cache_key(fasta_path:str, tool_version:str) -> str:
+    """
+    Make a key from the content of a fasta and the version of a tool
+
+    :param fasta_path: Path to the reference fasta
+    :param tool_version: The version of the tool that builds the database
+    :returns: A hex digest, the same for the same content and version
+    """
+    digest = hashlib.sha256(tool_version.encode() + b'\0')
+    return hash_file(fasta_path, digest).hexdigest()
+
+
+def make_mmseqs_reference_db(fasta_path:str, db_dir:str,
+                             cache_dir:str=None, verbosity:int=2):
+    """
+    Make the mmseqs database of the generic 16S as db_dir/query
+
+    If cache_dir is given the database is built once in the cache, under a
+    key from the fasta content and the mmseqs version, and db_dir only links
+    to it. The database is built in a temporary folder in the cache and
+    renamed when done, so runs sharing the cache never see half of one.
+
+    :param fasta_path: Path to the generic 16S fasta
+    :param db_dir: The folder for the database, or the links to it
+    :param cache_dir: Optional, the folder holding the cached databases
+    :param verbosity: The verbosity passed to mmseqs
+    """
+    os.makedirs(db_dir)
+    createdb = ['mmseqs', 'createdb', '-v', str(verbosity), fasta_path]
+    if cache_dir is None:
+        subprocess.run(createdb + [os.path.join(db_dir, 'query')], check=True)
+        return
+    version = subprocess.run(['mmseqs', 'version'], check=True,
+                             capture_output=True, text=True).stdout.strip()
+    cached_dir = os.path.join(
+        cache_dir, f"mmseqs_{reference_cache_key(fasta_path, version)}")
+    if os.path.isdir(cached_dir):
+        print(f"Using the cached generic 16S database {cached_dir}")
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.building_')
+        os.chmod(build_dir, 0o755)
+        try:
+            subprocess.run(createdb + [os.path.join(build_dir, 'query')],
+                           check=True)
+            os.rename(build_dir, cached_dir)
+        except OSError:
+            # Another run finished the same database first
+            if not os.path.isdir(cached_dir):
+                raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    for name in os.listdir(cached_dir):
+        os.symlink(os.path.join(cached_dir, name), os.path.join(db_dir, name))
+
+
+def index_bins_file(fasta_path:str, index_path:str, cache_dir:str=None):
+    """
+    Make the random access index of a bins file, once for each content
+
+    If cache_dir is given the index is kept in it under a key from the
+    fasta content, and later runs on the same bins copy it instead of
+    reading every record again. Like the reference databases it is written
+    to a temporary file in the cache and renamed when done.
+
+    :param fasta_path: Path to the uncompressed bins fasta
+    :param index_path: Where to save the index
+    :param cache_dir: Optional, the folder holding the cached indexes
+    """
+    if cache_dir is None:
+        build_fasta_index(fasta_path, index_path)
+        return
+    cached_path = os.path.join(
+        cache_dir,
+        f"bins_index_{reference_cache_key(fasta_path, FASTA_INDEX_VERSION)}"
+        ".tsv")
+    if os.path.exists(cached_path):
+        print(f"Using the cached bins index {cached_path}")
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        build_fd, build_path = tempfile.mkstemp(dir=cache_dir,
+                                                prefix='.building_')
+        os.close(build_fd)
+        try:
+            build_fasta_index(fasta_path, build_path)
+            os.chmod(build_path, 0o644)
+            os.replace(build_path, cached_path)
+        finally:
+            if os.path.exists(build_path):
+                os.remove(build_path)
+    shutil.copyfile(cached_path, index_path)
+
+
+def combine_bins(bin_paths:list, out_fasta_path:str, index_path:str,
+                 map_path:str, threads:int=1):
+    """
+    Join the bins into one fasta, with its index and the bin of each scaffold
+
+    :param bin_paths: The bin files, each may be gziped
+    :param out_fasta_path: Path for the combined bins
+    :param index_path: Path for the index of the combined bins
+    :param map_path: Path for a table of each scaffold, its bin file and
+        its length
+    :param threads: The number of processes to decompress the bins with
+    """
+    index = concat_fasta_files(bin_paths, out_fasta_path, threads)
+    pd.DataFrame({'header': index['header'],
+                  'bin': [os.path.basename(bin_paths[i])
+                          for i in index['file']],
+                  'length': index['length']}).to_csv(
+        map_path, sep='\t', index=False)
+    index.drop(columns='file').drop_duplicates('header').to_csv(
+        index_path, sep='\t', index=False, header=False)
+
+
+def split_bins_shards(in_fasta_path:str, index_path:str, shard_paths:list,
+                      sizes_path:str):
+    """
+    Split the combined bins into shards of about the same size
+
+    :param in_fasta_path: Path to the combined bins
+    :param index_path: Path to the index of the combined bins
+    :param shard_paths: A path for each shard
+    :param sizes_path: Path for a table of the bases in each shard
+    """
+    index = load_fasta_index(in_fasta_path, index_path)
+    sizes = split_fasta_by_size(in_fasta_path, index, shard_paths)
+    pd.DataFrame({'shard': shard_paths, 'bases': sizes}).to_csv(
+        sizes_path, sep='\t', index=False)
+
+
+def read_shard_sizes(sizes_path:str, column:str='bases') -> pd.Series:
+    """
+    Read the table of shard sizes from split_bins_shards
+
+    :param sizes_path: Path to the table
+    :param column: The column of sizes to read
+    :returns: The number of bases in each shard indexed by shard path
+    """
+    return pd.read_csv(sizes_path, sep='\t', index_col='shard')[column]
+
+
+def scale_evalues(hits:pd.DataFrame, factor:float,
+                  max_evalue:float=None) -> pd.DataFrame:
+    """
+    Scale the e-values of hits searched against part of a target
+
+    E-values grow with the size of the target, so hits against a part of it
+    are scaled up by the size of the whole over the size of the part.
+
+    :param hits: Hits read as strings with MBSTATS_NAMES columns
+    :param factor: The size of the whole target over the part searched
+    :param max_evalue: Optional, the highest e-value to keep after scaling
+    :returns: The hits with the e-values scaled and formatted
+    """
+    evalue = hits['evalue'].astype(float) * factor
+    if max_evalue is not None:
+        hits, evalue = hits[evalue <= max_evalue], evalue[evalue <= max_evalue]
+    hits = hits.copy()
+    hits['evalue'] = evalue.map('{:.3E}'.format)
+    return hits
+
+
+def order_hits(hits:pd.DataFrame, query_fasta_path:str,
+               max_targets:int=None) -> pd.DataFrame:
+    """
+    Order hits by query and score, and keep the best targets of each query
+
+    Queries are in the order of the query fasta, then hits are ordered best
+    bitscore first, and ties by target name and coordinates, so the order
+    doesn't depend on the order the hits were read in.
+
+    :param hits: Hits read as strings with MBSTATS_NAMES columns
+    :param query_fasta_path: The query fasta of the search
+    :param max_targets: Optional, the most targets to keep for each query,
+        ranked by their best hit, with all the hits of each target kept
+    :returns: The ordered hits
+    """
+    query_order = {j[0]: i for i, j in
+                   enumerate(read_fasta(query_fasta_path))}
+    keys = pd.DataFrame({
+        'query_order': hits['qseqid'].map(query_order).to_numpy(),
+        'bitscore': -hits['bitscore'].astype(float).to_numpy(),
+        'sseqid': hits['sseqid'].to_numpy()})
+    for column in ['sstart', 'send', 'qstart', 'qend']:
+        keys[column] = hits[column].astype(int).to_numpy()
+    order = keys.sort_values(list(keys.columns), kind='stable').index
+    return limit_targets(hits.iloc[order], max_targets)
+
+
+def limit_targets(hits:pd.DataFrame, max_targets:int=None) -> pd.DataFrame:
+    """
+    Keep the first targets of each query, like the limit of a search
+
+    :param hits: Hits with MBSTATS_NAMES columns, grouped by query and
+        ordered as the search would order them
+    :param max_targets: The most targets to keep for each query, all the
+        hits of each target are kept, if None all hits are kept
+    :returns: The hits of the first max_targets targets of each query
+    """
+    if max_targets is None or len(hits) == 0:
+        return hits
+    # Targets are numbered as they first appear, from 0 in each query
+    target = hits.groupby(['qseqid', 'sseqid'], sort=False).ngroup()
+    rank = target - target.groupby(hits['qseqid']).transform('min')
+    return hits[(rank < max_targets).to_numpy()]
+
+
+def gather_stage1_shards(shard_tab_paths:list, out_tab_path:str,
+                         query_fasta_path:str, sizes_path:str=None,
+                         shard_paths:list=None, max_evalue:float=None,
+                         total_size:int=None, max_targets:int=None):
+    """
+    Gather the hit tables of the stage 1 shards into one table
+
+    This is also used to join the stage 2 exact matches to the search hits,
+    and the two passes of an adaptive search.
+
+    Hits are ordered by order_hits. MMseqs2 e-values depend on the size of
+    the target, so if sizes_path is given the e-values of each shard are
+    scaled up to the size of all the bins and max_evalue is applied again.
+    The other values are copied as they are. Each shard is searched with
+    its own limit on targets per query, so max_targets should be given to
+    apply the limit again. The limit keeps the best targets by bitscore,
+    while a single search keeps the best of its prefilter, so for queries
+    with more targets than the limit the hits can differ from one search.
+
+    :param shard_tab_paths: The hit tables, one per shard
+    :param out_tab_path: Path for the gathered table
+    :param query_fasta_path: The query fasta of the search
+    :param sizes_path: Optional, the table of shard sizes to scale e-values
+    :param shard_paths: The shard of each table, needed with sizes_path
+    :param max_evalue: Optional, the highest e-value to keep after scaling
+    :param total_size: Optional, the size to scale to if the shards don't
+        add up to the whole target, by default the sum of the shards
+    :param max_targets: Optional, the most targets to keep for each query
+    """
+    if len(shard_tab_paths) == 1 and sizes_path is None and \
+       max_targets is None:
+        shutil.copyfile(shard_tab_paths[0], out_tab_path)
+        return
+    sizes = None if sizes_path is None else read_shard_sizes(sizes_path)
+    if sizes is not None and total_size is None:
+        total_size = sizes.sum()
+    hits = [pd.DataFrame(columns=MBSTATS_NAMES, dtype=str)]
+    for i, tab_path in enumerate(shard_tab_paths):
+        if os.path.getsize(tab_path) == 0:
+            continue
+        data = pd.read_csv(tab_path, sep='\t', header=None,
+                           names=MBSTATS_NAMES, dtype=str)
+        if sizes is not None:
+            data = scale_evalues(data, total_size /
+                                 max(sizes[shard_paths[i]], 1), max_evalue)
+        hits.append(data)
+    hits = order_hits(pd.concat(hits, ignore_index=True), query_fasta_path,
+                      max_targets)
+    hits[MBSTATS_NAMES].to_csv(out_tab_path, sep='\t', header=False,
+                               index=False)
+
+
+def screen_stage1_targets(in_paths:list, out_paths:list,
+                          reference_path:str, sizes_path:str,
+                          min_kmers:int):
+    """
+    Keep only the scaffolds that share k-mers with the generic 16S
+
+    The k-mer table of the generic 16S is built once and each stage 1
+    target is screened with it. The sizes of the screened targets are
+    written in the format of split_bins_shards, with the bases before
+    screening, so e-values can be scaled to the full target.
+
+    :param in_paths: The stage 1 targets, the combined bins or each shard
+    :param out_paths: A path for each screened target
+    :param reference_path: The generic 16S fasta
+    :param sizes_path: Path for a table of the bases in each target
+    :param min_kmers: The fewest shared k-mers in a window to keep a scaffold
+    """
+    table = build_kmer_table(reference_path)
+    sizes = [screen_fasta_by_kmers(i, j, table, min_kmers)
+             for i, j in zip(in_paths, out_paths)]
+    pd.DataFrame({'shard': out_paths, 'bases': [i[1] for i in sizes],
+                  'unscreened_bases': [i[0] for i in sizes]}).to_csv(
+        sizes_path, sep='\t', index=False)
+    total_in = sum(i[0] for i in sizes)
+    total_out = sum(i[1] for i in sizes)
+    print(f"The k-mer screen kept {total_out} of {total_in} bases of the"
+          " bins for the stage 1 search.")
+
+
+def gather_barrnap_shards(shard_gff_paths:list, out_gff_path:str):
+    """
+    Gather the barrnap gff files of the shards into one gff
+
+    Shards hold whole scaffolds, so the coordinates are kept as they are.
+    The features are sorted by scaffold and start, as barrnap sorts them.
+
+    :param shard_gff_paths: The barrnap output of each shard
+    :param out_gff_path: Path for the gathered gff
+    """
+    if len(shard_gff_paths) == 1:
+        shutil.copyfile(shard_gff_paths[0], out_gff_path)
+        return
+    headers = []
+    features = []
+    for gff_path in shard_gff_paths:
+        with open(gff_path) as in_file:
+            for line in in_file:
+                if line.startswith('#'):
+                    if line not in headers:
+                        headers.append(line)
+                elif line.strip():
+                    fields = line.split('\t', 4)
+                    features.append((fields[0], int(fields[3]), line))
+    features.sort(key=lambda i: i[:2])
+    with open(out_gff_path, 'w') as out_file:
+        out_file.writelines(headers)
+        out_file.writelines(i[2] for i in features)
+
+
+def run_blastn(db_path:str, query_path:str, out_path:str, threads:int=1,
+               extra_args:list=(), scratch_dir:str=None):
+    """
+    Run blastn with the query split into chunks run in parallel
+
+    The query is cut into one run of consecutive records per thread, with
+    about the same number of bases in each, and the outputs are joined in
+    the same order, so the table is the same as from one blastn.
+
+    :param db_path: The blast database
+    :param query_path: The query fasta
+    :param out_path: Path for the tabular output
+    :param threads: The number of threads to use
+    :param extra_args: More arguments for blastn
+    :param scratch_dir: Optional, where to write the chunks, by default
+        beside the output
+    """
+    records = list(read_fasta(query_path))
+    chunks = max(min(threads, len(records)), 1)
+    command = ['blastn', '-db', db_path, '-outfmt', BLAST_OUTFMT,
+               '-num_threads', str(max(threads // chunks, 1))] + \
+        list(extra_args)
+    if chunks == 1:
+        subprocess.run(command + ['-query', query_path, '-out', out_path],
+                       check=True)
+        return
+    bases = np.cumsum([len(i[2]) for i in records])
+    cuts = np.searchsorted(bases, bases[-1] * np.arange(1, chunks) / chunks)
+    cuts = [0] + list(np.maximum.accumulate(cuts + 1)) + [len(records)]
+    if scratch_dir is None:
+        scratch_dir = os.path.dirname(os.path.abspath(out_path))
+    chunk_dir = tempfile.mkdtemp(dir=scratch_dir, prefix='blastn_chunks_')
+    jobs = []
+    try:
+        for i in range(chunks):
+            if cuts[i] >= cuts[i + 1]:
+                continue
+            chunk_path = os.path.join(chunk_dir, f"query_{i}.fa")
+            write_fasta(records[cuts[i]:cuts[i + 1]], chunk_path)
+            jobs.append((subprocess.Popen(command + [
+                '-query', chunk_path, '-out', f"{chunk_path}.tab"]),
+                f"{chunk_path}.tab"))
+        for job, _ in jobs:
+            if job.wait() != 0:
+                raise subprocess.CalledProcessError(job.returncode, job.args)
+        with open(out_path, 'wb') as out_file:
+            for _, tab_path in jobs:
+                with open(tab_path, 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+    finally:
+        for job, _ in jobs:
+            if job.poll() is None:
+                job.kill()
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def allocate_stage1_threads(cores:int, shards:int=1,
+                            barrnap_share:float=None) -> dict:
+    """
+    Split the cores between barrnap and the stage 1 search
+
+    The two are independent, so given separate budgets snakemake runs them
+    at the same time. By default barrnap gets up to BARRNAP_MAX_THREADS per
+    shard and no more than half the cores, and the search gets the rest.
+    Each budget is then divided between the shard jobs.
+
+    :param cores: The cores snakemake was given
+    :param shards: The number of shards each tool runs on
+    :param barrnap_share: Optional, the fraction of the cores for barrnap
+    :returns: A dict with the 'barrnap' and 'search' threads of each job
+    """
+    if cores < 2:
+        return {'barrnap': 1, 'search': 1}
+    if barrnap_share is None:
+        barrnap = min(max(cores // 2, 1), BARRNAP_MAX_THREADS * shards)
+    else:
+        barrnap = min(max(round(cores * barrnap_share), 1), cores - 1)
+    return {'barrnap': max(barrnap // shards, 1),
+            'search': max((cores - barrnap) // shards, 1)}
+
+
+def exact_stage2_prepass(target_fasta_path:str, query_fasta_path:str,
+                         out_tab_path:str, leftover_fasta_path:str):
+    """
+    Find the ASVs that are exact substrings of a candidate without a search
+
+    The exact matches are written in the same format as the search output.
+    The bitscore and e-value are what blastn would give an ungapped match
+    with no mismatches, whichever tool searches the rest, see
+    EXACT_SEARCH_TOOL. The ASVs with no exact match are written to a fasta
+    to be searched as normal. Near matches of the exact ASVs are not looked
+    for, so this is only used when the filters would remove them.
+
+    :param target_fasta_path: The candidate 16S sequences
+    :param query_fasta_path: The ASV sequences
+    :param out_tab_path: Path for the table of exact matches
+    :param leftover_fasta_path: Path for the ASVs with no exact match
+    """
+    queries = list(read_fasta(query_fasta_path))
+    targets = list(read_fasta(target_fasta_path))
+    db_size = sum(len(i[2]) for i in targets)
+    hits = find_exact_hits([i[2] for i in queries], [i[2] for i in targets])
+    rows = []
+    for query_id, target_id, start, reverse in hits:
+        length = len(queries[query_id][2])
+        bitscore = (EXACT_MATCH_LAMBDA * length - np.log(EXACT_MATCH_K)) / \
+            np.log(2)
+        sstart, send = (start + length, start + 1) if reverse \
+            else (start + 1, start + length)
+        rows.append((queries[query_id][0], targets[target_id][0], 100.0,
+                     length, 0, 0, 1, length, sstart, send,
+                     f"{length * db_size * 2 ** -bitscore:.3g}",
+                     int(bitscore), length, len(targets[target_id][2])))
+    pd.DataFrame(rows, columns=MBSTATS_NAMES).to_csv(
+        out_tab_path, sep='\t', header=False, index=False)
+    matched = {i[0] for i in hits}
+    write_fasta((j for i, j in enumerate(queries) if i not in matched),
+                leftover_fasta_path)
+    print(f"{len(matched)} of {len(queries)} ASVs were exact matches to"
+          " candidate 16S sequences.")
+
+
+def read_exact_queries(exact_tab_path:str, query_map_path:str) -> set:
+    """
+    The ASVs the exact pre-pass matched, with every ASV they stand for
+
+    :param exact_tab_path: The hits from exact_stage2_prepass
+    :param query_map_path: The query map from dereplicate_fasta
+    :returns: A set of ASV headers
+    """
+    if os.path.getsize(exact_tab_path) == 0:
+        return set()
+    matched = set(pd.read_csv(exact_tab_path, sep='\t', header=None,
+                              usecols=[0], dtype=str,
+                              keep_default_na=False)[0])
+    members = pd.read_csv(query_map_path, sep='\t', dtype=str,
+                          keep_default_na=False)
+    return set(members.loc[members['representative'].isin(matched),
+                           'member'])
+
+
+def dereplicate_fasta(in_fasta_path:str, out_fasta_path:str,
+                      map_path:str) -> int:
+    """
+    Collapse identical sequences to the first record with each sequence
+
+    Sequences are compared by their sha1, so only the digests are kept in
+    memory.
+
+    :param in_fasta_path: The fasta to dereplicate
+    :param out_fasta_path: Path for the representative records, in the
+        order they first appear
+    :param map_path: Path for a table of each record and its representative
+    :returns: The number of records collapsed into another
+    """
+    representatives = {}
+    members = []
+
+    def first_records():
+        for seq_id, description, seq in read_fasta(in_fasta_path):
+            digest = hashlib.sha1(seq).digest()
+            representative = representatives.setdefault(digest, seq_id)
+            members.append((representative, seq_id))
+            if representative == seq_id:
+                yield seq_id, description, seq
+
+    write_fasta(first_records(), out_fasta_path)
+    pd.DataFrame(members, columns=['representative', 'member']).to_csv(
+        map_path, sep='\t', index=False)
+    return len(members) - len(representatives)
+
+
+def expand_dereplicated_hits(tab_path:str, out_tab_path:str,
+                             query_map_path:str):
+    """
+    Expand hits of representative queries to every query they stand for
+
+    Each hit is copied to every query record with the same sequence. The
+    e-value of a hit depends only on the query length and the target, so the
+    copies are the hits a search of every query would give. The hits are
+    ordered by query in the original order, then as the search ordered them.
+    If no queries were collapsed the hits are copied as they are.
+
+    :param tab_path: The hits of the representatives
+    :param out_tab_path: Path for the expanded hits
+    :param query_map_path: The query map from dereplicate_fasta
+    """
+    members = pd.read_csv(query_map_path, sep='\t', dtype=str,
+                          keep_default_na=False)
+    if os.path.getsize(tab_path) == 0 or \
+       (members['representative'] == members['member']).all():
+        shutil.copyfile(tab_path, out_tab_path)
+        return
+    hits = pd.read_csv(tab_path, sep='\t', header=None, names=MBSTATS_NAMES,
+                       dtype=str, keep_default_na=False)
+    hits['hit_order'] = np.arange(len(hits))
+    members['query_order'] = np.arange(len(members))
+    hits = pd.merge(hits, members, left_on='qseqid',
+                    right_on='representative')
+    hits['qseqid'] = hits['member']
+    hits.sort_values(['query_order', 'hit_order'], inplace=True)
+    hits[MBSTATS_NAMES].to_csv(out_tab_path, sep='\t', header=False,
+                               index=False)
+
+
+def split_adaptive_queries(tab_path:str, query_fasta_path:str,
+                           leftover_fasta_path:str, **filter_kargs) -> int:
+    """
+    Find the queries of a fast search with no hit that passes the filters
+
+    :param tab_path: The hits of the fast search
+    :param query_fasta_path: The queries of the fast search
+    :param leftover_fasta_path: Path for the queries to search again
+    :param filter_kargs: The arguments to filter_mdstats
+    :returns: The number of queries to search again
+    """
+    passed = set()
+    if os.path.getsize(tab_path) > 0:
+        passed.update(filter_mdstats(read_mbstats(tab_path),
+                                     **filter_kargs)['qseqid'].astype(str))
+    leftover = [i for i in read_fasta(query_fasta_path) if i[0] not in passed]
+    write_fasta(leftover, leftover_fasta_path)
+    print(f"{len(leftover)} queries had no passing hit in the fast search"
+          " and will be searched again.")
+    return len(leftover)
+
+
+def merge_adaptive_passes(fast_tab_path:str, thorough_tab_path:str,
+                          leftover_fasta_path:str, query_fasta_path:str,
+                          out_tab_path:str):
+    """
+    Merge the hits of the fast and thorough passes of an adaptive search
+
+    The queries searched again only keep their hits from the thorough pass,
+    the rest keep their hits from the fast pass.
+
+    :param fast_tab_path: The hits of the fast pass
+    :param thorough_tab_path: The hits of the thorough pass
+    :param leftover_fasta_path: The queries of the thorough pass
+    :param query_fasta_path: All the queries, for the order of the hits
+    :param out_tab_path: Path for the merged hits
+    """
+    leftover = {i[0] for i in read_fasta(leftover_fasta_path)}
+    kept_tab_path = f"{out_tab_path}.fast"
+    with open(fast_tab_path) as in_file, open(kept_tab_path, 'w') as out_file:
+        out_file.writelines(i for i in in_file
+                            if i.split('\t', 1)[0] not in leftover)
+    try:
+        gather_stage1_shards([kept_tab_path, thorough_tab_path],
+                             out_tab_path, query_fasta_path)
+    finally:
+        os.remove(kept_tab_path)
+
+
+def run_report_path(rule_name:str, *wildcards) -> str:
+    """
+    The benchmark path of a rule, one file for each job
+
+    :param rule_name: The name of the rule
+    :param wildcards: The names of the wildcards of the rule, in the order
+        they are in its output
+    :returns: A path with the wildcards to give to benchmark
+    """
+    job_name = "_".join(f"{{{i}}}" for i in wildcards) or 'job'
+    return os.path.join(RUN_REPORT_DIR, rule_name, f"{job_name}.tsv")
+
+
+def paths_size(paths) -> int:
+    """The size of the files and folders that exist in paths, in bytes"""
+    size = 0
+    for path in paths:
+        if os.path.isdir(path):
+            size += sum(os.path.getsize(os.path.join(i, k))
+                        for i, _, j in os.walk(path) for k in j)
+        elif os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+
+@contextmanager
+def time_run_block(rule_name:str, wildcards, input_paths, output_paths):
+    """
+    Time the python in a run block and measure its files
+
+    The times and sizes are written next to the benchmark of the job, see
+    run_report_path, for write_run_report.
+
+    :param rule_name: The name of the rule
+    :param wildcards: The wildcards of the job
+    :param input_paths: The inputs of the job
+    :param output_paths: The outputs of the job
+    """
+    job_name = "_".join(str(i) for i in wildcards) or 'job'
+    input_bytes = paths_size(input_paths)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    yield
+    record = {'run_wall_s': time.perf_counter() - start,
+              'run_cpu_s': time.process_time() - cpu_start,
+              'input_mb': input_bytes / 1e6,
+              'output_mb': paths_size(output_paths) / 1e6}
+    os.makedirs(os.path.join(RUN_REPORT_DIR, rule_name), exist_ok=True)
+    with open(os.path.join(RUN_REPORT_DIR, rule_name,
+                           f"{job_name}.run.json"), 'w') as out_file:
+        json.dump(record, out_file)
+
+
+def write_run_report(report_dir:str, tsv_path:str, json_path:str) -> bool:
+    """
+    Gather the benchmarks of the jobs into one report
+
+    The TSV has a row for each job, from its snakemake benchmark: the wall
+    and CPU time, the peak RSS and the MB read and written. Jobs with a run
+    block also have the time of the python in it and the size of their input
+    and output files, from time_run_block. The JSON has the same rows under
+    'jobs' and the totals of each rule under 'rules', with the largest peak
+    RSS. The folder of benchmarks is removed once they are read, and the
+    Snakefile clears it when a run starts, so only the jobs of this run are
+    reported.
+
+    :param report_dir: The folder of benchmarks
+    :param tsv_path: Path for the report of each job
+    :param json_path: Path for the report of each job and rule
+    :returns: True if there were benchmarks to report
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(report_dir, '*', '*.tsv'))):
+        bench = pd.read_csv(path, sep='\t', na_values=['NA', '-'])
+        row = {'rule': os.path.basename(os.path.dirname(path)),
+               'job': os.path.basename(path)[:-len('.tsv')],
+               'wall_s': bench['s'].mean(),
+               'cpu_s': bench['cpu_time'].mean(),
+               'max_rss_mb': bench['max_rss'].max(),
+               'io_in_mb': bench['io_in'].mean(),
+               'io_out_mb': bench['io_out'].mean()}
+        run_path = f"{path[:-len('.tsv')]}.run.json"
+        if os.path.exists(run_path):
+            with open(run_path) as in_file:
+                row.update(json.load(in_file))
+        rows.append(row)
+    shutil.rmtree(report_dir, ignore_errors=True)
+    if len(rows) == 0:
+        return False
+    jobs = pd.DataFrame(rows, columns=[
+        'rule', 'job', 'wall_s', 'cpu_s', 'max_rss_mb', 'io_in_mb',
+        'io_out_mb', 'run_wall_s', 'run_cpu_s', 'input_mb', 'output_mb'])
+    jobs.to_csv(tsv_path, sep='\t', index=False, na_rep='NA',
+                float_format='%.4f')
+    by_rule = jobs.drop(columns='job').groupby('rule')
+    rules = by_rule.sum(min_count=1)
+    rules['max_rss_mb'] = by_rule['max_rss_mb'].max()
+    rules.insert(0, 'jobs', by_rule.size())
+    with open(json_path, 'w') as out_file:
+        json.dump({'jobs': json.loads(jobs.to_json(orient='records')),
+                   'rules': json.loads(rules.to_json(orient='index'))},
+                  out_file, indent=2)
+    return True
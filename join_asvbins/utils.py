@@ -1,39 +1,673 @@
 """Tools for extract 16S from scaffolds"""
 import os
+import io
+import gzip
+import heapq
+import hashlib
 import pandas as pd
 import numpy as np
-from skbio import write as write_fa
-from skbio import read as read_fa
-from skbio import Sequence
 import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from join_asvbins.seq_array import SeqArray, as_seq_array, seq_to_bytes
 
 # This is the header format for blast and mmseqs stats
 MBSTATS_NAMES=[
     "qseqid", "sseqid", "pident", "length", "mismatch", "gapopen",
     "qstart", "qend", "sstart", "send", "evalue", "bitscore", "qlen",
     "slen"]
+FASTA_BUFFER_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+# The bytes of fasta files worth starting worker processes for in
+# concat_fasta_files, each worker takes most of a second to start
+CONCAT_POOL_MIN_BYTES = FASTA_BUFFER_SIZE * 64
+FASTA_INDEX_COLUMNS = ['header', 'length', 'offset', 'line_bases',
+                       'line_width', 'span']
+_SEQ_WHITESPACE = b' \t\r\n\x0b\x0c'
+_COMPLEMENT = bytes.maketrans(b'ACGTUNacgtun', b'TGCAANtgcaan')
+# The longest seed used to index the queries of find_exact_hits, kmer_codes
+# fits at most 31 bases in an int64
+EXACT_SEED_LENGTH = 31
+# The low bits of the seed codes find_exact_hits keeps a table of, it takes
+# 2**bits bytes
+EXACT_SEED_TABLE_BITS = 24
+# The k-mer length and window of the stage 1 k-mer screen, the table of
+# k-mers takes 4**k bits
+KMER_SCREEN_LENGTH = 14
+KMER_SCREEN_WINDOW = 200
+# Bases are coded 0 to 3, anything else is 4 and ends a k-mer
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+_BASE_CODES[list(b'Aa')] = 0
+_BASE_CODES[list(b'Cc')] = 1
+_BASE_CODES[list(b'Gg')] = 2
+_BASE_CODES[list(b'TtUu')] = 3
 
 
-def fasta_to_df(path, headers=None):
+def open_fasta(path:str, mode:str='rb'):
+    """
+    Open a fasta file for binary reading or writing, gziped or not
+
+    Gzip is detected from the magic bytes when reading, and from a '.gz'
+    extension when writing.
+
+    :param path: A path to a fasta
+    :param mode: Either 'rb' or 'wb'
+    :returns: A binary file object
+    """
+    path = os.fspath(path)
+    if mode == 'rb':
+        with open(path, 'rb') as in_file:
+            is_gzip = in_file.read(2) == GZIP_MAGIC
+    else:
+        is_gzip = path.endswith('.gz')
+    if is_gzip:
+        return gzip.open(path, mode)
+    return open(path, mode, buffering=FASTA_BUFFER_SIZE)
+
+
+def hash_file(path:str, digest=None):
+    """
+    Feed the content of a file to a hash in large blocks
+
+    :param path: The file to hash
+    :param digest: Optional, a hashlib object to update, sha256 by default
+    :returns: The updated hashlib object
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(FASTA_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def _parse_fasta_record(record:bytes):
+    header, _, body = record.partition(b'\n')
+    header = header.decode().strip().split(None, 1)
+    if len(header) < 1:
+        raise ValueError("Found a fasta record with no id.")
+    return (header[0], header[1] if len(header) > 1 else '',
+            body.translate(None, _SEQ_WHITESPACE))
+
+
+def _iter_fasta_records(in_file, path:str):
+    """
+    Split an open fasta into raw records, tracking where each one starts
+
+    :param in_file: A binary file object
+    :param path: The path of the file, used for errors
+    :returns: A generator of (offset, record bytes) where the offset is the
+        position just after the '>' and the record is the header line and body
+    :raises ValueError: If the file is not in fasta format
+    """
+    tail = in_file.read(FASTA_BUFFER_SIZE)
+    start = len(tail) - len(tail.lstrip())
+    tail = tail[start:]
+    if len(tail) == 0:
+        return
+    if not tail.startswith(b'>'):
+        raise ValueError(f"The file {path} is not in fasta format.")
+    offset = start + 1
+    parts = [tail[1:]]
+    while True:
+        block = in_file.read(FASTA_BUFFER_SIZE)
+        if len(block) == 0:
+            break
+        # Long sequences span many blocks, only join once a record ends
+        if b'\n>' not in parts[-1][-1:] + block:
+            parts.append(block)
+            continue
+        parts.append(block)
+        records = b''.join(parts).split(b'\n>')
+        parts = [records.pop()]
+        for record in records:
+            yield offset, record
+            offset += len(record) + 2
+    for record in b''.join(parts).split(b'\n>'):
+        yield offset, record
+        offset += len(record) + 2
+
+
+def read_fasta(path:str):
+    """
+    Read a fasta file one record at a time
+
+    The file is read in large blocks that are split on record boundaries,
+    so no per line python work is done.
+
+    :param path: A path to a fasta, may be gziped
+    :returns: A generator of (id, description, sequence bytes) tuples
+    :raises ValueError: If the file is not in fasta format
+    """
+    with open_fasta(path) as in_file:
+        for _, record in _iter_fasta_records(in_file, path):
+            yield _parse_fasta_record(record)
+
+
+def write_fasta(records, path:str):
+    """
+    Write records to a fasta file with one line per sequence
+
+    :param records: An iterable of (id, description, sequence) tuples, the
+        sequence can be bytes, a string, or an array or list of characters
+    :param path: A path to a fasta, it will be gziped if it ends in '.gz'
+    """
+    with open_fasta(path, 'wb') as out_file:
+        for seq_id, description, seq in records:
+            header = f">{seq_id} {description}\n" if description \
+                else f">{seq_id}\n"
+            out_file.write(header.encode())
+            out_file.write(seq_to_bytes(seq))
+            out_file.write(b'\n')
+
+
+def _index_fasta_record(offset:int, record:bytes) -> tuple:
+    header_end = record.find(b'\n')
+    if header_end < 0:
+        header_end = len(record)
+    header = record[:header_end].decode().split(None, 1)
+    if len(header) < 1:
+        raise ValueError("Found a fasta record with no id.")
+    body = record[header_end + 1:]
+    seq_len = len(body.translate(None, _SEQ_WHITESPACE))
+    line_bases = line_width = 0
+    newlines = np.flatnonzero(np.frombuffer(body, dtype=np.uint8) == 10)
+    last_line = len(body) - (newlines[-1] + 1 if len(newlines) > 0 else 0)
+    if len(newlines) == 0:
+        line_bases, line_width = len(body), len(body) + 1
+    elif b'\r' not in body:
+        lines = np.diff(newlines, prepend=-1)
+        width = lines[0]
+        # Every line is full except the last, which may lack a newline
+        if np.all(lines[:-1] == width) and lines[-1] <= width and \
+           (last_line == 0 or (lines[-1] == width and last_line < width)):
+            line_bases, line_width = width - 1, width
+    return (header[0], seq_len, offset + header_end + 1, line_bases,
+            line_width, len(body))
+
+
+def build_fasta_index(fasta_path:str, index_path:str=None) -> pd.DataFrame:
+    """
+    Make a random access index of a fasta file
+
+    The index is much like a samtools faidx, one row per record with the
+    header, sequence length, byte offset of the sequence, bases per line,
+    bytes per line and the number of bytes the sequence spans. If the lines
+    of a record are irregular the line values are 0 and the whole record is
+    read when fetching.
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param index_path: Optional, where to save the index as a tsv
+    :returns: The index as a dataframe
+    :raises ValueError: If the fasta is gziped
+    """
+    with open_fasta(fasta_path) as in_file:
+        if isinstance(in_file, gzip.GzipFile):
+            raise ValueError(f"The fasta {fasta_path} is gziped, it can't"
+                             " be indexed for random access.")
+        index = pd.DataFrame([_index_fasta_record(offset, record)
+                              for offset, record
+                              in _iter_fasta_records(in_file, fasta_path)],
+                             columns=FASTA_INDEX_COLUMNS)
+    index.drop_duplicates('header', inplace=True)
+    if index_path is not None:
+        index.to_csv(index_path, sep='\t', index=False, header=False)
+    return index
+
+
+def _read_and_index_fasta(path:str) -> tuple:
+    """
+    Read a whole fasta, gziped or not, and index it from its own start
+
+    The index is made as if another record followed, so the last newline is
+    not counted in the span of the last record.
+    """
+    with open_fasta(path) as in_file:
+        data = in_file.read()
+    if len(data) > 0 and not data.endswith(b'\n'):
+        data += b'\n'
+    return data, [_index_fasta_record(offset, record) for offset, record
+                  in _iter_fasta_records(io.BytesIO(data[:-1]), path)]
+
+
+def _read_ahead(pool, paths:list, ahead:int):
+    """Read and index files in a pool, yielding them in the order given"""
+    paths = iter(paths)
+    pending = [pool.submit(_read_and_index_fasta, i)
+               for _, i in zip(range(ahead), paths)]
+    while len(pending) > 0:
+        result = pending.pop(0).result()
+        path = next(paths, None)
+        if path is not None:
+            pending.append(pool.submit(_read_and_index_fasta, path))
+        yield result
+
+
+def concat_fasta_files(fasta_paths:list, out_path:str,
+                       threads:int=1) -> pd.DataFrame:
+    """
+    Join fasta files into one uncompressed fasta and index it in one pass
+
+    Files are read, decompressed and indexed by a pool of worker processes,
+    as the indexing is mostly python that holds the GIL, and written in the
+    order given, so the output is the same as concatenating them. The
+    workers are spawned, not forked, as forking inside a snakemake job can
+    hang. Spawned workers are slow to start, so with one thread, one file or
+    less than CONCAT_POOL_MIN_BYTES of files they are read in this process
+    instead. Only a few files are read ahead of the writer, and a newline is
+    added to files that don't end in one.
+
+    :param fasta_paths: The fasta files, each may be gziped
+    :param out_path: Path for the joined fasta
+    :param threads: The number of worker processes to read with
+    :returns: The index of the joined fasta, like build_fasta_index, with
+        a 'file' column giving the position in fasta_paths of each record
+    """
+    fasta_paths = list(fasta_paths)
+    threads = min(max(threads, 1), len(fasta_paths))
+    rows = []
+    files = []
+    offset = 0
+    pool = None
+    if threads > 1 and sum(os.path.getsize(i) for i in fasta_paths) >= \
+       CONCAT_POOL_MIN_BYTES:
+        pool = ProcessPoolExecutor(
+            threads, mp_context=multiprocessing.get_context('spawn'))
+        results = _read_ahead(pool, fasta_paths, 2 * threads)
+    else:
+        results = map(_read_and_index_fasta, fasta_paths)
+    try:
+        with open(out_path, 'wb') as out_file:
+            for i, (data, index) in enumerate(results):
+                out_file.write(data)
+                rows.extend((j[0], j[1], j[2] + offset) + j[3:]
+                            for j in index)
+                files.extend([i] * len(index))
+                offset += len(data)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    index = pd.DataFrame(rows, columns=FASTA_INDEX_COLUMNS)
+    if len(index) > 0:
+        # Nothing follows the last record of the last file
+        index.loc[index.index[-1], 'span'] += 1
+    index['file'] = files
+    return index
+
+
+def load_fasta_index(fasta_path:str, index_path:str) -> pd.DataFrame:
+    """
+    Load a fasta index, making it first if it is missing or out of date
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param index_path: The path to the index tsv
+    :returns: The index as a dataframe
+    """
+    if not os.path.exists(index_path) or \
+       os.path.getmtime(index_path) < os.path.getmtime(fasta_path):
+        return build_fasta_index(fasta_path, index_path)
+    return pd.read_csv(index_path, sep='\t', header=None,
+                       names=FASTA_INDEX_COLUMNS,
+                       dtype={'header': str}, keep_default_na=False)
+
+
+def fetch_fasta_records(fasta_path:str, index:pd.DataFrame, headers):
+    """
+    Pull whole records from an indexed fasta, seeking past everything else
+
+    The records come out in the order they are in the file.
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param index: The index from load_fasta_index
+    :param headers: Headers to pull, headers not in the index are skipped
+    :returns: A generator of (id, description, sequence bytes) tuples, the
+        description is always empty
+    """
+    index = index[index['header'].isin(set(headers))].sort_values('offset')
+    with open(fasta_path, 'rb') as in_file:
+        for header, offset, span in zip(index['header'], index['offset'],
+                                        index['span']):
+            in_file.seek(offset)
+            yield (header, '',
+                   in_file.read(span).translate(None, _SEQ_WHITESPACE))
+
+
+def fetch_fasta_windows(fasta_path:str, index:pd.DataFrame,
+                        windows:pd.DataFrame):
+    """
+    Pull sub sequences from an indexed fasta, reading only those bytes
+
+    Records with irregular lines are read whole and then sliced. The window
+    is kept in the description as 'window=start-stop' so it can be placed
+    back on the scaffold with window_start_from_description.
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param index: The index from load_fasta_index
+    :param windows: A dataframe with 'header', 'start' and 'stop' columns,
+        0-based and end exclusive
+    :returns: A generator of (id, description, sequence bytes) tuples in the
+        order they are in the file, windows of the same header in the order
+        they were given
+    """
+    windows = pd.merge(windows[['header', 'start', 'stop']], index,
+                       on='header').sort_values('offset', kind='stable')
+    with open(fasta_path, 'rb') as in_file:
+        for header, start, stop, offset, line_bases, line_width, span in zip(
+                windows['header'], windows['start'].clip(lower=0),
+                windows[['stop', 'length']].min(axis=1), windows['offset'],
+                windows['line_bases'], windows['line_width'],
+                windows['span']):
+            # A window past the end of its scaffold is empty
+            stop = max(start, stop)
+            if line_bases > 0:
+                first = offset + (start // line_bases) * line_width + \
+                    start % line_bases
+                last = offset + (stop // line_bases) * line_width + \
+                    stop % line_bases
+                in_file.seek(first)
+                seq = in_file.read(last - first)
+            else:
+                in_file.seek(offset)
+                seq = in_file.read(span).translate(
+                    None, _SEQ_WHITESPACE)[start:stop]
+            yield (header, f"window={start}-{stop}",
+                   seq.translate(None, _SEQ_WHITESPACE))
+
+
+def split_fasta_by_size(fasta_path:str, index:pd.DataFrame,
+                        out_paths:list) -> list:
+    """
+    Split a fasta into shards with about the same number of bases
+
+    Each record goes to the shard with the fewest bases so far, largest
+    records first, and is then copied byte for byte, keeping the order of
+    the file inside each shard. Records with the same header stay together.
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param index: The index from load_fasta_index
+    :param out_paths: A path for each shard, some may be left empty
+    :returns: The number of bases written to each shard
+    """
+    loads = [(0, i) for i in range(len(out_paths))]
+    shard_of = {}
+    for header, length in index.sort_values(
+            'length', ascending=False, kind='stable')[
+                ['header', 'length']].itertuples(index=False):
+        load, shard = heapq.heappop(loads)
+        shard_of[header] = shard
+        heapq.heappush(loads, (load + length, shard))
+    sizes = [0] * len(out_paths)
+    out_files = [open(i, 'wb') for i in out_paths]
+    try:
+        with open_fasta(fasta_path) as in_file:
+            for _, record in _iter_fasta_records(in_file, fasta_path):
+                header, _, body = record.partition(b'\n')
+                shard = shard_of[header.decode().split(None, 1)[0]]
+                sizes[shard] += len(body.translate(None, _SEQ_WHITESPACE))
+                out_files[shard].write(b'>' + record)
+                if not record.endswith(b'\n'):
+                    out_files[shard].write(b'\n')
+    finally:
+        for i in out_files:
+            i.close()
+    return sizes
+
+
+def kmer_codes(seq:bytes, k:int=KMER_SCREEN_LENGTH) -> tuple:
+    """
+    Code every k-mer of a sequence as an integer, the same on both strands
+
+    Each k-mer is coded as 2 bits per base, and the smaller of the codes of
+    the k-mer and its reverse complement is kept. The codes of windows are
+    joined in pairs to code windows twice as long, so the k-mers are coded
+    in about 2 log2(k) passes over the sequence instead of 2 k.
+
+    :param seq: The sequence as bytes
+    :param k: The k-mer length
+    :returns: An array of the code of the k-mer starting at each position,
+        and a boolean array that is False for k-mers with other bases
+    """
+    bases = _BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    count = len(bases) - k + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    other = np.r_[0, np.cumsum(bases == 4)]
+    valid = other[k:] - other[:count] == 0
+    bases = np.where(bases == 4, 0, bases).astype(np.int64)
+    # The codes of the windows of length piece at each position, the reverse
+    # complement codes have the first base lowest
+    forward_piece, reverse_piece, piece = bases, 3 - bases, 1
+    forward = reverse = None
+    length = 0
+    remaining = k
+    while True:
+        if remaining & 1:
+            if forward is None:
+                forward, reverse, length = forward_piece, reverse_piece, piece
+            else:
+                size = len(bases) - length - piece + 1
+                forward = forward[:size] * 4 ** piece + \
+                    forward_piece[length:length + size]
+                reverse = reverse[:size] + \
+                    reverse_piece[length:length + size] * 4 ** length
+                length += piece
+        remaining >>= 1
+        if remaining == 0:
+            break
+        size = len(bases) - 2 * piece + 1
+        forward_piece = forward_piece[:size] * 4 ** piece + \
+            forward_piece[piece:piece + size]
+        reverse_piece = reverse_piece[:size] + \
+            reverse_piece[piece:piece + size] * 4 ** piece
+        piece *= 2
+    return np.minimum(forward, reverse), valid
+
+
+def build_kmer_table(fasta_path:str, k:int=KMER_SCREEN_LENGTH,
+                     batch_bases:int=FASTA_BUFFER_SIZE * 16) -> np.ndarray:
+    """
+    Mark every k-mer of a fasta in a table of bits
+
+    Records are joined with an N between them into batches, so the k-mers
+    are coded a batch at a time.
+
+    :param fasta_path: The fasta of reference sequences
+    :param k: The k-mer length
+    :param batch_bases: About the most bases to code at once
+    :returns: A uint8 array of 4**k bits, set for k-mers in the fasta
+    """
+    table = np.zeros(max(4 ** k // 8, 1), dtype=np.uint8)
+    batch = []
+    batch_size = 0
+
+    def mark(batch):
+        codes, valid = kmer_codes(b'N'.join(batch), k)
+        codes = np.unique(codes[valid])
+        np.bitwise_or.at(table, codes >> 3,
+                         np.left_shift(1, codes & 7).astype(np.uint8))
+
+    for _, _, seq in read_fasta(fasta_path):
+        batch.append(seq)
+        batch_size += len(seq)
+        if batch_size >= batch_bases:
+            mark(batch)
+            batch = []
+            batch_size = 0
+    if len(batch) > 0:
+        mark(batch)
+    return table
+
+
+def screen_fasta_by_kmers(fasta_path:str, out_path:str, table:np.ndarray,
+                          min_kmers:int, k:int=KMER_SCREEN_LENGTH,
+                          window:int=KMER_SCREEN_WINDOW) -> tuple:
+    """
+    Keep the records with enough k-mers from the table close together
+
+    A record is kept if any window of k-mers holds at least min_kmers that
+    are set in the table. Kept records are copied byte for byte.
+
+    :param fasta_path: The path to an uncompressed fasta
+    :param out_path: Path for the kept records
+    :param table: The table from build_kmer_table
+    :param min_kmers: The fewest k-mers in the table a window must hold
+    :param k: The k-mer length the table was built with
+    :param window: The number of k-mers in each window
+    :returns: The number of bases read and the number kept
+    """
+    bases_in = 0
+    bases_out = 0
+    with open_fasta(fasta_path) as in_file, open(out_path, 'wb') as out_file:
+        for _, record in _iter_fasta_records(in_file, fasta_path):
+            seq = record.partition(b'\n')[2].translate(None, _SEQ_WHITESPACE)
+            bases_in += len(seq)
+            codes, valid = kmer_codes(seq, k)
+            found = valid & ((table[codes >> 3] >> (codes & 7)) & 1 == 1)
+            found = np.r_[0, np.cumsum(found)]
+            span = min(window, len(found) - 1)
+            if len(found) == 1 or \
+               (found[span:] - found[:len(found) - span]).max() < min_kmers:
+                continue
+            bases_out += len(seq)
+            out_file.write(b'>' + record)
+            if not record.endswith(b'\n'):
+                out_file.write(b'\n')
+    return bases_in, bases_out
+
+
+def find_exact_hits(queries:list, targets:list,
+                    seed_length:int=EXACT_SEED_LENGTH,
+                    batch_bases:int=FASTA_BUFFER_SIZE * 16) -> list:
+    """
+    Find the queries that are exact substrings of the targets, on either strand
+
+    The queries are grouped by the length of their seed, their first bases
+    up to seed_length, so short queries don't shorten the seeds of the rest.
+    For each group the k-mers of a batch of targets are coded at once with
+    kmer_codes, which codes both strands the same, and only the positions
+    with the code of a seed are checked in full, as a forward match starting
+    there or a reverse match ending there. Queries with other bases than
+    ACGT in their seed are searched for as plain bytes. Only the first match
+    of a query in a target is kept, forward strand first.
+
+    :param queries: A list of query sequences as bytes
+    :param targets: A list of target sequences as bytes
+    :param seed_length: The most bases to index each query by, at most 31
+    :param batch_bases: About the most target bases to code at once
+    :returns: A list of (query index, target index, 0-based start, reverse)
+        tuples, sorted by query then target, the start is on the forward
+        strand of the target
+    """
+    queries = [i.upper() for i in queries]
+    if len(queries) == 0:
+        return []
+    lengths = np.array([len(i) for i in queries])
+    if lengths.min() == 0:
+        raise ValueError("Exact matches can't be found for empty queries.")
+    targets = [i.upper() for i in targets]
+    batches = np.cumsum([len(i) + 1 for i in targets]) // max(batch_bases, 1)
+    batches = np.split(np.arange(len(targets)),
+                       np.flatnonzero(np.diff(batches)) + 1)
+    seed_lengths = np.minimum(lengths, seed_length)
+    # The first forward start and the last reverse start of each pair
+    forward = {}
+    reverse = {}
+    plain = []
+    for k in np.unique(seed_lengths).tolist():
+        group = np.flatnonzero(seed_lengths == k)
+        # The seeds are joined so they are coded at once
+        seed_codes, valid = kmer_codes(
+            b'N'.join(queries[i][:k] for i in group), k)
+        seed_codes = seed_codes[::k + 1]
+        valid = valid[::k + 1]
+        plain.extend(group[~valid].tolist())
+        group, seed_codes = group[valid], seed_codes[valid]
+        order = np.argsort(seed_codes, kind='stable')
+        seed_codes, group = seed_codes[order], group[order].tolist()
+        # A table of the low bits of the seeds rules out most positions
+        # before the seeds are searched
+        low_bits = (1 << min(2 * k, EXACT_SEED_TABLE_BITS)) - 1
+        seed_table = np.zeros(low_bits + 1, dtype=bool)
+        seed_table[seed_codes & low_bits] = True
+        for batch in batches:
+            if len(group) == 0 or len(batch) == 0:
+                continue
+            offsets = np.r_[0, np.cumsum([len(targets[i]) + 1
+                                          for i in batch])]
+            codes, valid = kmer_codes(
+                b'N'.join(targets[i] for i in batch), k)
+            positions = np.flatnonzero(valid & seed_table[codes & low_bits])
+            first = np.searchsorted(seed_codes, codes[positions], 'left')
+            found = seed_codes[np.minimum(first, len(seed_codes) - 1)] == \
+                codes[positions]
+            positions, first = positions[found], first[found]
+            last = np.searchsorted(seed_codes, codes[positions], 'right')
+            owner = np.searchsorted(offsets, positions, 'right') - 1
+            for pos, target_id, i_first, i_last in zip(
+                    (positions - offsets[owner]).tolist(),
+                    batch[owner].tolist(), first.tolist(), last.tolist()):
+                target = targets[target_id]
+                for i in group[i_first:i_last]:
+                    if target.startswith(queries[i], pos):
+                        forward.setdefault((i, target_id), pos)
+                    start = pos + k - len(queries[i])
+                    if start >= 0 and target[start:start + len(queries[i])] \
+                       .translate(_COMPLEMENT)[::-1] == queries[i]:
+                        reverse[(i, target_id)] = start
+    if len(plain) > 0:
+        reversed_targets = [i.translate(_COMPLEMENT)[::-1] for i in targets]
+        for i in plain:
+            for target_id, target in enumerate(targets):
+                pos = target.find(queries[i])
+                if pos >= 0:
+                    forward[(i, target_id)] = pos
+                    continue
+                pos = reversed_targets[target_id].find(queries[i])
+                if pos >= 0:
+                    reverse[(i, target_id)] = len(target) - pos - \
+                        len(queries[i])
+    hits = {i: (*i, j, False) for i, j in forward.items()}
+    hits.update({i: (*i, j, True) for i, j in reverse.items()
+                 if i not in forward})
+    return [hits[i] for i in sorted(hits)]
+
+
+def window_start_from_description(descriptions:pd.Series) -> pd.Series:
+    """
+    Get the 0-based window starts written by fetch_fasta_windows
+
+    :param descriptions: Fasta descriptions
+    :returns: The window starts, 0 where there is no window
+    """
+    return descriptions.str.extract(r'window=(\d+)-\d+', expand=False)\
+        .fillna(0).astype(int)
+
+
+def fasta_to_df(path, headers=None, descriptions:bool=False):
     """
     Convert a fasta to a dataframe
 
     :param path: A path to a fasta
     :param headers: Optional, headers to read from fasta
+    :param descriptions: If true also keep the header descriptions
     :returns: A dataframe
     """
     if os.stat(path).st_size == 0:
         return pd.DataFrame()
     try:
-        dafr = pd.DataFrame({seq.metadata['id']:[seq.values]
-                             for seq in read_fa(path, format='fasta')})
+        records = {seq_id: (description, seq)
+                   for seq_id, description, seq in read_fasta(path)}
     except ValueError:
         warnings.warn('Some fasta file was not read, posbly it is the wrong'
                       'format.')
         return pd.DataFrame()
-    dafr = dafr.T
-    dafr.reset_index(inplace=True)
-    dafr.columns = ['header', 'seq']
+    if len(records) == 0:
+        return pd.DataFrame()
+    dafr = pd.DataFrame({
+        'header': list(records.keys()),
+        'seq': SeqArray.from_bytes([i[1] for i in records.values()])})
+    if descriptions:
+        dafr['description'] = [i[0] for i in records.values()]
     if headers is not None:
         dafr= dafr.merge(pd.DataFrame({'header': headers}), on='header', how='inner')
     return dafr
@@ -46,75 +680,91 @@ def df_to_fasta(dafr:pd.DataFrame, path:str):
     :param dafr: A dataframe containing 'seq', 'note' and 'header' fields
     :param path: A path to a fasta
     """
-    seqs = (Sequence(x['seq'],
-                     metadata={"id": x["header"],
-                               'description': x["note"]}
-                     )
-            for _, x in dafr.iterrows())
-    write_fa(seqs, 'fasta', path)
-
-
-def merge_duplicate_seqs(data:pd.DataFrame) -> pd.DataFrame:
-    data.sort_values('start')
-    joined = data.iloc[0]
-    if len(data) <= 1:
-        return joined
-    for _, to_join in data.iloc[1:].iterrows():
-        if to_join['start'] > joined['stop']:
-            # raise Warning("Found non-overlapping duplicate in barrnap data")
-            continue
-        trim_point = joined['stop'] - to_join['start']
-        joined['seq'] = np.concatenate([joined['seq'],
-                                        to_join['seq'][trim_point:]])
-        joined['stop'] = to_join['stop']
-        joined['barrnap_header'] = f"{joined['header']}:{joined['start']}-{joined['stop']}"
-    return joined
+    seqs = dafr['seq'].array
+    if isinstance(seqs, SeqArray):
+        seqs = seqs.iter_bytes()
+    write_fasta(zip(dafr['header'], dafr['note'], seqs), path)
 
 
 def get_stage1_mbstats_fasta(mbstats, mbstats_fasta_path):
-    # Get the mbseqs data and add a length column, then make a double index
-    mbseqs = fasta_to_df(mbstats_fasta_path)
-    mbseqs['len'] = mbseqs['seq'].apply(len)
-    mbseqs = mbseqs.reset_index()# sanity check
-    mbseqs.set_index(['header', 'len'], inplace=True)
-    # Set the same ined on the stats
+    """
+    Join the mmseqs or blast stats to the matched sequences and trim them
+
+    The matched sequences may be whole scaffolds or windows around the hits
+    made by fetch_fasta_windows, the stats always use scaffold coordinates.
+
+    :param mbstats: Filtered mmseqs or blast statistics
+    :param mbstats_fasta_path: Path to the matched scaffolds or windows
+    :returns: The stats with the trimmed 'seq' of each hit
+    """
+    mbseqs = fasta_to_df(mbstats_fasta_path, descriptions=True)
+    mbseqs['window_start'] = window_start_from_description(
+        mbseqs['description'])
+    mbseqs = mbseqs[['header', 'seq', 'window_start']].rename(
+        columns={'header': 'sseqid'})
     mbstats = mbstats.reset_index() # sanity check
-    mbstats.set_index(['sseqid', 'slen'], inplace=True)
-    mbseqs.index.names = ['sseqid', 'slen']
     # join the data
-    mbdata = pd.merge(mbseqs,
-                       mbstats, 
-                       left_index=True,
-                       right_index=True,
-                       how='inner')
-    mbdata.reset_index(inplace=True)
+    mbdata = pd.merge(mbseqs, mbstats, on='sseqid', how='inner')
     mbdata = process_mbdata(mbdata)
     return mbdata
 
 
 def process_barfasta(data:pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge the overlapping barrnap fragments found on each scaffold
+
+    The fragments are sorted by scaffold and start, and swept in one pass: a
+    fragment is joined to the one before it if it starts before the furthest
+    stop seen so far on that scaffold, and only the part past that stop is
+    added. Fragments after the first gap on a scaffold are dropped.
+
+    :param data: The barrnap sequences, with 'header' like scaffold:start-stop
+    :returns: One merged sequence per scaffold
+    """
     data.rename(columns={'header': 'barrnap_header'}, inplace=True)
     data[['header', 'start']] = \
         data['barrnap_header'].str.split(':', expand=True)
     data[['start', 'stop']] = data['start'].str.split('-', expand=True)
     data[['start', 'stop']] = data[['start', 'stop']].astype(int)
-    data = data.groupby('header').apply(merge_duplicate_seqs).\
-        reset_index(drop=True)
+    seq_array = isinstance(data['seq'].array, SeqArray)
+    data = data.sort_values(['header', 'start'], kind='stable')
+    by_header = data.groupby('header', sort=False)
+    reach = by_header['stop'].cummax()
+    last_reach = reach.groupby(data['header'], sort=False).shift().\
+        fillna(data['start']).astype(int)
+    gaps = (data['start'] > last_reach).groupby(data['header'],
+                                                sort=False).cumsum()
+    keep = (gaps == 0).to_numpy()
+    data, last_reach = data[keep], last_reach[keep]
+    seqs = as_seq_array(data['seq'])
+    pieces = seqs.subseq((last_reach - data['start']).clip(lower=0),
+                         seqs.lengths())
+    merged = data.groupby('header', sort=False).agg(
+        start=('start', 'first'), stop=('stop', 'max')).reset_index()
+    merged['barrnap_header'] = merged['header'] + ':' + \
+        merged['start'].astype(str) + '-' + merged['stop'].astype(str)
+    merged['seq'] = pieces.join_runs(data['header'].to_numpy())
+    if not seq_array:
+        merged['seq'] = [np.array(list(i.decode())) for i in
+                         merged['seq'].array.iter_bytes()]
+    data = merged[['barrnap_header', 'seq', 'header', 'start', 'stop']]
     # extra assert statement to cover by back
     assert sum(
         (data['stop'] - data['start']) != data['seq'].apply(len)) == 0, \
         "The length of the sequence dose not match the size from the indexes."
     return data
 
-def read_mbstats(stats_path:str) -> pd.DataFrame:
+def read_mbstats(stats_path:str, chunksize:int=None):
     """
     Read the tab delimited mmseqs or blast file with its very specific format.
 
     :param stats_path: The path to the formatted statistics
-    :returns: A dataframe with proper format
+    :param chunksize: Optional, read the file this many rows at a time
+    :returns: A dataframe with proper format, or an iterator of dataframes
+        if chunksize is given
     """
     stats = pd.read_csv(stats_path, header=None, sep='\t',
-                        names=MBSTATS_NAMES)
+                        names=MBSTATS_NAMES, chunksize=chunksize)
     return stats
 
 
@@ -138,10 +788,16 @@ def process_mbdata(data:pd.DataFrame, headers=None) -> pd.DataFrame:
     if headers is not None:
         data = pd.merge(data, pd.DataFrame({
             'sseqid': list(headers)}), on='sseqid')
-    data['seq'] = data.apply(
-        lambda x: x["seq"][x["sstart"] - 1:x["send"]]
-        if x["sstart"] < x["send"]
-        else x["seq"][::-1][x["send"] - 1:x["sstart"]], axis=1)
+    window_start = data['window_start'].to_numpy() \
+        if 'window_start' in data.columns else 0
+    sstart = data['sstart'].to_numpy() - window_start
+    send = data['send'].to_numpy() - window_start
+    # The hit is on the minus strand if sstart > send, either way cut out
+    # the hit and give it on the strand of the query
+    reverse = sstart >= send
+    data['seq'] = as_seq_array(data['seq']).subseq(
+        np.minimum(sstart, send) - 1, np.maximum(sstart, send)).\
+        reverse_complement(reverse)
     return data
 
 
@@ -160,21 +816,20 @@ def combine_fasta(mbstats:pd.DataFrame, barrnap:pd.DataFrame,
     data[['mbseqs', 'barseqs']] = data[['mbseqs', 'barseqs']].fillna(False)
     data.rename(columns={'seq_x': 'seq_bar', 'seq_y': 'seq_other'},
                 inplace=True)
-    def select_and_describe_seq(x):
-        if ['barseqs'] and not x['mbseqs']:
-            return x['seq_bar'], 'Barnnap'
-        elif x['mbseqs'] and not x['barseqs']:
-            return x['seq_other'], search_tool
-        elif len(x['seq_bar']) > len(x['seq_other']):
-            return x['seq_bar'], f'Barnnap>{search_tool}'
-        elif len(x['seq_bar']) < len(x['seq_other']):
-            return x['seq_bar'], f'{search_tool}>Barnnap'
-        elif len(x['seq_bar']) == len(x['seq_other']):
-            return x['seq_bar'], f'{search_tool}=Barnnap'
-        else:
-            raise Exception("Non equal duplicates in barseqs, and mbseqs")
-
-    data[['seq', 'note']] = data.apply(select_and_describe_seq, axis=1, result_type='expand')
+    # NOTE barseqs is treated as true even if only mbseqs is found, and the
+    #      barrnap sequence is kept whenever both tools found the scaffold
+    only_mbseqs = (data['mbseqs'] & ~data['barseqs']).to_numpy()
+    seq_bar = as_seq_array(data['seq_bar'])
+    seq_other = as_seq_array(data['seq_other'])
+    bar_len = seq_bar.lengths()
+    other_len = seq_other.lengths()
+    data['seq'] = seq_other.where(only_mbseqs, seq_bar)
+    data['note'] = np.select(
+        [~data['mbseqs'].to_numpy(), only_mbseqs, bar_len > other_len,
+         bar_len < other_len],
+        ['Barnnap', search_tool, f'Barnnap>{search_tool}',
+         f'{search_tool}>Barnnap'],
+        f'{search_tool}=Barnnap')
     print("After Merge: \n"
          f" There are {sum(data['barseqs'])} Sequences found by Barrnap.\n"
          f" There are {sum(data['mbseqs'])} Sequences found by"
@@ -187,12 +842,57 @@ def combine_fasta(mbstats:pd.DataFrame, barrnap:pd.DataFrame,
 
 
 
-def filter_mdstats(data, min_pct_id:float=None, min_length:int=None,
-                   min_len_pct:float=None, max_gaps:int=None,
-                   max_missmatch:int=None, min_len_with_overlap:int=None,
-                   min_len_pct_no_overlap:float=None, end_buffer_length:int=5):
+def check_overlap_mask(data:pd.DataFrame,
+                       end_buffer_length:int=5) -> np.ndarray:
     """
-    Creates and then applies a filter for mmseqs or blast statistics
+    Column wise check that a match overlaps the ends of the query and subject
+
+    Conditions for True
+    qseq reversed      qstart included sstart included
+                       qend included   send included
+    qseq not reversed qstart included  send included
+                      qend included    sstart included
+
+    NOTE sseq cant be reversed
+
+    :param data: Data in a computable blast style format
+    :param end_buffer_length: The distance from an end that still counts as
+        reaching that end
+    :returns: A boolean array with one value per row
+    :raises ValueError: If a subject that must be checked is reversed
+    """
+    ebl = end_buffer_length
+    length = data['length'].to_numpy()
+    qlen = data['qlen'].to_numpy()
+    slen = data['slen'].to_numpy()
+    qstart = data['qstart'].to_numpy()
+    qend = data['qend'].to_numpy()
+    sstart = data['sstart'].to_numpy()
+    send = data['send'].to_numpy()
+    # NOTE is this exceptionable
+    full_length = (np.abs(length - qlen) <= 2*ebl) | \
+        (np.abs(length - slen) <= 2*ebl) | (qlen == slen)
+    if np.any(~full_length & (sstart > send)):
+        raise ValueError("The search sequences cant be reversed."
+                         " Your data may be corrupt")
+    q_reversed = qstart > qend
+    reversed_ends = \
+        ((np.abs(qstart - qlen) <= ebl) & (np.abs(send - slen) <= ebl)) | \
+        ((qend <= ebl) & (sstart <= ebl))
+    forward_ends = \
+        ((qstart <= ebl) & (np.abs(send - slen) <= ebl)) | \
+        ((np.abs(qend - qlen) <= ebl) & (sstart <= ebl))
+    return full_length | np.where(q_reversed, reversed_ends, forward_ends)
+
+
+def get_mdstats_masks(data:pd.DataFrame, min_pct_id:float=None,
+                      min_length:int=None, min_len_pct:float=None,
+                      max_gaps:int=None, max_missmatch:int=None,
+                      min_len_with_overlap:int=None,
+                      min_len_pct_no_overlap:float=None,
+                      end_buffer_length:int=5) -> dict:
+    """
+    Evaluate each of the mmseqs or blast filters as a column wise mask
 
     :param data: Data to be filter must be in a computable blast style format
     :param min_pct_id: Optional filter
@@ -200,66 +900,71 @@ def filter_mdstats(data, min_pct_id:float=None, min_length:int=None,
     :param min_len_pct: Optional filter
     :param max_gaps: Optional filter
     :param max_missmatch: Optional filter
-    :returns: Filtered data
-    #TODO look more at annotat_vgfs get_gene order
+    :param min_len_with_overlap: Optional filter, used with
+        min_len_pct_no_overlap
+    :param min_len_pct_no_overlap: Optional filter, used with
+        min_len_with_overlap
+    :param end_buffer_length: Slack allowed when checking for overlap
+    :returns: A dict of filter names to boolean arrays, True rows pass
     """
-    def check_overlap(x:pd.Series) -> bool:
-        """
-        Conditions for True
-        qseq reversed      qstart included sstart included
-                           qend included   send included
-        qseq not reversed qstart included  send included
-                          qend included    sstart included
-
-        NOTE sseq cant be reversed
-        """
-        ebl = end_buffer_length
-        # NOTE is this exceptionable
-        if abs(x['length']- x['qlen']) <= 2*ebl or \
-            abs(x['length']- x['slen']) <= 2*ebl:
-            return True
-        if x['qlen'] == x['slen']:
-            return True
-        if x['sstart'] > x['send']:
-            breakpoint()
-            raise ValueError("The search sequences cant be reversed."
-                             " Your data may be corrupt")
-        if x['qstart'] > x['qend']:# q is reversed
-            if (abs(x['qstart'] - x['qlen']) <= ebl) \
-                and (abs(x['send'] - x['slen']) <= ebl):
-                return True
-            if (x['qend'] <= ebl) and (x['sstart'] <= ebl):
-                return True
-        else:# q is not reversed
-            if (x['qstart'] <= ebl) and (abs(x['send'] - x['slen']) <= ebl):
-                return True
-            if (abs(x['qend'] - x['qlen']) <= ebl) and (x['sstart'] <= ebl):
-                return True
-        return False
-    data_checks = []
+    masks = {}
     if max_gaps is not None:
-        data_checks.append(lambda x: x['gapopen'] <= max_gaps)
+        masks['max_gaps'] = (data['gapopen'] <= max_gaps).to_numpy()
     if max_missmatch is not None:
-        data_checks.append(lambda x: x['mismatch'] <= max_missmatch)
+        masks['max_missmatch'] = (data['mismatch'] <= max_missmatch).to_numpy()
     if min_length is not None:
-        data_checks.append(lambda x: x['length'] >= min_length)
+        masks['min_length'] = (data['length'] >= min_length).to_numpy()
     if min_pct_id is not None:
-        data_checks.append(lambda x: x['pident'] >= min_pct_id)
+        masks['min_pct_id'] = (data['pident'] >= min_pct_id).to_numpy()
     if min_len_pct is not None:
-        data_checks.append(lambda x:
-    # TODO check that qlen should not be slen
-            ((x['length'] / x['qlen']) * 100) >= min_len_pct)
+        # TODO check that qlen should not be slen
+        masks['min_len_pct'] = \
+            (((data['length'] / data['qlen']) * 100) >= min_len_pct).to_numpy()
     # NOTE MIN_SLEN_LENGTH = 1000
     if min_len_with_overlap is not None and \
-       min_len_pct_no_overlap is not None:
-        data_checks.append(lambda x:
-            (check_overlap(x) & \
-             (x['length'] >= min_len_with_overlap)) | \
-            ((x['pident'] >= min_len_pct_no_overlap) & \
-             (x['length'] >= min_len_with_overlap)))
-    return data[data.apply(
-        lambda x: all([l(x) for l in data_checks]),
-        axis=1)]
+       min_len_pct_no_overlap is not None and len(data) > 0:
+        long_enough = (data['length'] >= min_len_with_overlap).to_numpy()
+        masks['overlap'] = long_enough & (
+            check_overlap_mask(data, end_buffer_length) |
+            (data['pident'] >= min_len_pct_no_overlap).to_numpy())
+    return masks
+
+
+def filter_mdstats(data, min_pct_id:float=None, min_length:int=None,
+                   min_len_pct:float=None, max_gaps:int=None,
+                   max_missmatch:int=None, min_len_with_overlap:int=None,
+                   min_len_pct_no_overlap:float=None, end_buffer_length:int=5,
+                   report:bool=False):
+    """
+    Creates and then applies a filter for mmseqs or blast statistics
+
+    All the filters are evaluated over whole columns, see get_mdstats_masks.
+
+    :param data: Data to be filter must be in a computable blast style format
+    :param min_pct_id: Optional filter
+    :param min_length: Optional filter
+    :param min_len_pct: Optional filter
+    :param max_gaps: Optional filter
+    :param max_missmatch: Optional filter
+    :param report: If true print how many rows each filter removed
+    :returns: Filtered data
+    #TODO look more at annotat_vgfs get_gene order
+    """
+    masks = get_mdstats_masks(data, min_pct_id=min_pct_id,
+                              min_length=min_length, min_len_pct=min_len_pct,
+                              max_gaps=max_gaps, max_missmatch=max_missmatch,
+                              min_len_with_overlap=min_len_with_overlap,
+                              min_len_pct_no_overlap=min_len_pct_no_overlap,
+                              end_buffer_length=end_buffer_length)
+    keep = np.ones(len(data), dtype=bool)
+    for mask in masks.values():
+        keep &= mask
+    if report:
+        print(f"Filtering {len(data)} hits:\n" +
+              "".join(f" {name} removed {int((~mask).sum())} hits\n"
+                      for name, mask in masks.items()) +
+              f" {int(keep.sum())} hits passed all filters\n")
+    return data[keep]
 
 
 def barstats_reformat(barstats_corrected:pd.DataFrame,
@@ -335,7 +1040,5 @@ def filter_fasta_from_headers(in_fasta_path:str, out_fasta_path:str, headers):
     :param headers: Headers to filter by
     """
     headers = set(headers)
-    write_fa((seq for seq in read_fa(in_fasta_path, format='fasta')
-              if seq.metadata['id'] in headers),
-             'fasta', out_fasta_path)
-
+    write_fasta((seq for seq in read_fasta(in_fasta_path)
+                 if seq[0] in headers), out_fasta_path)
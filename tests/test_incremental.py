@@ -0,0 +1,151 @@
+import os
+import pandas as pd
+from join_asvbins.incremental import prepare_incremental_run, \
+    add_shared_bins, finish_incremental_run, get_settings_key, read_manifest, \
+    rescale_stats_evalues, merge_outputs, order_match_stats
+from join_asvbins.utils import read_fasta
+
+
+def write_bin(bins_dir, name, scaffolds):
+    with open(os.path.join(bins_dir, name), 'w') as out:
+        for i in scaffolds:
+            out.write(f">{i}\nACGT{i}\n")
+
+
+def fake_scaffold_map(run):
+    """Write the scaffold map of the bins in the run like the pipeline"""
+    bins = sorted(os.listdir(run['bins_dir']))
+    pd.DataFrame([(j[0], i, len(j[2])) for i in bins for j in read_fasta(
+        os.path.join(run['bins_dir'], i))],
+        columns=['header', 'bin', 'length']).to_csv(
+        os.path.join(run['run_dir'], 'bins_scaffolds.tsv'), sep='\t',
+        index=False)
+
+
+def fake_outputs(run):
+    """Write candidate outputs with one row for each scaffold in the run"""
+    fake_scaffold_map(run)
+    assert not add_shared_bins(run)
+    scaffolds = [j for i in sorted(run['new_bins'])
+                 for j in run['new_bins'][i]['scaffolds']]
+    with open(os.path.join(run['run_dir'], 'candidate_sequences.fna'),
+              'w') as out:
+        for i in scaffolds:
+            out.write(f">{i} mmseqs\nACGT\n")
+    pd.DataFrame({'bin_scaffold_header': scaffolds,
+                  'evalue': ['NA'] * len(scaffolds)}).to_csv(
+        os.path.join(run['run_dir'], 'candidate_statistics.tsv'), sep='\t',
+        index=False)
+
+
+def output_scaffolds(output_dir):
+    stats = pd.read_csv(os.path.join(output_dir, 'candidate_statistics.tsv'),
+                        sep='\t', keep_default_na=False)
+    assert list(stats['evalue']) == ['NA'] * len(stats)
+    fasta = [i[0] for i in read_fasta(
+        os.path.join(output_dir, 'candidate_sequences.fna'))]
+    assert fasta == list(stats['bin_scaffold_header'])
+    return set(fasta)
+
+
+def test_incremental_run(tmp_path):
+    """Test only new and changed bins are run, and outputs are merged"""
+    bins_dir = tmp_path / 'bins'
+    output_dir = str(tmp_path / 'output')
+    bins_dir.mkdir()
+    os.makedirs(output_dir)
+    write_bin(bins_dir, 'a.fa', ['a_1', 'a_2'])
+    write_bin(bins_dir, 'b.fa', ['b_1'])
+    write_bin(bins_dir, 'c.fa', ['c_1'])
+    run = prepare_incremental_run(str(bins_dir), output_dir, 'fa', 'key')
+    assert sorted(os.listdir(run['bins_dir'])) == ['a.fa', 'b.fa', 'c.fa']
+    fake_outputs(run)
+    finish_incremental_run(run, output_dir)
+    assert not os.path.exists(run['run_dir'])
+    assert output_scaffolds(output_dir) == {'a_1', 'a_2', 'b_1', 'c_1'}
+    # change b, remove c, add d
+    write_bin(bins_dir, 'b.fa', ['b_1', 'b_2'])
+    os.remove(bins_dir / 'c.fa')
+    write_bin(bins_dir, 'd.fa', ['d_1'])
+    run = prepare_incremental_run(str(bins_dir), output_dir, 'fa', 'key')
+    assert sorted(os.listdir(run['bins_dir'])) == ['b.fa', 'd.fa']
+    assert run['dropped_scaffolds'] == {'b_1', 'c_1'}
+    fake_outputs(run)
+    finish_incremental_run(run, output_dir)
+    assert output_scaffolds(output_dir) == {'a_1', 'a_2', 'b_1', 'b_2', 'd_1'}
+    assert sorted(read_manifest(output_dir)['bins']) == ['a.fa', 'b.fa',
+                                                         'd.fa']
+    # nothing to do
+    run = prepare_incremental_run(str(bins_dir), output_dir, 'fa', 'key')
+    assert os.listdir(run['bins_dir']) == []
+    finish_incremental_run(run, output_dir)
+    assert output_scaffolds(output_dir) == {'a_1', 'a_2', 'b_1', 'b_2', 'd_1'}
+    # a new bin shares a scaffold name so the old bin is run again
+    write_bin(bins_dir, 'e.fa', ['a_2'])
+    run = prepare_incremental_run(str(bins_dir), output_dir, 'fa', 'key')
+    assert sorted(os.listdir(run['bins_dir'])) == ['e.fa']
+    fake_scaffold_map(run)
+    assert add_shared_bins(run)
+    assert sorted(os.listdir(run['bins_dir'])) == ['a.fa', 'e.fa']
+    assert run['dropped_scaffolds'] == {'a_1', 'a_2'}
+    fake_outputs(run)
+    finish_incremental_run(run, output_dir)
+    assert output_scaffolds(output_dir) == {'a_1', 'a_2', 'b_1', 'b_2',
+                                            'd_1'}
+    assert read_manifest(output_dir)['bins']['e.fa'] == {
+        'sha256': run['new_bins']['e.fa']['sha256'], 'scaffolds': ['a_2'],
+        'bases': 7}
+    # new settings run everything
+    run = prepare_incremental_run(str(bins_dir), output_dir, 'fa', 'other')
+    assert len(os.listdir(run['bins_dir'])) == 4
+    assert not run['keep_old']
+
+
+def test_get_settings_key(tmp_path):
+    """Test the settings key ignores settings that don't change outputs"""
+    asvs = tmp_path / 'asvs.fa'
+    asvs.write_text(">a\nACGT\n")
+    config = {'asv_seqs': str(asvs), 'bins': 'one', 's2_min_pct_id': 0.9}
+    key = get_settings_key(config)
+    assert key == get_settings_key(dict(config, bins='two', verbosity=5))
+    # sharding can change the hits kept for each query
+    assert key != get_settings_key(dict(config, s1_shards=4))
+    assert key != get_settings_key(dict(config, s2_min_pct_id=0.8))
+    asvs.write_text(">a\nACGA\n")
+    assert key != get_settings_key(config)
+
+
+def test_rescale_stats_evalues():
+    """Test e-values are scaled and rows with none or 0 are kept as is"""
+    stats = pd.DataFrame({'bin_scaffold_header': ['a', 'b', 'c', 'd'],
+                          'evalue': ['1e-10', 'NA', '2.5e-3', '0.0']})
+    assert rescale_stats_evalues(stats, 1) is stats
+    scaled = rescale_stats_evalues(stats, 4)
+    assert list(scaled['evalue']) == ['4e-10', 'NA', '0.01', '0.0']
+    assert list(stats['evalue']) == ['1e-10', 'NA', '2.5e-3', '0.0']
+
+
+def test_merge_outputs_order(tmp_path):
+    """Test old rows are kept as text and rows are ordered as a full run"""
+    old_dir, new_dir = tmp_path / 'old', tmp_path / 'new'
+    old_dir.mkdir()
+    new_dir.mkdir()
+    queries = tmp_path / 'queries.fa'
+    queries.write_text(">q1\nACGT\n>q2\nACGT\n")
+    for folder, rows in ((old_dir, [('q2', 'b_1', '2.000E-10', '50')]),
+                         (new_dir, [('q1', 'a_1', '1e-10', '50'),
+                                    ('q2', 'c_1', '0.0', '90')])):
+        with open(folder / 'match.fna', 'w') as out:
+            for i in sorted(rows, key=lambda i: i[1], reverse=True):
+                out.write(f">{i[1]}\nACGT\n")
+        pd.DataFrame(rows, columns=['ASV_header', 'bin_scaffold_header',
+                                    'evalue', 'bitscore']).to_csv(
+            folder / 'match.tsv', sep='\t', index=False)
+    merge_outputs(str(old_dir), str(new_dir), 'match.fna', 'match.tsv',
+                  set(), True, 2,
+                  lambda i: order_match_stats(i, str(queries)))
+    stats = pd.read_csv(old_dir / 'match.tsv', sep='\t', dtype=str)
+    assert list(stats['bin_scaffold_header']) == ['a_1', 'c_1', 'b_1']
+    assert list(stats['evalue']) == ['2e-10', '0.0', '2.000E-10']
+    assert [i[0] for i in read_fasta(str(old_dir / 'match.fna'))] == [
+        'a_1', 'b_1', 'c_1']
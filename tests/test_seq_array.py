@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from join_asvbins.seq_array import SeqArray, as_seq_array
+
+
+def to_list(seqs:SeqArray) -> list:
+    return [None if i is None else i.decode() for i in seqs.iter_bytes()]
+
+
+def test_seq_array_items():
+    """Test SeqArray gives the same items as arrays of S1"""
+    seqs = SeqArray.from_bytes([b'ACGT', None, b'', b'GG'])
+    assert len(seqs) == 4
+    assert list(seqs.isna()) == [False, True, False, False]
+    assert list(seqs.lengths()) == [4, 0, 0, 2]
+    assert seqs[0].dtype == np.dtype('S1')
+    assert seqs[0].tobytes() == b'ACGT'
+    assert pd.isna(seqs[1])
+    assert to_list(seqs[[3, 0]]) == ['GG', 'ACGT']
+    assert list(seqs == b'GG') == [False, False, False, True]
+    assert list(pd.Series(seqs[[0, 0]]).apply(len)) == [4, 4]
+
+
+def test_seq_array_in_dataframe():
+    """Test SeqArray columns survive sorting and merging"""
+    data = pd.DataFrame({'header': ['a', 'b', 'c'],
+                         'seq': SeqArray.from_bytes([b'A', b'CC', b'GGG'])})
+    other = pd.DataFrame({'header': ['c', 'd', 'a'],
+                          'seq': as_seq_array(['TTTT', 'T', list('AA')])})
+    merged = pd.merge(data, other, on='header', how='outer')
+    assert isinstance(merged['seq_x'].array, SeqArray)
+    assert to_list(merged['seq_x'].array) == ['A', 'CC', 'GGG', None]
+    assert to_list(merged['seq_y'].array) == ['AA', None, 'TTTT', 'T']
+    stacked = pd.concat([data, other]).sort_values('header')
+    assert to_list(stacked['seq'].array) == ['A', 'AA', 'CC', 'GGG', 'TTTT',
+                                             'T']
+    assert list(stacked['seq'].apply(len)) == [1, 2, 2, 3, 4, 1]
+
+
+def test_seq_array_subseq_reverse_where():
+    """Test the vectorized sequence operations"""
+    seqs = SeqArray.from_bytes([b'ABCDEF', b'GHIJ', None, b'KLM'])
+    pieces = seqs.subseq([1, 0, 0, 2], [4, 10, 1, 3])
+    assert to_list(pieces) == ['BCD', 'GHIJ', None, 'M']
+    flipped = pieces.reverse(np.array([True, False, True, True]))
+    assert to_list(flipped) == ['DCB', 'GHIJ', None, 'M']
+    assert len(flipped._buffer) == 8
+    other = SeqArray.from_bytes([b'x', b'y', b'z', b'w'])
+    assert to_list(seqs.where([True, False, False, True], other)) == \
+        ['ABCDEF', 'y', 'z', 'KLM']
+    compact = seqs[[3]].copy()
+    assert to_list(compact) == ['KLM']
+    assert len(compact._buffer) == 3
+    complement = SeqArray.from_bytes([b'AACG', None, b'TTGU']).\
+        reverse_complement([True, True, False])
+    assert to_list(complement) == ['CGTT', None, 'TTGU']
+    joined = seqs.join_runs(['a', 'a', 'b', 'b'])
+    assert to_list(joined) == ['ABCDEFGHIJ', 'KLM']
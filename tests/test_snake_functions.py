@@ -1,10 +1,19 @@
+import os
+import json
 import random
 from itertools import combinations
 import pytest
 import pandas as pd
 from pathlib import Path
-from join_asvbins.snake_functions import combine_mbstats_barrnap
-from join_asvbins.utils import MBSTATS_NAMES
+from join_asvbins.snake_functions import combine_mbstats_barrnap, \
+    filter_from_mbstats, resolve_dup_gene_locs, reference_cache_key, \
+    index_bins_file, \
+    gather_stage1_shards, gather_barrnap_shards, run_blastn, \
+    allocate_stage1_threads, exact_stage2_prepass, read_exact_queries, \
+    dereplicate_fasta, expand_dereplicated_hits, split_adaptive_queries, \
+    merge_adaptive_passes, extract_barrnap_16s, run_report_path, \
+    time_run_block, write_run_report
+from join_asvbins.utils import MBSTATS_NAMES, read_fasta, build_fasta_index
 
 # TODO Enable stats for howmayn bins had finds and how many 16s where founds STAGE 1
 # TODO Enable stats for how many matches where founds STAGE 1
@@ -34,6 +43,23 @@ def test_combine_mbstats_barrnap_all_empty(tmp_path):
         combine_mbstats_barrnap(**arguments)
 
 
+def test_resolve_dup_gene_locs():
+    """Test each hit is checked against every kept locus on its scaffold"""
+    stats = pd.DataFrame({
+        'sseqid': ['a', 'a', 'a', 'a', 'a', 'b'],
+        'sstart': [100, 900, 500, 150, 1200, 150],
+        'send':   [200, 1000, 600, 50, 1300, 50],
+        'bitscore': [90, 80, 70, 60, 10, 5]})
+    kept = resolve_dup_gene_locs(stats, bs_name='sseqid', bs_start='send',
+                                 bs_end='sstart', values='bitscore',
+                                 ascending=False)
+    assert list(kept.index) == [0, 1, 2, 4, 5]
+    kept = resolve_dup_gene_locs(stats, bs_name='sseqid', bs_start='send',
+                                 bs_end='sstart', values='bitscore',
+                                 ascending=True)
+    assert list(kept.index) == [5, 4, 3, 2, 1]
+
+
 @pytest.fixture(scope="session")
 def temp_fasta_protien_10(tmpdir_factory):
     """Creates a fake protein file"""
@@ -107,3 +133,310 @@ def test_barrnap_empty_combine_mbstats_barrnap_all(tmp_path):
                        header=False)
     with pytest.raises(ValueError, match=r'.*no hits*.') as e_info:
         combine_mbstats_barrnap(**arguments, min_length=100)
+
+
+def test_filter_from_mbstats_chunked(tmp_path):
+    """Test filter_from_mbstats gives the same output when streaming"""
+    candidates = tmp_path / 'candidates.fna'
+    candidates.write_text(">a\nACGT\n>b\nGGCC\n>c\nTTAA\n")
+    stats = pd.DataFrame({i:[1, 1, 1, 1, 1] for i in MBSTATS_NAMES})
+    stats['qseqid'] = ['q1', 'q2', 'q3', 'q4', 'q5']
+    stats['sseqid'] = ['a', 'b', 'a', 'c', 'b']
+    stats['length'] = [300, 100, 300, 300, 300]
+    stats_path = tmp_path / 'stats.tab'
+    stats.to_csv(stats_path, index=False, sep='\t', header=False)
+    outputs = {}
+    for chunksize in [None, 2]:
+        fasta_out = tmp_path / f'match_{chunksize}.fna'
+        stats_out = tmp_path / f'match_{chunksize}.tsv'
+        filter_from_mbstats(str(stats_path), str(candidates), str(fasta_out),
+                            str(stats_out), 'mmseqs', chunksize=chunksize,
+                            min_length=250)
+        outputs[chunksize] = (pd.read_csv(stats_out, sep='\t'),
+                              fasta_out.read_text())
+    pd.testing.assert_frame_equal(outputs[None][0], outputs[2][0])
+    assert outputs[None][1] == outputs[2][1]
+    assert list(outputs[2][0]['ASV_header']) == ['q1', 'q3', 'q4', 'q5']
+
+
+def test_reference_cache_key(tmp_path):
+    """Test the cache key follows the content and the tool version"""
+    first = tmp_path / 'first.fa'
+    second = tmp_path / 'second.fa'
+    first.write_text(">a\nACGT\n")
+    second.write_text(">a\nACGT\n")
+    key = reference_cache_key(str(first), '15.6f452')
+    assert key == reference_cache_key(str(second), '15.6f452')
+    assert key != reference_cache_key(str(first), '14.7e284')
+    second.write_text(">a\nACGA\n")
+    assert key != reference_cache_key(str(second), '15.6f452')
+
+
+def test_index_bins_file(tmp_path):
+    """Test the bins index is cached by content and reused"""
+    bins = tmp_path / 'bins.fa'
+    bins.write_text(">a\nACGT\n>b\nGGCC\n")
+    cache = tmp_path / 'cache'
+    index_bins_file(str(bins), str(tmp_path / 'plain.tsv'))
+    index_bins_file(str(bins), str(tmp_path / 'first.tsv'), str(cache))
+    assert (tmp_path / 'first.tsv').read_text() == \
+        (tmp_path / 'plain.tsv').read_text()
+    cached = list(cache.iterdir())
+    assert len(cached) == 1
+    # A changed cached index shows it was used, not rebuilt
+    cached[0].write_text("a\t4\t3\t4\t5\t4\n")
+    index_bins_file(str(bins), str(tmp_path / 'second.tsv'), str(cache))
+    assert (tmp_path / 'second.tsv').read_text() == "a\t4\t3\t4\t5\t4\n"
+    bins.write_text(">a\nACGT\n")
+    index_bins_file(str(bins), str(tmp_path / 'third.tsv'), str(cache))
+    assert len(list(cache.iterdir())) == 2
+
+
+def test_gather_stage1_shards(tmp_path):
+    """Test shard hits are ordered by query and score and e-values scaled"""
+    query = tmp_path / 'query.fa'
+    query.write_text(">q2\nACGT\n>q1\nACGT\n")
+    sizes = tmp_path / 'sizes.tsv'
+    pd.DataFrame({'shard': ['s0', 's1'], 'bases': [300, 100]}).to_csv(
+        sizes, sep='\t', index=False)
+    row = "\t99.5\t100\t0\t0\t1\t100\t1\t100\t{}\t{}\t100\t100\n"
+    (tmp_path / '0.tab').write_text(
+        "q1\tt1" + row.format('1e-10', 90) +
+        "q2\tt2" + row.format('1e-4', 50))
+    (tmp_path / '1.tab').write_text(
+        "q1\tt3" + row.format('2e-10', 95) +
+        "q2\tt4" + row.format('3e-4', 40))
+    (tmp_path / '2.tab').write_text("")
+    out = tmp_path / 'out.tab'
+    gather_stage1_shards([str(tmp_path / f'{i}.tab') for i in range(3)],
+                         str(out), str(query), sizes_path=str(sizes),
+                         shard_paths=['s0', 's1', 's2'], max_evalue=1e-3)
+    hits = pd.read_csv(out, sep='\t', header=None, names=MBSTATS_NAMES)
+    assert list(hits['sseqid']) == ['t2', 't3', 't1']
+    assert list(hits['evalue']) == pytest.approx([1.333e-4, 8e-10,
+                                                  1.333e-10], rel=1e-3)
+
+
+def test_gather_stage1_shards_ties(tmp_path):
+    """Test tied hits are ordered by target and the target limit applied"""
+    query = tmp_path / 'query.fa'
+    query.write_text(">q1\nACGT\n")
+    row = "\t99.5\t100\t0\t0\t1\t100\t{}\t{}\t1e-10\t{}\t100\t100\n"
+    (tmp_path / '0.tab').write_text(
+        "q1\tt2" + row.format(1, 100, 90) +
+        "q1\tt2" + row.format(500, 600, 60))
+    (tmp_path / '1.tab').write_text(
+        "q1\tt1" + row.format(50, 150, 90) +
+        "q1\tt1" + row.format(1, 100, 90) +
+        "q1\tt3" + row.format(1, 100, 70))
+    tabs = [str(tmp_path / f'{i}.tab') for i in range(2)]
+    out = tmp_path / 'out.tab'
+    for order in (tabs, tabs[::-1]):
+        gather_stage1_shards(order, str(out), str(query))
+        hits = pd.read_csv(out, sep='\t', header=None, names=MBSTATS_NAMES)
+        assert list(zip(hits['sseqid'], hits['sstart'])) == [
+            ('t1', 1), ('t1', 50), ('t2', 1), ('t3', 1), ('t2', 500)]
+    gather_stage1_shards(tabs, str(out), str(query), max_targets=2)
+    hits = pd.read_csv(out, sep='\t', header=None, names=MBSTATS_NAMES)
+    assert list(zip(hits['sseqid'], hits['sstart'])) == [
+        ('t1', 1), ('t1', 50), ('t2', 1), ('t2', 500)]
+
+
+def test_gather_barrnap_shards(tmp_path):
+    """Test the shard gff files are merged in scaffold and start order"""
+    feature = "{}\tbarrnap:0.9\trRNA\t{}\t{}\t0\t+\t.\tName=16S_rRNA\n"
+    (tmp_path / '0.gff').write_text(
+        "##gff-version 3\n" + feature.format('s2', 500, 2000) +
+        feature.format('s3', 10, 1500))
+    (tmp_path / '1.gff').write_text(
+        "##gff-version 3\n" + feature.format('s1', 90, 1600) +
+        feature.format('s2', 40, 450))
+    (tmp_path / '2.gff').write_text("")
+    out = tmp_path / 'out.gff'
+    gather_barrnap_shards([str(tmp_path / f'{i}.gff') for i in range(3)],
+                          str(out))
+    assert out.read_text() == "##gff-version 3\n" + \
+        feature.format('s1', 90, 1600) + feature.format('s2', 40, 450) + \
+        feature.format('s2', 500, 2000) + feature.format('s3', 10, 1500)
+
+
+def test_run_blastn_chunks(tmp_path, monkeypatch):
+    """Test the query chunks are joined back in the order of the query"""
+    fake_blastn = tmp_path / 'blastn'
+    fake_blastn.write_text(
+        "#!/bin/sh\n"
+        "while [ $# -gt 0 ]; do\n"
+        "  case $1 in -query) query=$2;; -out) out=$2;;\n"
+        "    -num_threads) threads=$2;; esac; shift 2\n"
+        "done\n"
+        "grep '>' $query | sed \"s/>\\(.*\\)/\\1\\t$threads/\" > $out\n")
+    fake_blastn.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}:{os.environ['PATH']}")
+    query = tmp_path / 'query.fa'
+    query.write_text("".join(f">q{i}\n{'A' * (i + 1) * 10}\n"
+                             for i in range(10)))
+    out = tmp_path / 'out.tab'
+    run_blastn('db', str(query), str(out), threads=3)
+    assert out.read_text() == "".join(f"q{i}\t1\n" for i in range(10))
+    assert not any(i.name.startswith('blastn_chunks')
+                   for i in tmp_path.iterdir())
+    run_blastn('db', str(query), str(out), threads=20)
+    assert out.read_text() == "".join(f"q{i}\t2\n" for i in range(10))
+
+
+def test_allocate_stage1_threads():
+    """Test barrnap and the stage 1 search get separate core budgets"""
+    assert allocate_stage1_threads(1) == {'barrnap': 1, 'search': 1}
+    assert allocate_stage1_threads(4) == {'barrnap': 2, 'search': 2}
+    assert allocate_stage1_threads(64) == {'barrnap': 4, 'search': 60}
+    assert allocate_stage1_threads(64, shards=4) == {'barrnap': 4,
+                                                     'search': 12}
+    assert allocate_stage1_threads(10, barrnap_share=0.5) == \
+        {'barrnap': 5, 'search': 5}
+    assert allocate_stage1_threads(10, barrnap_share=1) == \
+        {'barrnap': 9, 'search': 1}
+
+
+def test_exact_stage2_prepass(tmp_path):
+    """Test exact ASV matches are found on both strands, the rest are left"""
+    targets = tmp_path / 'candidates.fna'
+    queries = tmp_path / 'asvs.fa'
+    targets.write_text(">c1 mmseqs\nTTACGTACGGATCCAAA\n"
+                       ">c2 barrnap\nGGGTTTGGATCCGTACG\n")
+    # a is in c1 and reversed in c2, b is reversed in c1 and in c2, c has no
+    # match
+    queries.write_text(">a\nCGTACGGATCC\n>b\nTTTGGATCCG\n"
+                       ">c\nAAAAAAAAAAAA\n")
+    out_tab = tmp_path / 'exact.tab'
+    leftover = tmp_path / 'leftover.fa'
+    exact_stage2_prepass(str(targets), str(queries), str(out_tab),
+                         str(leftover))
+    hits = pd.read_csv(out_tab, sep='\t', header=None, names=MBSTATS_NAMES)
+    assert list(hits['qseqid']) == ['a', 'a', 'b', 'b']
+    assert list(hits['sseqid']) == ['c1', 'c2', 'c1', 'c2']
+    assert list(hits['sstart']) == [4, 17, 17, 4]
+    assert list(hits['send']) == [14, 7, 8, 13]
+    assert (hits['pident'] == 100).all()
+    assert (hits['mismatch'] == 0).all()
+    assert list(hits['length']) == list(hits['qlen'])
+    assert [i[0] for i in read_fasta(leftover)] == ['c']
+    (tmp_path / 'asvs.tsv').write_text("representative\tmember\na\ta\n"
+                                       "a\td\nb\tb\nc\tc\n")
+    assert read_exact_queries(str(out_tab), str(tmp_path / 'asvs.tsv')) == \
+        {'a', 'b', 'd'}
+
+
+def test_dereplicate_and_expand_hits(tmp_path):
+    """Test hits of representatives are copied to every identical query"""
+    asvs = tmp_path / 'asvs.fa'
+    asvs.write_text(">a\nACGT\n>b desc\nGGCC\n>c\nACGT\n")
+    assert dereplicate_fasta(str(asvs), str(tmp_path / 'asvs_derep.fa'),
+                             str(tmp_path / 'asvs.tsv')) == 1
+    assert [i[:2] for i in read_fasta(tmp_path / 'asvs_derep.fa')] == \
+        [('a', ''), ('b', 'desc')]
+    pd.DataFrame([['b', 't2', '100', '4', '0', '0', '1', '4', '1', '4',
+                   '1.00E-03', '8', '4', '6'],
+                  ['a', 't3', '100', '4', '0', '0', '1', '4', '2', '5',
+                   '7.500000000000001e-130', '8', '4', '6'],
+                  ['a', 't1', '100', '4', '0', '0', '1', '4', '2', '5',
+                   '2.00E-03', '8', '4', '6']]).to_csv(
+        tmp_path / 'hits.tab', sep='\t', header=False, index=False)
+    expand_dereplicated_hits(
+        str(tmp_path / 'hits.tab'), str(tmp_path / 'expanded.tab'),
+        str(tmp_path / 'asvs.tsv'))
+    hits = pd.read_csv(tmp_path / 'expanded.tab', sep='\t', header=None,
+                       names=MBSTATS_NAMES, dtype=str)
+    assert list(zip(hits['qseqid'], hits['sseqid'])) == [
+        ('a', 't3'), ('a', 't1'), ('b', 't2'), ('c', 't3'), ('c', 't1')]
+    # The e-values are copied as the search wrote them
+    assert list(hits['evalue']) == ['7.500000000000001e-130', '2.00E-03',
+                                    '1.00E-03', '7.500000000000001e-130',
+                                    '2.00E-03']
+    # with nothing collapsed the search output is kept byte for byte
+    assert dereplicate_fasta(str(tmp_path / 'asvs_derep.fa'),
+                             str(tmp_path / 'asvs_again.fa'),
+                             str(tmp_path / 'asvs_again.tsv')) == 0
+    expand_dereplicated_hits(
+        str(tmp_path / 'hits.tab'), str(tmp_path / 'expanded.tab'),
+        str(tmp_path / 'asvs_again.tsv'))
+    assert (tmp_path / 'expanded.tab').read_text() == \
+        (tmp_path / 'hits.tab').read_text()
+
+
+def test_adaptive_passes(tmp_path):
+    """Test only queries with no passing hit are searched again and merged"""
+    query = tmp_path / 'query.fa'
+    query.write_text(">q1\nACGT\n>q2\nACGT\n>q3\nACGT\n")
+    row = "\t{}\t100\t0\t0\t1\t100\t1\t100\t1e-10\t{}\t100\t100\n"
+    fast = tmp_path / 'fast.tab'
+    fast.write_text("q2\tt1" + row.format(99.0, 90) +
+                    "q1\tt1" + row.format(80.0, 50))
+    leftover = tmp_path / 'leftover.fa'
+    assert split_adaptive_queries(str(fast), str(query), str(leftover),
+                                  min_pct_id=90) == 2
+    assert [i[0] for i in read_fasta(leftover)] == ['q1', 'q3']
+    thorough = tmp_path / 'thorough.tab'
+    thorough.write_text("q3\tt2" + row.format(95.0, 70) +
+                        "q1\tt2" + row.format(97.0, 80))
+    out = tmp_path / 'out.tab'
+    merge_adaptive_passes(str(fast), str(thorough), str(leftover), str(query),
+                          str(out))
+    hits = pd.read_csv(out, sep='\t', header=None, names=MBSTATS_NAMES)
+    assert list(zip(hits['qseqid'], hits['sseqid'])) == [
+        ('q1', 't2'), ('q2', 't1'), ('q3', 't2')]
+
+
+def test_extract_barrnap_16s(tmp_path):
+    """Test 16S features are pulled with the names bedtools gives them"""
+    bins = tmp_path / 'bins.fa'
+    bins.write_text(">s2 desc\nAAAACCCC\nGGGGTTTT\n>s1\nACGTACGTAC\n")
+    index = tmp_path / 'bins.tsv'
+    build_fasta_index(str(bins), str(index))
+    feature = "{}\tbarrnap:0.9\trRNA\t{}\t{}\t0\t+\t.\tName={}_rRNA\n"
+    gff = tmp_path / 'rrna.gff'
+    gff.write_text("##gff-version 3\n" + feature.format('s1', 2, 5, '16S') +
+                   feature.format('s1', 8, 9, '23S') +
+                   feature.format('s1', 9, 11, '16S') +
+                   feature.format('s2', 7, 10, '16S') +
+                   feature.format('s2', 1, 4, '16S'))
+    out_gff = tmp_path / '16S.gff'
+    out_fasta = tmp_path / '16S.fna'
+    extract_barrnap_16s(str(gff), str(bins), str(index), str(out_gff),
+                        str(out_fasta))
+    assert out_gff.read_text().count('16S') == 4
+    assert [(i[0], i[2]) for i in read_fasta(out_fasta)] == [
+        ('s1:1-5', b'CGTA'), ('s2:6-10', b'CCGG'), ('s2:0-4', b'AAAA')]
+
+
+def test_run_report(tmp_path, monkeypatch):
+    """Test the benchmarks and run block timers are joined by job"""
+    monkeypatch.chdir(tmp_path)
+    header = "s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\t" \
+        "io_out\tmean_load\tcpu_time\n"
+    for path, row in [
+            (run_report_path('search', 'shard').format(shard=0),
+             "2.0\t0:00:02\t100\t1\t1\t1\t5\t1\t1\t1.5\n"),
+            (run_report_path('search', 'shard').format(shard=1),
+             "3.0\t0:00:03\t300\t1\t1\t1\t5\t2\t1\t2.5\n"),
+            (run_report_path('gather'),
+             "1.0\t0:00:01\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\n")]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as out:
+            out.write(header + row)
+    (tmp_path / 'in.tab').write_text("a" * 1000)
+    with time_run_block('gather', [], ['in.tab'], ['out.tab']):
+        (tmp_path / 'out.tab').write_text("a" * 500)
+    assert write_run_report('run_report', 'report.tsv', 'report.json')
+    assert not os.path.exists('run_report')
+    jobs = pd.read_csv('report.tsv', sep='\t')
+    assert list(zip(jobs['rule'], jobs['job'])) == [
+        ('gather', 'job'), ('search', '0'), ('search', '1')]
+    assert list(jobs['input_mb'].fillna(0)) == [0.001, 0, 0]
+    assert list(jobs['output_mb'].fillna(0)) == [0.0005, 0, 0]
+    with open('report.json') as in_file:
+        rules = json.load(in_file)['rules']
+    assert rules['search']['jobs'] == 2
+    assert rules['search']['wall_s'] == 5.0
+    assert rules['search']['max_rss_mb'] == 300
+    assert rules['gather']['max_rss_mb'] is None
+    assert not write_run_report('missing', 'report.tsv', 'report.json')
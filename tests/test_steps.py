@@ -1,9 +1,13 @@
 """Here we can test the steps of the pipeline in a methodically"""
 import pytest
 
+import json
+import random
+import shutil
 import subprocess
 from join_asvbins import join_asvbins
 import os
+import pandas as pd
 
 
 MINI_BINS = os.path.join('tests', 'data', 'mini_bins')
@@ -35,7 +39,7 @@ def test_run_blast(tmp_path):
     assert os.path.exists(os.path.join(output_path, "candidate_statistics.tsv"))
     assert os.path.exists(os.path.join(output_path, "match_sequences.fna"))
     assert os.path.exists(os.path.join(output_path, "match_statistics.tsv"))
-    assert len(os.listdir(output_path)) == 5 # acounts for .snakemake folder
+    assert len(os.listdir(output_path)) == 8 # acounts for .snakemake folder
 
 
 def test_run_mmseqs(tmp_path):
@@ -52,7 +56,11 @@ def test_run_mmseqs(tmp_path):
     assert os.path.exists(os.path.join(output_path, "candidate_statistics.tsv"))
     assert os.path.exists(os.path.join(output_path, "match_sequences.fna"))
     assert os.path.exists(os.path.join(output_path, "match_statistics.tsv"))
-    assert len(os.listdir(output_path)) == 5 # acounts for .snakemake folder
+    report = pd.read_csv(os.path.join(output_path, "run_report.tsv"),
+                         sep='\t')
+    assert {'combine_input_fa', 'mmseqs_stage1_search',
+            'combine_barrnap_with_other'}.issubset(report['rule'])
+    assert len(os.listdir(output_path)) == 8 # acounts for .snakemake folder
 
 
 def test_get_matches(tmp_path):
@@ -67,7 +75,7 @@ def test_get_matches(tmp_path):
     )
     assert os.path.exists(os.path.join(output_path, "match_sequences.fna"))
     assert os.path.exists(os.path.join(output_path, "match_statistics.tsv"))
-    assert len(os.listdir(output_path)) == 3 # acounts for .snakemake folder
+    assert len(os.listdir(output_path)) == 5 # acounts for .snakemake folder
 
 
 def test_get_candidates(tmp_path):
@@ -81,5 +89,73 @@ def test_get_candidates(tmp_path):
     )
     assert os.path.exists(os.path.join(output_path, "candidate_sequences.fna"))
     assert os.path.exists(os.path.join(output_path, "candidate_statistics.tsv"))
-    assert len(os.listdir(output_path)) == 3 # acounts for .snakemake folder
+    assert len(os.listdir(output_path)) == 6 # acounts for .snakemake folder
+
+
+
+def test_kmer_screen_recall(tmp_path):
+    """The k-mer screen should find the same candidates as a full search"""
+    outputs = {}
+    for screen in (None, 50):
+        output_path = os.path.join(tmp_path, f'test_kmer_screen_{screen}')
+        join_asvbins(
+            bins = MINI_BINS,
+            output_dir = output_path,
+            generic_16S = MINI_16S,
+            threads=1,
+            verbosity=6,
+            s1_kmer_screen=screen
+        )
+        with open(os.path.join(output_path, "candidate_statistics.tsv")) as stats:
+            outputs[screen] = stats.read()
+    assert outputs[50] == outputs[None]
+
+
+def test_adaptive_sensitivity_must_be_lower(tmp_path):
+    """The fast pass of the adaptive search must be less sensitive"""
+    with pytest.raises(AttributeError, match=r'.*must be lower.*'):
+        join_asvbins(
+            bins = MINI_BINS,
+            asv_seqs = MINI_ASV,
+            output_dir = os.path.join(tmp_path, 'test_adaptive'),
+            generic_16S = MINI_16S,
+            s2_mmseqs_sensitivity=4,
+            s2_adaptive_sensitivity=4
+        )
+
+
+def test_exact_prepass_needs_strict_filters(tmp_path):
+    """The exact pre-pass must not drop near matches the filters would pass"""
+    with pytest.raises(AttributeError, match=r'.*remove near matches.*'):
+        join_asvbins(
+            bins = MINI_BINS,
+            asv_seqs = MINI_ASV,
+            output_dir = os.path.join(tmp_path, 'test_exact'),
+            generic_16S = MINI_16S,
+            s2_exact_prepass=True
+        )
+
 
+def test_incremental_new_bin_without_16s(tmp_path):
+    """A new bin with no 16S still moves the incremental run on"""
+    bins_path = os.path.join(tmp_path, 'bins')
+    output_path = os.path.join(tmp_path, 'test_incremental')
+    os.makedirs(bins_path)
+    for path in (MINI_BINS_BARRNAP, MINI_BINS_MMSEQS):
+        shutil.copy(path, bins_path)
+    run_args = dict(bins=bins_path, asv_seqs=MINI_ASV,
+                    output_dir=output_path, generic_16S=MINI_16S, threads=1,
+                    incremental=True)
+    join_asvbins(**run_args)
+    with open(os.path.join(output_path, "candidate_sequences.fna")) as fasta:
+        candidates = fasta.read()
+    rand = random.Random(0)
+    with open(os.path.join(bins_path, 'no_16s.fa'), 'w') as out:
+        out.write(">no_16s_1\n%s\n" % ''.join(rand.choice('ACGT')
+                                             for _ in range(3000)))
+    join_asvbins(**run_args)
+    with open(os.path.join(output_path, "incremental_manifest.json")) as mf:
+        assert 'no_16s.fa' in json.load(mf)['bins']
+    with open(os.path.join(output_path, "candidate_sequences.fna")) as fasta:
+        assert fasta.read() == candidates
+    assert not os.path.exists(os.path.join(output_path, 'incremental_run'))
@@ -1,10 +1,18 @@
+import gzip
 import random
 from itertools import combinations
 import pytest
 import pathlib
+import numpy as np
 import pandas as pd
 from join_asvbins.utils import process_barfasta, filter_mdstats, \
-    fasta_to_df, df_to_fasta, filter_fasta_from_headers
+    fasta_to_df, df_to_fasta, filter_fasta_from_headers, get_mdstats_masks, \
+    read_fasta, build_fasta_index, load_fasta_index, fetch_fasta_records, \
+    fetch_fasta_windows, window_start_from_description, split_fasta_by_size, \
+    kmer_codes, build_kmer_table, screen_fasta_by_kmers, concat_fasta_files, \
+    process_mbdata, find_exact_hits
+from join_asvbins import utils
+from join_asvbins.seq_array import SeqArray
 
 
 def test_filter_mdstats():
@@ -35,6 +43,22 @@ def test_filter_mdstats():
                 f"The test case/cases {expect - out} wrongfully filtered"
 
 
+def test_get_mdstats_masks():
+    """Test get_mdstats_masks counts each filter on its own"""
+    input_df = pd.DataFrame({
+       "gapopen"  : [  3,   2,   1,   0],
+       "mismatch" : [  2,   3,   1,   1],
+       "length"   : [400, 400, 148, 300],
+       "qlen"     : [500, 800, 200, 600],
+       "pident"   : [100,  50,  60,  40],
+    })
+    masks = get_mdstats_masks(input_df, max_gaps=2, min_pct_id=50)
+    assert list(masks) == ['max_gaps', 'min_pct_id']
+    assert list(masks['max_gaps']) == [False, True, True, True]
+    assert list(masks['min_pct_id']) == [True, True, True, False]
+    assert get_mdstats_masks(input_df) == {}
+
+
 def test_barnap_procesing():
     """Test test_barnap_procesing"""
     input_df = pd.DataFrame({
@@ -59,6 +83,17 @@ def test_barnap_procesing():
                                   check_index_type=False, check_names=False)
 
 
+def test_barnap_procesing_unsorted():
+    """Test process_barfasta with unsorted and nested fragments"""
+    input_df = pd.DataFrame({
+        'header': ['b:3-7', 'a:5-9', 'b:0-4', 'b:1-2', 'a:0-3', 'b:9-12'],
+        'seq': SeqArray.from_bytes([b'defg', b'fghi', b'abcd', b'b', b'abc',
+                                    b'jkl'])})
+    output_df = process_barfasta(input_df)
+    assert list(output_df['barrnap_header']) == ['a:0-3', 'b:0-7']
+    assert [i.tobytes() for i in output_df['seq']] == [b'abc', b'abcdefg']
+
+
 @pytest.fixture(scope="session")
 def temp_fasta_protien_100(tmpdir_factory):
     """Creates a fake protein file"""
@@ -86,6 +121,61 @@ def test_fasta_to_df_no_filter(temp_fasta_protien_100):
         "The header was not correctly matched"
 
 
+def test_read_fasta(tmp_path):
+    """Test read_fasta with wrapped lines, descriptions and gzip"""
+    text = ">a first seq\nACG\nTN\n\n>b\nGG TT\n>c\nA"
+    expect = [('a', 'first seq', b'ACGTN'), ('b', '', b'GGTT'),
+              ('c', '', b'A')]
+    plain_path = tmp_path / 'plain.fa'
+    plain_path.write_text(text)
+    gzip_path = tmp_path / 'zipped.fa.gz'
+    with gzip.open(gzip_path, 'wt') as out:
+        out.write(text)
+    assert list(read_fasta(plain_path)) == expect
+    assert list(read_fasta(gzip_path)) == expect
+
+
+def test_fasta_index(tmp_path):
+    """Test the fasta index pulls the same records as a full read"""
+    fasta_path = tmp_path / 'bins.fa'
+    fasta_path.write_text(">a\nACGTA\nCG\n>b desc\nGGGG\nTT\nAAAA\n"
+                          ">c\nTTTTTTTT\n>d\nAC\nGT\nA\n")
+    index_path = tmp_path / 'bins.idx'
+    index = build_fasta_index(fasta_path, index_path)
+    assert list(index['header']) == ['a', 'b', 'c', 'd']
+    assert list(index['length']) == [7, 10, 8, 5]
+    # b has irregular lines so it can only be read whole
+    assert list(index['line_bases']) == [5, 0, 8, 2]
+    loaded = load_fasta_index(fasta_path, index_path)
+    pd.testing.assert_frame_equal(index, loaded)
+    pulled = list(fetch_fasta_records(fasta_path, loaded, ['d', 'b', 'x']))
+    assert pulled == [('b', '', b'GGGGTTAAAA'), ('d', '', b'ACGTA')]
+    windows = pd.DataFrame({'header': ['a', 'b', 'd'], 'start': [4, 3, -2],
+                            'stop': [6, 8, 9]})
+    pulled = list(fetch_fasta_windows(fasta_path, loaded, windows))
+    assert pulled == [('a', 'window=4-6', b'AC'),
+                      ('b', 'window=3-8', b'GTTAA'),
+                      ('d', 'window=0-5', b'ACGTA')]
+    starts = window_start_from_description(pd.Series([i[1] for i in pulled]
+                                                     + ['']))
+    assert list(starts) == [4, 3, 0, 0]
+    # windows past the end of a scaffold are empty, not the rest of the file
+    windows = pd.DataFrame({'header': ['a', 'c'], 'start': [9, 8],
+                            'stop': [12, 10]})
+    pulled = list(fetch_fasta_windows(fasta_path, loaded, windows))
+    assert pulled == [('a', 'window=9-9', b''), ('c', 'window=8-8', b'')]
+
+
+def test_df_to_fasta(tmp_path):
+    """Test df_to_fasta writes one line per sequence"""
+    out_path = tmp_path / 'out.fa'
+    data = pd.DataFrame({'header': ['a', 'b'], 'note': ['Barnnap', ''],
+                         'seq': [np.frombuffer(b'ACGT', dtype='S1'),
+                                 list('GG')]})
+    df_to_fasta(data, out_path)
+    assert out_path.read_text() == ">a Barnnap\nACGT\n>b\nGG\n"
+
+
 def test_empty_fasta_to_df(tmp_path):
     empty_file = tmp_path / "emptyfile"
     empty_file.touch()
@@ -104,7 +194,7 @@ def test_empty_fasta_to_df(tmp_path):
 def test_filter_fasta_from_headers(temp_fasta_protien_100, tmp_path):
     "Test filter_fasta_from_headers"""
     headers = {f"sequence-{i}:{i+10}" for i in range(100)}
-    sample_headers = set(random.sample(headers, 20))
+    sample_headers = set(random.sample(sorted(headers), 20))
     filtered_path = str(tmp_path / 'filter.fa')
     filter_fasta_from_headers(temp_fasta_protien_100,
                               filtered_path, sample_headers)
@@ -172,3 +262,110 @@ def test_overlap_filter(overlap_df):
                    min_len_with_overlap=min_len_with_overlap,
                    min_len_pct_no_overlap=min_len_pct_no_overlap)
     assert overlap_df[overlap_df['pass']].equals(ouput_df)
+
+
+def test_split_fasta_by_size(tmp_path):
+    """Test shards are balanced and keep the records as they were"""
+    fasta = tmp_path / 'in.fa'
+    fasta.write_text(">a\nAAAA\nAA\n>b desc\nCCCCCCCCCC\n>c\nGGG\n"
+                     ">d\nTTTTTTT\n>a\nAA\n>e\nA")
+    index = build_fasta_index(str(fasta))
+    out_paths = [str(tmp_path / f'{i}.fa') for i in range(3)]
+    sizes = split_fasta_by_size(str(fasta), index, out_paths)
+    shards = [open(i).read() for i in out_paths]
+    assert shards == [">b desc\nCCCCCCCCCC\n",
+                      ">d\nTTTTTTT\n>e\nA\n",
+                      ">a\nAAAA\nAA\n>c\nGGG\n>a\nAA\n"]
+    assert sizes == [10, 8, 11]
+
+
+def test_kmer_codes():
+    """Test k-mers are coded the same on both strands and skip other bases"""
+    codes, valid = kmer_codes(b'ACGGNTTACCGTA', 3)
+    assert list(valid) == [True, True, False, False, False, True, True,
+                           True, True, True, True]
+    # ACG and CGT, CCG and CGG are reverse complements
+    assert codes[0] == codes[9]
+    assert codes[1] == codes[8]
+    assert len(kmer_codes(b'AC', 3)[0]) == 0
+    random.seed(2)
+    seq = ''.join(random.choice('ACGT') for _ in range(60)).encode()
+    number = {ord(j): i for i, j in enumerate('ACGT')}
+    for k in (7, 31):
+        codes, _ = kmer_codes(seq, k)
+        for pos in range(len(seq) - k + 1):
+            forward = sum(number[j] * 4 ** (k - 1 - i)
+                          for i, j in enumerate(seq[pos:pos + k]))
+            reverse = sum((3 - number[j]) * 4 ** i
+                          for i, j in enumerate(seq[pos:pos + k]))
+            assert codes[pos] == min(forward, reverse)
+
+
+def test_find_exact_hits():
+    """Test queries of mixed lengths are found on both strands"""
+    random.seed(3)
+    target = ''.join(random.choice('ACGT') for _ in range(200))
+    reverse = target.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+    queries = [target[10:60], reverse[20:45], target[100:140].lower(),
+               'NN' + target[150:160], target[5:45] + 'A' * 40]
+    hits = find_exact_hits([i.encode() for i in queries],
+                           [b'A' * 10, target.encode()])
+    assert hits == [(0, 1, 10, False), (1, 1, 155, True),
+                    (2, 1, 100, False)]
+    # A query with other bases in its seed is still found if it matches
+    hits = find_exact_hits([b'NN' + target[150:160].encode()],
+                           [target[:148].encode() + b'NN' +
+                            target[150:].encode()])
+    assert hits == [(0, 0, 148, False)]
+    with pytest.raises(ValueError):
+        find_exact_hits([b''], [target.encode()])
+
+
+def test_screen_fasta_by_kmers(tmp_path):
+    """Test only records with enough k-mers from the reference are kept"""
+    random.seed(1)
+    gene = ''.join(random.choice('ACGT') for _ in range(300))
+    reference = tmp_path / 'ref.fa'
+    reference.write_text(f">r1\n{gene}\n")
+    other = ''.join(random.choice('ACGT') for _ in range(500))
+    reverse = gene[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+    bins = tmp_path / 'bins.fa'
+    bins.write_text(f">s1 gene\n{other[:200]}{gene[50:250]}\n{other[200:]}\n"
+                    f">s2\n{other}\n>s3\n{reverse}\n>s4\nACG\n")
+    table = build_kmer_table(str(reference), k=8)
+    out = tmp_path / 'out.fa'
+    sizes = screen_fasta_by_kmers(str(bins), str(out), table, 100, k=8,
+                                  window=150)
+    assert [i[0] for i in read_fasta(out)] == ['s1', 's3']
+    assert out.read_text().startswith(f">s1 gene\n{other[:200]}")
+    assert sizes == (700 + 500 + 300 + 3, 700 + 300)
+
+
+def test_concat_fasta_files(tmp_path, monkeypatch):
+    """Test files are joined in order, gziped or not, and indexed"""
+    # Small files are read without workers unless the limit is lowered
+    monkeypatch.setattr(utils, 'CONCAT_POOL_MIN_BYTES', 0)
+    plain = tmp_path / 'a.fa'
+    plain.write_text(">a1\nACGT\nAC\n>a2 desc\nGG")
+    zipped = tmp_path / 'b.fa.gz'
+    with gzip.open(zipped, 'wt') as out:
+        out.write(">b1\nTTTT\n")
+    out_path = tmp_path / 'all.fa'
+    for threads in (1, 2):
+        index = concat_fasta_files([str(zipped), str(plain)], str(out_path),
+                                   threads=threads)
+        assert out_path.read_text() == \
+            ">b1\nTTTT\n>a1\nACGT\nAC\n>a2 desc\nGG\n"
+        assert list(index['file']) == [0, 1, 1]
+        built = build_fasta_index(str(out_path))
+        assert index.drop(columns='file').equals(built)
+
+
+def test_process_mbdata_strands():
+    """Test minus strand hits are cut out and reverse complemented"""
+    data = pd.DataFrame({
+        'sseqid': ['a', 'b', 'b'], 'length': [4, 4, 2],
+        'sstart': [2, 6, 1], 'send': [5, 3, 2],
+        'seq': SeqArray.from_bytes([b'TAACGG', b'AAACCGTT', b'AAACCGTT'])})
+    data = process_mbdata(data).sort_values('sseqid')
+    assert [i.tobytes() for i in data['seq']] == [b'AACG', b'CGGT']